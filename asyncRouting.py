@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import aiohttp
+
+import osrmHealth
+import routingMetrics
+
+class AsyncRoutingClient:
+    """Concurrent OSRM client with a pooled keep-alive session.
+
+    At most `concurrency` requests are in flight at once, over connections that
+    are reused between calls.  Failures are handled like osm_request: requests
+    to a server whose circuit breaker is open are not sent, retries wait a
+    jittered backoff and draw on the shared retry budget, no request runs past
+    `deadline` seconds, and None is returned once a request has failed.  OSRM's
+    own error responses (4xx, e.g. NoRoute) are returned as they are.
+
+    The client owns its own event loop so synchronous code can call get_many()
+    repeatedly and keep the same connection pool.
+    """
+
+    def __init__(self, concurrency=32, retries=5, base_wait=1, timeout=10, deadline=30):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.base_wait = base_wait
+        self.timeout = timeout
+        self.deadline = deadline
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphore = None
+
+    async def _open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def fetch(self, url):
+        await self._open()
+        deadline = time.monotonic() + self.deadline
+        breaker = osrmHealth.breaker_for(url)
+        osrmHealth.budget.deposit()
+        for retry in range(self.retries):
+            #The deadline is checked first: allow() may hand this request the
+            #breaker's only probe, which must end in a success or a failure.
+            if deadline - time.monotonic() <= 0:
+                routingMetrics.metrics.inc("deadline_exceeded")
+                return None
+            while not breaker.allow():
+                #While a probe is finding out whether the server is back, wait
+                #for its answer instead of failing (at most until the deadline).
+                if not breaker.probing or time.monotonic() >= deadline:
+                    routingMetrics.metrics.inc("breaker_rejections")
+                    return None
+                await asyncio.sleep(osrmHealth.PROBE_POLL_SECONDS)
+            remaining = max(deadline - time.monotonic(), osrmHealth.PROBE_POLL_SECONDS)
+            try:
+                async with self.semaphore:
+                    with routingMetrics.metrics.timer("osrm_request"):
+                        async with self.session.get(url, allow_redirects=False,
+                                                    timeout=aiohttp.ClientTimeout(total=min(self.timeout, remaining))) as r:
+                            if 400 <= r.status < 500 and r.status != 429:
+                                #OSRM answered, just not with a route: not worth retrying.
+                                breaker.record_success()
+                                return await r.json(content_type=None)
+                            r.raise_for_status()  # Raise an exception for HTTP errors
+                            res = await r.json(content_type=None)
+                breaker.record_success()
+                return res
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                breaker.record_failure()
+                print(f"Attempt {retry + 1}/{self.retries}: Request failed - {str(e) or type(e).__name__}")
+
+                if retry < self.retries - 1:
+                    if not osrmHealth.budget.withdraw():
+                        print("Retry budget exhausted, giving up on the request.")
+                        routingMetrics.metrics.inc("budget_exhausted")
+                        break
+                    # The slot is released while waiting so other requests keep the server busy.
+                    wait_time = min(osrmHealth.backoff(retry, self.base_wait), deadline - time.monotonic())
+                    if wait_time <= 0:
+                        break
+                    print(f"Retrying in {wait_time:.1f} seconds...")
+                    routingMetrics.metrics.inc("retries")
+                    with routingMetrics.metrics.timer("backoff"):
+                        await asyncio.sleep(wait_time)
+            except BaseException:
+                #Cancelled or interrupted mid-request: neither outcome is known.
+                breaker.release()
+                raise
+
+        routingMetrics.metrics.inc("request_failures")
+        return None  # All retries failed
+
+    async def fetch_all(self, urls):
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    def get_many(self, urls):
+        """Fetch all urls concurrently; returns parsed responses (or None) in order."""
+        return self.loop.run_until_complete(self.fetch_all(urls))
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
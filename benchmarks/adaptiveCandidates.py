@@ -0,0 +1,126 @@
+#Compares the adaptive candidate mode (route nearest first, stop once the
+#crow-flies lower bound rules out the rest) with routing every origin to all
+#N_CANDIDATES nearest urban areas, on the fake OSRM server.
+#
+#Usage: python benchmarks/adaptiveCandidates.py [--origins 3000] [--urban 2000] [--unroutable 0.02]
+#       python benchmarks/adaptiveCandidates.py --origin-path sourceData/nepalDegurbaPoints.geojson \
+#                                               --urban-path sourceData/urbanCentroids.geojson
+#
+#With --origin-path/--urban-path the real inputs are used (prepared as
+#processDegurb would); otherwise synthetic points over Nepal.  Runs both
+#ROUTING_MODEs and reports the HTTP requests the fake served and the pairs
+#routed in each mode, and how many requests per origin adaptive saved.
+#Checks that every origin the fixed mode matches gets the same destination
+#and distance in adaptive mode; origins the fixed mode could not match may be
+#matched by the adaptive mode's wider search.  Last, with the fake server
+#down, checks that origins whose requests failed are not widened: on the last
+#pass they are passed through as they are, otherwise deferred.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+import routingMetrics
+from fakeOsrm import FakeOSRM
+from routingClient import ListWriter, synthetic_points
+from synthetic import origin_grid
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=3000)
+    parser.add_argument("--urban", type=int, default=2000)
+    parser.add_argument("--unroutable", type=float, default=0.02)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--origin-path")
+    parser.add_argument("--urban-path")
+    args = parser.parse_args()
+
+    if args.origin_path and args.urban_path:
+        processDegurb.ORIGIN_PATH = args.origin_path
+        processDegurb.URBAN_PATH = args.urban_path
+        processDegurb.PREPARED_PATH = tempfile.mkdtemp()
+        urbanPoints = processDegurb.load_urban_points()
+        pts = processDegurb.load_origin_points().head(args.origins)
+    else:
+        urbanPoints = synthetic_points(args.urban, 3)
+        pts = origin_grid(args.origins)
+    processDegurb.ROUTE_CACHE = False
+    #The fake answers unroutable /route pairs with an error status, which is retried.
+    processDegurb.RESPONSEWAIT = 0.01
+    metrics = routingMetrics.enable()
+
+    def run(candidateMode):
+        processDegurb.CANDIDATE_MODE = candidateMode
+        writer = ListWriter()
+        with FakeOSRM(latency=args.latency, unroutable=args.unroutable) as osrm:
+            processDegurb.OSRM_URL = osrm.url
+            before = metrics.counters.get("pairs_routed", 0)
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                start = time.perf_counter()
+                processDegurb.processPoints(pts, writer, urbanPoints)
+                elapsed = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+            requests = osrm.counts["route"] + osrm.counts["table"]
+        pairs = metrics.counters.get("pairs_routed", 0) - before if candidateMode == "adaptive" else len(pts) * processDegurb.N_CANDIDATES
+        return {r["urbanID"]: (r["dest_ID"], r["distance"]) for r in writer.rows}, requests, pairs, elapsed
+
+    def auto_mode():
+        processDegurb.CANDIDATE_MODE = "auto"
+        return processDegurb.candidate_mode()
+
+    failed = False
+    for routingMode in ["table", "route"]:
+        processDegurb.ROUTING_MODE = routingMode
+        fixed, fixedRequests, fixedPairs, fixedTime = run("fixed")
+        adaptive, adaptiveRequests, adaptivePairs, adaptiveTime = run("adaptive")
+        print("%s mode, %d origins:" % (routingMode, len(pts)))
+        print("  fixed    %7d requests  %8d pairs (%.1f per origin)  %6.2f s"
+              % (fixedRequests, fixedPairs, fixedPairs / len(pts), fixedTime))
+        print("  adaptive %7d requests  %8d pairs (%.1f per origin)  %6.2f s"
+              % (adaptiveRequests, adaptivePairs, adaptivePairs / len(pts), adaptiveTime))
+        print("  adaptive saved %.2f requests per origin (%.0f%%) and %.1f pairs per origin; CANDIDATE_MODE \"auto\" picks %s here"
+              % ((fixedRequests - adaptiveRequests) / len(pts), 100.0 * (1 - adaptiveRequests / fixedRequests),
+                 (fixedPairs - adaptivePairs) / len(pts), auto_mode()))
+        differ = [pid for pid in fixed if adaptive.get(pid) != fixed[pid]]
+        recovered = len(set(adaptive) - set(fixed))
+        print("  %d of %d matched origins differ; %d unmatched origins recovered by widening" % (len(differ), len(fixed), recovered))
+        if differ:
+            failed = True
+            for pid in differ[:5]:
+                print("    PID " + str(pid) + ": fixed " + str(fixed[pid]) + ", adaptive " + str(adaptive.get(pid)))
+
+    #Runs last: it leaves the fake's circuit breaker open.
+    processDegurb.ROUTING_MODE = "route"
+    sample = pts.head(50)
+    with FakeOSRM(latency=0) as osrm:
+        processDegurb.OSRM_URL = osrm.url
+        osrm.down = True
+        urbanIndex = processDegurb.UrbanIndex(urbanPoints)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for deferred in [None, set()]:
+                stats = {}
+                for origins, candidates, routed in processDegurb.adaptive_windows(sample, urbanIndex, None, None, None, stats, deferred):
+                    pass
+                label = "last pass" if deferred is None else "deferring pass"
+                widenedOk = stats.get("widened", 0) == 0
+                deferredOk = deferred is None or deferred == set(sample["PID"])
+                print("  while down (%s): %d widenings for %d origins%s" % (label, stats.get("widened", 0), len(sample),
+                      "" if deferred is None else ", %d deferred" % len(deferred)), file=stdout)
+                if not widenedOk or not deferredOk:
+                    failed = True
+        finally:
+            sys.stdout = stdout
+    print("FAIL" if failed else "OK")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
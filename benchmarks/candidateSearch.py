@@ -0,0 +1,86 @@
+#Benchmark of urban-centre candidate selection:
+#the original per-origin full-table distance scan against the UrbanIndex KD-tree.
+#
+#Usage: python benchmarks/candidateSearch.py [--origins 1000000] [--urban 20000] [--loop-sample 200]
+#
+#The per-origin scan is far too slow to run over the full synthetic grid, so it is
+#timed on --loop-sample origins and extrapolated.  The same sample is used to check
+#that both methods return the same top-k candidate set.
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import geopandas
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from urbanIndex import UrbanIndex
+
+def synthetic_urban(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(60, 100, n)
+    lat = rng.uniform(5, 40, n)
+    return geopandas.GeoDataFrame({"UID": np.arange(n)},
+                                  geometry=geopandas.points_from_xy(lon, lat),
+                                  crs="EPSG:4326")
+
+def synthetic_grid(n):
+    #Regular grid of roughly n origins over the same extent as the urban centres.
+    side = int(np.ceil(np.sqrt(n)))
+    lon, lat = np.meshgrid(np.linspace(60, 100, side), np.linspace(5, 40, side))
+    return lon.ravel()[:n], lat.ravel()[:n]
+
+def loop_candidates(urbanPoints, lon, lat, k):
+    #The original processPoints selection: a full-table distance per origin.
+    out = []
+    for x, y in zip(lon, lat):
+        pt = geopandas.points_from_xy([x], [y])[0]
+        urbanPoints["distance"] = 999999999999
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            urbanPoints["distance"] = urbanPoints.geometry.distance(pt)
+        out.append(set(urbanPoints.nsmallest(k, "distance")["UID"]))
+    return out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=1000000)
+    parser.add_argument("--urban", type=int, default=20000)
+    parser.add_argument("--loop-sample", type=int, default=200)
+    parser.add_argument("-k", type=int, default=20)
+    args = parser.parse_args()
+
+    urbanPoints = synthetic_urban(args.urban)
+    lon, lat = synthetic_grid(args.origins)
+
+    start = time.perf_counter()
+    index = UrbanIndex(urbanPoints)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    positions, meters = index.query(lon, lat, args.k)
+    indexed = time.perf_counter() - start
+
+    sample = np.linspace(0, len(lon) - 1, args.loop_sample).astype(int)
+    start = time.perf_counter()
+    loopSets = loop_candidates(urbanPoints, lon[sample], lat[sample], args.k)
+    looped = time.perf_counter() - start
+    loopPerOrigin = looped / len(sample)
+
+    uids = urbanPoints["UID"].values
+    overlap = [len(loopSets[i] & set(uids[positions[s]])) / args.k for i, s in enumerate(sample)]
+
+    print("Origins: " + str(len(lon)) + ", urban centres: " + str(args.urban) + ", k: " + str(args.k))
+    print("KD-tree build: %.3f s" % build)
+    print("KD-tree query (all origins): %.3f s (%.0f origins/s)" % (indexed, len(lon) / indexed))
+    print("Full-table loop: %.4f s/origin, %.0f s extrapolated to all origins (%.0fx slower)"
+          % (loopPerOrigin, loopPerOrigin * len(lon), loopPerOrigin * len(lon) / indexed))
+    #The loop ranks by planar distance in degrees, the index by great-circle
+    #distance, so candidates at the edge of the top-k can differ.
+    print("Top-k set agreement on sample: mean %.4f, min %.4f" % (np.mean(overlap), np.min(overlap)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#Runs osm_data_processing (sourceData/retrieveData.py) on a local Dask cluster
+#against local file servers holding synthetic continent PBFs of different
+#sizes, plus one URL that does not exist.
+#
+#Usage: python benchmarks/continentFanout.py [--small 4] [--small-ways 2000] [--large-ways 40000]
+#
+#The memory settings are scaled so the large PBF reserves a whole worker and
+#the small ones a fraction of one.  Checks that every existing continent is
+#converted, that the missing one fails as a task state (and fails the flow),
+#that nothing else ran on the large conversion's worker while it did, and
+#that small conversions ran concurrently.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sourceData"))
+import retrieveData
+from downloadResume import FlakyFileServer
+from synthetic import synthetic_pbf
+
+def overlaps(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--small", type=int, default=4)
+    parser.add_argument("--small-ways", type=int, default=2000)
+    parser.add_argument("--large-ways", type=int, default=40000)
+    parser.add_argument("--hold", type=float, default=1.0, help="seconds each conversion is held open, so overlaps show")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    servers = []
+    try:
+        for name in ["OUTPUTPATH", "ORIGINALPATH", "LOGBASEPATH", "TMPBASEPATH"]:
+            path = os.path.join(workdir, name.lower())
+            os.makedirs(path)
+            setattr(retrieveData, name, path)
+        #pLogger's default log folder is bound when the module is imported.
+        logger = retrieveData.pLogger
+        retrieveData.pLogger = lambda id, type, message: logger(id, type, message, retrieveData.LOGBASEPATH)
+        urls = []
+        sizes = {}
+        for i, (continent, ways) in enumerate([("large", args.large_ways)] + [("small" + str(i), args.small_ways) for i in range(args.small)]):
+            served = os.path.join(workdir, "served", continent, continent + "-latest.osm.pbf")
+            os.makedirs(os.path.dirname(served))
+            synthetic_pbf(served, ways, seed=i)
+            sizes[continent] = os.path.getsize(served) / 1024 ** 3
+            server = FlakyFileServer(served, drop_every=0, drops=0)
+            servers.append(server)
+            urls.append(server.start())
+        #A continent the server doesn't have: its download fails.
+        urls.append(urls[-1].rsplit("/", 1)[0] + "/missing-latest.osm.pbf")
+
+        #Scale the memory settings to the synthetic sizes: the large PBF takes a whole worker.
+        retrieveData.WORKER_MEMORY_GB = 8
+        retrieveData.PBF_MEMORY_FACTOR = 8 / sizes["large"]
+        retrieveData.MIN_TASK_MEMORY_GB = 0.01
+        retrieveData.download_feature = retrieveData.download_feature.with_options(retries=0)
+        #Dask serializes the task (and this shim with it), so timings go to a file.
+        timings = os.path.join(workdir, "conversions.txt")
+        extract = retrieveData.extract_road_dataset
+        hold = args.hold
+
+        def timed_extract(pbfPath, datasetPath, *a, **kw):
+            from distributed import get_worker
+            begin = time.time()
+            roads = extract(pbfPath, datasetPath, *a, **kw)
+            time.sleep(hold)
+            with open(timings, "a") as f:
+                f.write("%s %f %f %s\n" % (os.path.basename(datasetPath).split(".")[0], begin, time.time(), get_worker().name))
+            return roads
+
+        retrieveData.extract_road_dataset = timed_extract
+        #Threaded workers, so the timing shim above is the one the tasks call.
+        runner = retrieveData.dask_runner(workers=2, threads=4, memoryGB=8, processes=False)
+        start = time.time()
+        state = retrieveData.osm_data_processing.with_options(task_runner=runner)(urls, return_state=True)
+        elapsed = time.time() - start
+        conversions = {}
+        if os.path.exists(timings):
+            with open(timings) as f:
+                for line in f:
+                    continent, begin, end, worker = line.split()
+                    conversions[continent] = (float(begin), float(end), worker)
+
+        failures = []
+        print("Flow %s in %.1f s" % (state.name, elapsed))
+        for continent, (begin, end, worker) in sorted(conversions.items()):
+            print("  %-8s converted on worker %s, %.1f-%.1f s" % (continent, worker, begin - start, end - start))
+        if not state.is_failed():
+            failures.append("the flow should fail when a continent fails, got " + state.name)
+        expected = {c for c in sizes}
+        if set(conversions) != expected:
+            failures.append("converted " + str(sorted(conversions)) + ", expected " + str(sorted(expected)))
+        for continent in expected:
+            if not os.path.isdir(os.path.join(retrieveData.OUTPUTPATH, continent + ".parquet")):
+                failures.append(continent + ": no road dataset written")
+        if "large" in conversions:
+            large = conversions["large"]
+            shared = [c for c, v in conversions.items() if c != "large" and v[2] == large[2] and overlaps(v, large)]
+            if shared:
+                failures.append("ran alongside the large conversion on its worker: " + ", ".join(shared))
+        small = [v for c, v in conversions.items() if c != "large"]
+        if args.small > 1 and not any(overlaps(a, b) for i, a in enumerate(small) for b in small[i + 1:]):
+            failures.append("no small conversions ran concurrently")
+        for f in failures:
+            print("FAIL: " + f)
+        print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(workdir)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
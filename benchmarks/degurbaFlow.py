@@ -0,0 +1,100 @@
+#Runs the degurbaRouting Prefect flow end to end on synthetic inputs: the fake
+#OSRM server for routing, SQLite in place of MariaDB, and Dask workers as
+#threads so both stand-ins are visible to them.
+#
+#Usage: python benchmarks/degurbaFlow.py [--origins 1000] [--batch-size 200] [--workers 2]
+#
+#Checks that every origin gets exactly one row, that a rerun is served from the
+#task cache without routing anything, and that adding origins only routes the
+#batches whose inputs changed.  Prefect runs against a throwaway local API.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp()
+os.environ["PREFECT_HOME"] = os.path.join(WORKDIR, "prefect")
+os.environ.setdefault("PREFECT_LOGGING_LEVEL", "WARNING")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import processDegurb
+import routingFlow
+from fakeOsrm import FakeOSRM
+from resultWrites import CREATE, SQLiteConnection
+from startupTime import synthetic_geojson
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=1000)
+    parser.add_argument("--added", type=int, default=150)
+    parser.add_argument("--urban", type=int, default=300)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    failures = []
+
+    def check(name, ok):
+        print(("ok   " if ok else "FAIL ") + name)
+        if not ok:
+            failures.append(name)
+
+    try:
+        database = os.path.join(WORKDIR, "roadresults.sqlite")
+        conn = SQLiteConnection(database)
+        with conn.cursor() as cursor:
+            cursor.execute(CREATE)
+        conn.commit()
+        routingFlow.connect = lambda: SQLiteConnection(database)
+
+        def rows():
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*), COUNT(DISTINCT urbanID) FROM roadresults")
+                return cursor.fetchall()[0]
+
+        processDegurb.URBAN_PATH = os.path.join(WORKDIR, "urban.geojson")
+        processDegurb.ORIGIN_PATH = os.path.join(WORKDIR, "origins.geojson")
+        processDegurb.PREPARED_PATH = os.path.join(WORKDIR, "prepared")
+        processDegurb.CACHE_PATH = os.path.join(WORKDIR, "routeCache.sqlite")
+        processDegurb.ROUTE_CACHE = False
+        synthetic_geojson(processDegurb.URBAN_PATH, args.urban, "UID", 3)
+        synthetic_geojson(processDegurb.ORIGIN_PATH, args.origins, "PID", 2)
+
+        with FakeOSRM(latency=0.005) as osrm:
+            processDegurb.OSRM_URL = osrm.url
+            stdout = sys.stdout
+
+            def run():
+                sys.stdout = open(os.devnull, "w")
+                try:
+                    return routingFlow.degurbaRouting(BATCH_SIZE=args.batch_size, WORKERS=args.workers,
+                                                      CONCURRENCY=8, PROCESSES=False)
+                finally:
+                    sys.stdout = stdout
+
+            run()
+            first = osrm.counts["table"]
+            count, distinct = rows()
+            check("first run writes one row per origin (%d rows, %d requests)" % (count, first),
+                  count == args.origins and distinct == args.origins)
+
+            run()
+            check("rerun is served from the task cache (%d new requests)" % (osrm.counts["table"] - first),
+                  osrm.counts["table"] == first and rows()[0] == args.origins)
+
+            os.remove(processDegurb.ORIGIN_PATH)
+            synthetic_geojson(processDegurb.ORIGIN_PATH, args.origins + args.added, "PID", 2)
+            before = osrm.counts["table"]
+            run()
+            count, distinct = rows()
+            check("added origins are routed (%d rows, %d new requests)" % (count, osrm.counts["table"] - before),
+                  count == args.origins + args.added and distinct == count)
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#Checks the streaming PBF downloader against a local HTTP server that serves a
+#large synthetic file, supports Range/If-Range, publishes a Geofabrik-style
+#.md5 sidecar, and drops the connection part-way through responses.
+#
+#Usage: python benchmarks/downloadResume.py [--size-mb 256] [--drop-every-mb 48]
+#
+#Reports wall time and peak RSS for the download; exits non-zero if any check fails.
+
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sourceData"))
+from pbfDownload import DownloadError, download, file_md5
+
+class FlakyFileServer:
+    #Serves one file at /<name> and /<name>.md5; responses are cut after drop_every
+    #bytes while drops_left > 0.
+    def __init__(self, path, drop_every, drops):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.drop_every = drop_every
+        self.drops_left = drops
+        self.md5_override = None
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.etag = '"' + str(stat.st_mtime_ns) + "-" + str(self.size) + '"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.md5 = file_md5(self.path)
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                with server.lock:
+                    server.requests = server.requests + 1
+                if self.path == "/" + server.name + ".md5":
+                    payload = ((server.md5_override or server.md5) + "  " + server.name + "\n").encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    if body:
+                        self.wfile.write(payload)
+                    return
+                if self.path != "/" + server.name:
+                    self.send_error(404)
+                    return
+                start = 0
+                rangeHeader = self.headers.get("Range")
+                ifRange = self.headers.get("If-Range")
+                if rangeHeader and (ifRange is None or ifRange in (server.etag, server.last_modified)):
+                    start = int(rangeHeader.split("=")[1].split("-")[0])
+                    if start >= server.size:
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, server.size - 1, server.size))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(server.size - start))
+                self.send_header("ETag", server.etag)
+                self.send_header("Last-Modified", server.last_modified)
+                self.end_headers()
+                if not body:
+                    return
+                with server.lock:
+                    drop = server.drops_left > 0
+                    if drop:
+                        server.drops_left = server.drops_left - 1
+                sent = 0
+                with open(server.path, "rb") as f:
+                    f.seek(start)
+                    while True:
+                        chunk = f.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        if drop and sent + len(chunk) > server.drop_every:
+                            self.wfile.write(chunk[:server.drop_every - sent])
+                            self.close_connection = True
+                            self.connection.shutdown(2)
+                            return
+                        self.wfile.write(chunk)
+                        sent = sent + len(chunk)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:" + str(self.server.server_address[1]) + "/" + self.name
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def write_random(path, size):
+    with open(path, "wb") as f:
+        for _ in range(size // (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--drop-every-mb", type=int, default=48)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    failures = []
+    try:
+        source = os.path.join(workdir, "served", "test-latest.osm.pbf")
+        os.makedirs(os.path.dirname(source))
+        write_random(source, args.size_mb * 1024 * 1024)
+        drops = args.size_mb // args.drop_every_mb
+        server = FlakyFileServer(source, args.drop_every_mb * 1024 * 1024, drops)
+        url = server.start()
+        target = os.path.join(workdir, "test-latest.osm.pbf")
+        quiet = lambda message: None
+
+        rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        downloaded = download(url, target, base_wait=0.01, retries=drops + 2, log=quiet)
+        elapsed = time.perf_counter() - start
+        rssAfter = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("Downloaded %d MB with %d dropped connections in %.2f s (%.0f MB/s)"
+              % (args.size_mb, drops, elapsed, args.size_mb / elapsed))
+        print("Peak RSS growth during download: %.1f MB" % ((rssAfter - rssBefore) / 1024.0))
+        if not downloaded or file_md5(target) != server.md5:
+            failures.append("interrupted download did not reproduce the source file")
+        if os.path.exists(target + ".part"):
+            failures.append("partial file left behind")
+
+        if download(url, target, log=quiet):
+            failures.append("unchanged file was downloaded again")
+
+        write_random(source, 8 * 1024 * 1024)
+        server.refresh()
+        if not download(url, target, base_wait=0.01, log=quiet) or file_md5(target) != server.md5:
+            failures.append("changed file on the server was not re-downloaded")
+
+        write_random(source, 4 * 1024 * 1024)
+        server.refresh()
+        server.md5_override = "0" * 32
+        try:
+            download(url, target, base_wait=0.01, log=quiet)
+            failures.append("checksum mismatch was not detected")
+        except DownloadError:
+            pass
+        server.stop()
+    finally:
+        shutil.rmtree(workdir)
+
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#In-process stand-in for osrm-routed, for exercising the routing client and
+#processPoints without a real OSRM deployment.
+#
+#Serves /route, /table and /nearest for the driving profile.  Every coordinate
+#snaps to the nearest node of a regular grid (SNAP_GRID degrees), so nearby
+#origins share snapped nodes as they do on sparse rural road networks.  With
+#`snap_edges` coordinates are instead projected onto the nearest of a set of
+#straight roads (slope ROAD_SLOPE, SNAP_GRID degrees apart, with a node every
+#SNAP_GRID degrees of longitude), as osrm-routed projects onto the nearest edge:
+#origins then only share a snapped location where they share a foot point.  Road
+#distance is the great-circle distance between snapped points times `detour`,
+#travelled at `speed_kmh`.  Latency is log-normal around `latency` seconds, and
+#`error_rate` of requests fail with a 503 as an overloaded or restarting pod would.
+#With `coverage` (xmin, ymin, xmax, ymax) the server stands in for a regional
+#shard, and counts["outside"] records coordinates it has no roads for.
+#While `down` is set every request gets a 503, as during a pod restart, and is
+#counted in counts["down"].
+#
+#    with FakeOSRM(latency=0.02, error_rate=0.05) as osrm:
+#        requests.get(osrm.url + "/route/v1/driving/85.3,27.7;85.4,27.6")
+
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SNAP_GRID = 0.005
+ROAD_SLOPE = 0.37
+EARTH_RADIUS = 6371008.8
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def snap(lon, lat):
+    #Returns (snapped location, snap distance in meters, node id).
+    i = round(lon / SNAP_GRID)
+    j = round(lat / SNAP_GRID)
+    location = [i * SNAP_GRID, j * SNAP_GRID]
+    return location, haversine(lon, lat, location[0], location[1]), i * 1000003 + j
+
+def snap_to_edge(lon, lat):
+    #Returns (location projected onto the nearest road, snap distance in meters,
+    #id of the road segment's first node).
+    k = round((lat - ROAD_SLOPE * lon) / SNAP_GRID)
+    offset = k * SNAP_GRID
+    x = (lon + ROAD_SLOPE * (lat - offset)) / (1 + ROAD_SLOPE ** 2)
+    location = [x, ROAD_SLOPE * x + offset]
+    return location, haversine(lon, lat, location[0], location[1]), k * 1000003 + math.floor(x / SNAP_GRID)
+
+class FakeOSRM:
+    def __init__(self, latency=0.01, latency_sigma=0.5, error_rate=0.0, unroutable=0.0,
+                 detour=1.3, speed_kmh=50, max_table_size=100, coverage=None, seed=0,
+                 snap_edges=False):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.unroutable = unroutable
+        self.detour = detour
+        self.speed_kmh = speed_kmh
+        self.max_table_size = max_table_size
+        self.coverage = coverage
+        self.snap = snap_to_edge if snap_edges else snap
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"route": 0, "table": 0, "nearest": 0, "errors": 0, "outside": 0, "down": 0}
+        self.down = False
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server.server_address[1])
+
+    def start(self, port=0):
+        osrm = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, body = osrm.handle(self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def handle(self, path):
+        with self.lock:
+            if self.down:
+                self.counts["down"] = self.counts["down"] + 1
+                return 503, {"code": "ServiceUnavailable"}
+            delay = self.latency * self.random.lognormvariate(0, self.latency_sigma) if self.latency else 0
+            fail = self.random.random() < self.error_rate
+        time.sleep(delay)
+
+        parsed = urlsplit(path)
+        parts = parsed.path.strip("/").split("/")
+        if len(parts) != 4 or parts[1] != "v1":
+            return 400, {"code": "InvalidUrl"}
+        service = parts[0]
+        if service not in ("route", "table", "nearest"):
+            return 400, {"code": "InvalidService"}
+        with self.lock:
+            self.counts[service] = self.counts[service] + 1
+            if fail:
+                self.counts["errors"] = self.counts["errors"] + 1
+        if fail:
+            return 503, {"code": "ServiceUnavailable"}
+
+        coords = [tuple(float(v) for v in c.split(",")) for c in parts[3].split(";")]
+        if self.coverage is not None:
+            xmin, ymin, xmax, ymax = self.coverage
+            outside = sum(not (xmin <= x <= xmax and ymin <= y <= ymax) for x, y in coords)
+            with self.lock:
+                self.counts["outside"] = self.counts["outside"] + outside
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        return getattr(self, service)(coords, params)
+
+    def _leg(self, a, b):
+        #Distance (m) and duration (s) between two snapped locations, or None if unroutable.
+        if self.unroutable and random.Random(hash((tuple(a), tuple(b)))).random() < self.unroutable:
+            return None
+        dist = haversine(a[0], a[1], b[0], b[1]) * self.detour
+        return dist, dist / (self.speed_kmh / 3.6)
+
+    def _waypoint(self, location, distance, node):
+        return {"location": location, "distance": distance, "name": "", "hint": str(node)}
+
+    def route(self, coords, params):
+        snapped = [self.snap(*c) for c in coords]
+        legs = []
+        for (a, _, _), (b, _, _) in zip(snapped, snapped[1:]):
+            leg = self._leg(a, b)
+            if leg is None:
+                return 400, {"code": "NoRoute", "message": "Impossible route between points"}
+            dist, dur = leg
+            legs.append({"distance": dist, "duration": dur, "weight": dur, "summary": "",
+                         "steps": [{"distance": dist / 2, "duration": dur / 2, "name": "", "maneuver": {"type": "depart"}},
+                                   {"distance": dist / 2, "duration": dur / 2, "name": "", "maneuver": {"type": "arrive"}}]})
+        return 200, {"code": "Ok",
+                     "routes": [{"distance": sum(l["distance"] for l in legs),
+                                 "duration": sum(l["duration"] for l in legs),
+                                 "weight": sum(l["weight"] for l in legs),
+                                 "weight_name": "routability", "legs": legs}],
+                     "waypoints": [self._waypoint(*s) for s in snapped]}
+
+    def table(self, coords, params):
+        snapped = [self.snap(*c) for c in coords]
+        sources = [int(i) for i in params["sources"].split(";")] if "sources" in params else list(range(len(coords)))
+        destinations = [int(i) for i in params["destinations"].split(";")] if "destinations" in params else list(range(len(coords)))
+        if len(sources) * len(destinations) > self.max_table_size ** 2:
+            return 400, {"code": "TooBig", "message": "Too many table coordinates"}
+        annotations = params.get("annotations", "duration").split(",")
+        distances = []
+        durations = []
+        for s in sources:
+            distRow = []
+            durRow = []
+            for d in destinations:
+                leg = self._leg(snapped[s][0], snapped[d][0])
+                distRow.append(None if leg is None else leg[0])
+                durRow.append(None if leg is None else leg[1])
+            distances.append(distRow)
+            durations.append(durRow)
+        body = {"code": "Ok",
+                "sources": [self._waypoint(*snapped[s]) for s in sources],
+                "destinations": [self._waypoint(*snapped[d]) for d in destinations]}
+        if "duration" in annotations:
+            body["durations"] = durations
+        if "distance" in annotations:
+            body["distances"] = distances
+        return 200, body
+
+    def nearest(self, coords, params):
+        location, distance, node = self.snap(*coords[0])
+        waypoint = self._waypoint(location, distance, node)
+        waypoint["nodes"] = [node, node + 1]
+        return 200, {"code": "Ok", "waypoints": [waypoint]}
@@ -0,0 +1,228 @@
+#Checks the multi-source road graph engine (roadGraph.py, processGraph)
+#against a brute-force search per urban area, runs processGraph end to end on
+#a road dataset converted from a synthetic PBF, and reports its throughput.
+#
+#Usage: python benchmarks/graphEngine.py [--side 300] [--origins 200000] [--urban 300] [--check-urban 40]
+#       python benchmarks/graphEngine.py --roads <road dataset> --origin-path sourceData/nepalDegurbaPoints.geojson \
+#                                        --urban-path sourceData/urbanCentroids.geojson --osrm-url http://osrm:80
+#
+#The synthetic network is a side x side grid of roads of random highway
+#classes with a share of the segments missing.  The brute-force reference runs
+#one Dijkstra search per urban area and takes the minimum for every node; the
+#engine must pick an equally near urban area with the same distance (weight
+#"distance") and travel time (weight "duration").  Urban areas outside the
+#roads' extent or far off them must not be routed to.  With --roads and
+#--osrm-url, processGraph is compared with processPoints on a real OSRM server
+#for the given inputs: how often both pick the same urban area, and the ratio
+#of their distances.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import geopandas
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+from roadGraph import HIGHWAY_SPEEDS, RoadGraph
+from routingClient import ListWriter, synthetic_points
+from synthetic import origin_grid, synthetic_pbf
+
+ROADRESULTS_COLUMNS = ["latitude", "longitude", "name", "total_population", "urbanID", "distance", "traveltime",
+                       "dest_latitude", "dest_longitude", "dest_ID"]
+
+def grid_roads(side, missing=0.1, seed=0, extent=(80, 26, 88, 30)):
+    #Roads along the rows and columns of a side x side grid over extent, each
+    #between 1 and 8 segments long, with `missing` of the segments left out.
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = extent
+    xs = np.linspace(xmin, xmax, side)
+    ys = np.linspace(ymin, ymax, side)
+    classes = list(HIGHWAY_SPEEDS)
+    lines = []
+    highways = []
+    for horizontal in (True, False):
+        for fixed in range(side):
+            i = 0
+            while i < side - 1:
+                length = min(int(rng.integers(1, 9)), side - 1 - i)
+                if rng.random() >= missing:
+                    steps = np.arange(i, i + length + 1)
+                    coords = np.column_stack((xs[steps], np.full(len(steps), ys[fixed]))) if horizontal \
+                        else np.column_stack((np.full(len(steps), xs[fixed]), ys[steps]))
+                    lines.append(shapely.LineString(coords))
+                    highways.append(classes[int(rng.integers(len(classes)))])
+                i = i + length
+    return geopandas.GeoDataFrame({"highway": highways}, geometry=lines, crs="EPSG:4326")
+
+def brute_force(graph, urbanNodes, startCost, weight):
+    #Nearest urban area and its cost for every node, one full search per urban area.
+    cost = graph.meters if weight == "distance" else graph.seconds
+    matrix = csr_matrix((cost + 1e-9, graph.indices, graph.indptr), shape=(len(graph), len(graph)))
+    best = np.full(len(graph), np.inf)
+    for i, node in enumerate(urbanNodes):
+        dist = dijkstra(matrix, indices=int(node)) + startCost[i]
+        best = np.minimum(best, dist)
+    return best
+
+def check_engine(args):
+    failures = []
+    roads = grid_roads(args.side)
+    start = time.perf_counter()
+    graph = RoadGraph.from_roads(roads)
+    built = time.perf_counter() - start
+    print("Graph: %d roads -> %d nodes, %d edges in %.2f s" % (len(roads), len(graph), graph.edge_count(), built))
+
+    urban = synthetic_points(args.check_urban, 3)
+    urbanNodes, urbanMeters = graph.snap(urban.geometry.x.values, urban.geometry.y.values)
+    urbanSeconds = processDegurb.offroad_seconds(urbanMeters)
+    for weight in ["distance", "duration"]:
+        source, meters, seconds = graph.nearest_sources(urbanNodes, urbanMeters, urbanSeconds, weight)
+        startCost = urbanMeters if weight == "distance" else urbanSeconds
+        expected = brute_force(graph, urbanNodes, startCost, weight)
+        found = meters if weight == "distance" else seconds
+        reached = np.isfinite(expected)
+        if not np.array_equal(reached, source >= 0):
+            failures.append(weight + ": %d nodes reached by brute force, %d by the engine" % (reached.sum(), (source >= 0).sum()))
+            continue
+        error = np.abs(found[reached] - expected[reached]) / np.maximum(expected[reached], 1)
+        print("  weight %-8s %d of %d nodes reached; max relative error %.2e" % (weight, reached.sum(), len(graph), error.max(initial=0)))
+        if error.max(initial=0) > 1e-6:
+            failures.append(weight + ": costs differ from brute force by up to %.2e" % error.max())
+    return failures
+
+def check_flow(args, workdir):
+    #processGraph end to end: synthetic PBF -> road dataset -> graph -> roadresults rows.
+    from roadExtract import extract_road_dataset
+    failures = []
+    pbf = os.path.join(workdir, "graph.osm.pbf")
+    synthetic_pbf(pbf, 20000)
+    extract_road_dataset(pbf, os.path.join(workdir, "roads"), log=lambda message: None)
+    pts = origin_grid(2000, extent=(60, 5, 60.25, 5.25))
+    urbanPoints = synthetic_points(50, 3)
+    urbanPoints["geometry"] = geopandas.points_from_xy(np.random.default_rng(3).uniform(60, 60.25, 50),
+                                                       np.random.default_rng(4).uniform(5, 5.25, 50))
+    writer = ListWriter()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        graph = processDegurb.load_road_graph(pts, os.path.join(workdir, "roads"))
+        processed = processDegurb.processGraph(pts, writer, urbanPoints, graph)
+    finally:
+        sys.stdout = stdout
+    pids = [r["urbanID"] for r in writer.rows]
+    #synthetic_pbf ways are short disconnected chains, so most origins have no urban area on their road piece.
+    print("End to end: %d origins on a %d node graph from a PBF, %d reach an urban area" % (processed, len(graph), len(pids)))
+    if processed != len(pts) or len(pids) != len(set(pids)):
+        failures.append("expected %d origins processed once, got %d processed and %d rows" % (len(pts), processed, len(pids)))
+    if any(r["distance"] <= 0 or r["traveltime"] <= 0 for r in writer.rows):
+        failures.append("rows with a non-positive distance or travel time")
+    if writer.rows and set(writer.rows[0]) != set(ROADRESULTS_COLUMNS):
+        failures.append("columns differ from the roadresults schema")
+    return failures
+
+def check_extent():
+    #Two separate road pieces near 27N.  The first piece's urban area is on it;
+    #the only one for the second is far south (outside the roads' extent) and
+    #another is inside the extent but ~40 km from any road.  Origins on the
+    #second piece must get no result rather than a long off-road "route".
+    roads = geopandas.GeoDataFrame({"highway": ["primary", "primary"]},
+                                   geometry=[shapely.LineString([(84.0, 27.0), (84.05, 27.0), (84.1, 27.0)]),
+                                             shapely.LineString([(85.0, 27.1), (85.05, 27.1), (85.1, 27.1)])],
+                                   crs="EPSG:4326")
+    urbanPoints = synthetic_points(3, 0)
+    urbanPoints["geometry"] = geopandas.points_from_xy([84.05, 85.05, 84.5], [27.0, 5.0, 27.05])
+    pts = synthetic_points(4, 1)
+    pts["geometry"] = geopandas.points_from_xy([84.01, 84.09, 85.01, 85.09], [27.0, 27.0, 27.1, 27.1])
+    writer = ListWriter()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        processDegurb.processGraph(pts, writer, urbanPoints, RoadGraph.from_roads(roads))
+    finally:
+        sys.stdout = stdout
+    found = sorted((r["urbanID"], r["dest_ID"]) for r in writer.rows)
+    print("Extent: %d of 4 origins routed (expected the 2 on the first road piece)" % len(found))
+    if found != [(0, 0), (1, 0)]:
+        return ["urban areas outside the roads or far off them were routed to: " + str(found)]
+    return []
+
+def throughput(args):
+    roads = grid_roads(args.side)
+    pts = origin_grid(args.origins)
+    urbanPoints = synthetic_points(args.urban, 3)
+    writer = ListWriter()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        graph = RoadGraph.from_roads(roads)
+        built = time.perf_counter()
+        processed = processDegurb.processGraph(pts, writer, urbanPoints, graph)
+        elapsed = time.perf_counter() - built
+    finally:
+        sys.stdout = stdout
+    print("Throughput: %d origins, %d urban areas, %d nodes: graph built in %.2f s, searched and written in %.2f s (%.0f origins/s)"
+          % (processed, args.urban, len(graph), built - start, elapsed, processed / elapsed))
+
+def compare_osrm(args):
+    #processGraph against processPoints on a real OSRM server, for real inputs.
+    processDegurb.ORIGIN_PATH = args.origin_path
+    processDegurb.URBAN_PATH = args.urban_path
+    processDegurb.PREPARED_PATH = tempfile.mkdtemp()
+    processDegurb.OSRM_URL = args.osrm_url
+    processDegurb.ROUTE_CACHE = False
+    urbanPoints = processDegurb.load_urban_points()
+    pts = processDegurb.load_origin_points().head(args.origins)
+    graphWriter = ListWriter()
+    osrmWriter = ListWriter()
+    start = time.perf_counter()
+    processDegurb.processGraph(pts, graphWriter, urbanPoints, processDegurb.load_road_graph(pts, args.roads))
+    graphTime = time.perf_counter() - start
+    start = time.perf_counter()
+    processDegurb.processPoints(pts, osrmWriter, urbanPoints)
+    osrmTime = time.perf_counter() - start
+    graph = {r["urbanID"]: r for r in graphWriter.rows}
+    osrm = {r["urbanID"]: r for r in osrmWriter.rows}
+    both = [pid for pid in osrm if pid in graph]
+    same = sum(graph[pid]["dest_ID"] == osrm[pid]["dest_ID"] for pid in both)
+    ratio = np.array([graph[pid]["distance"] / osrm[pid]["distance"] for pid in both])
+    print("OSRM: %d origins in %.1f s; graph: %d origins in %.1f s" % (len(osrm), osrmTime, len(graph), graphTime))
+    print("Same urban area for %d of %d origins (%.1f%%); graph/OSRM distance median %.3f, 5-95%% %.3f-%.3f"
+          % (same, len(both), 100.0 * same / max(len(both), 1), np.median(ratio), np.percentile(ratio, 5), np.percentile(ratio, 95)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--side", type=int, default=300)
+    parser.add_argument("--origins", type=int, default=200000)
+    parser.add_argument("--urban", type=int, default=300)
+    parser.add_argument("--check-urban", type=int, default=40)
+    parser.add_argument("--roads")
+    parser.add_argument("--origin-path")
+    parser.add_argument("--urban-path")
+    parser.add_argument("--osrm-url")
+    args = parser.parse_args()
+
+    if args.roads and args.osrm_url:
+        compare_osrm(args)
+        return
+    workdir = tempfile.mkdtemp()
+    try:
+        failures = check_engine(args) + check_flow(args, workdir) + check_extent()
+    finally:
+        shutil.rmtree(workdir)
+    throughput(args)
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
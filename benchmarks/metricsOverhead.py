@@ -0,0 +1,125 @@
+#Runs processPoints on the fake OSRM server with routingMetrics disabled and
+#enabled, and checks what the instrumentation reports.
+#
+#Usage: python benchmarks/metricsOverhead.py [--origins 1000] [--error-rate 0.02] [--unroutable 0.05]
+#
+#Checks that the results are identical either way, that the counters agree
+#with what the fake server did (origins, retries, unroutable pairs), and that
+#the Prometheus endpoint and JSON summary carry every stage.  Reports the
+#run time of both modes and the cost of one disabled timer/counter call.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+import routingMetrics
+from fakeOsrm import FakeOSRM
+from routingClient import ListWriter, synthetic_points
+
+STAGES = ["candidates", "routing", "osrm_request", "backoff", "assembly", "write"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=1000)
+    parser.add_argument("--urban", type=int, default=2000)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--unroutable", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    failures = []
+
+    def check(name, ok):
+        print(("ok   " if ok else "FAIL ") + name)
+        if not ok:
+            failures.append(name)
+
+    #No-op cost of the disabled instrumentation, per call.
+    null = routingMetrics.NullMetrics()
+    calls = 1000000
+    start = time.perf_counter()
+    for i in range(calls):
+        pass
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(calls):
+        with null.timer("osrm_request"):
+            pass
+        null.inc("retries")
+    perCall = (time.perf_counter() - start - loop) / calls
+    print("Disabled timer + counter: %.0f ns per call" % (perCall * 1e9))
+
+    urbanPoints = synthetic_points(args.urban, 3)
+    pts = synthetic_points(args.origins, 2)
+    processDegurb.ROUTE_CACHE = False
+    processDegurb.RESPONSEWAIT = 0.01
+
+    def run(osrm):
+        processDegurb.OSRM_URL = osrm.url
+        writer = ListWriter()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.perf_counter()
+            processDegurb.processPoints(pts, writer, urbanPoints)
+            elapsed = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+        return writer.rows, elapsed
+
+    def best_run():
+        best = None
+        for i in range(args.repeat):
+            with FakeOSRM(latency=0, error_rate=args.error_rate, unroutable=args.unroutable, seed=i) as osrm:
+                rows, elapsed = run(osrm)
+            if best is None or elapsed < best[1]:
+                best = (rows, elapsed, osrm)
+        return best
+
+    disabledRows, disabledTime, osrm = best_run()
+    workdir = tempfile.mkdtemp()
+    summaryPath = os.path.join(workdir, "metrics.json")
+    metrics = routingMetrics.enable(summaryPath=summaryPath, interval=3600)
+    server = metrics.serve(0, host="127.0.0.1")
+    #One run for the counters, on a fresh Metrics, then the timed runs.
+    with FakeOSRM(latency=0, error_rate=args.error_rate, unroutable=args.unroutable, seed=0) as osrm:
+        enabledRows, elapsed = run(osrm)
+    counters = dict(metrics.counters)
+    stages = {s: h[1] for s, h in metrics.stages.items()}
+    enabledTime = min(elapsed, best_run()[1])
+    print("processPoints, %d origins: disabled %.2f s, enabled %.2f s (%+.1f%%)"
+          % (args.origins, disabledTime, enabledTime, 100 * (enabledTime / disabledTime - 1)))
+
+    key = lambda r: r["urbanID"]
+    check("same results with metrics enabled", sorted(disabledRows, key=key) == sorted(enabledRows, key=key))
+    check("origins counted (%d)" % counters.get("origins", 0), counters.get("origins") == args.origins)
+    check("retries counted (%d, %d server errors)" % (counters.get("retries", 0), osrm.counts["errors"]),
+          counters.get("retries", 0) == osrm.counts["errors"] and osrm.counts["errors"] > 0)
+    check("requests timed (%d, %d served)" % (stages.get("osrm_request", 0), osrm.counts["table"]),
+          stages.get("osrm_request") == osrm.counts["table"])
+    check("unroutable pairs counted (%d)" % counters.get("unroutable_pairs", 0),
+          counters.get("unroutable_pairs", 0) > 0 or args.unroutable == 0)
+    check("failed origins counted (%d)" % counters.get("failed_origins", 0),
+          counters.get("failed_origins", 0) == args.origins - len(enabledRows))
+
+    text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1]).read().decode()
+    check("Prometheus endpoint has every stage",
+          all('globalroads_stage_seconds_count{stage="%s"}' % s in text for s in STAGES)
+          and "globalroads_origins_total" in text)
+    metrics.write_summary(summaryPath)
+    with open(summaryPath) as f:
+        summary = json.load(f)
+    check("JSON summary has every stage and a throughput figure",
+          all(s in summary["stages"] for s in STAGES) and summary["origins_per_second"] > 0)
+    server.shutdown()
+    print(json.dumps({s: summary["stages"][s] for s in STAGES}, indent=1))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#Compares reading origins with OriginSource (chunked reads, vectorized
+#reprojection, lightweight rows) against the old path (whole file into a
+#GeoDataFrame, to_crs, iterrows) on synthetic Mollweide origin grids.
+#
+#Usage: python benchmarks/originStream.py [--sizes 250000,1000000,2000000] [--chunk-rows 100000] [--formats parquet,gpkg]
+#
+#Each read runs in a fresh subprocess, so its peak RSS is its own (Linux).  Reports
+#rows/s and peak RSS per size; checks that both paths yield the same origins
+#and that the streaming path's peak RSS grows by less than --rss-growth MB
+#between the two largest sizes (the old path grows with the grid; the
+#streaming one levels off once Arrow's memory pool has warmed up, after a few
+#chunks).
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def peak_rss_mb():
+    #VmHWM rather than ru_maxrss, which Linux carries over from the parent
+    #across exec (and the parent here has just built the grid).
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def write_grid(path, n, seed=0):
+    #n origins over Nepal, stored in Mollweide as the degurba grid is.
+    import geopandas
+    from preparedInputs import MOLLWEIDE
+    rng = np.random.default_rng(seed)
+    pts = geopandas.GeoDataFrame({"PID": np.arange(n, dtype=np.int64)},
+                                 geometry=geopandas.points_from_xy(rng.uniform(80, 88, n), rng.uniform(26, 30, n)),
+                                 crs="EPSG:4326").to_crs(MOLLWEIDE)
+    if path.endswith(".parquet"):
+        pts.to_parquet(path, row_group_size=100000)
+    else:
+        pts.to_file(path, engine="pyogrio")
+
+def run_old(args):
+    import geopandas
+    from preparedInputs import MOLLWEIDE
+    start = time.perf_counter()
+    if args.path.endswith(".parquet"):
+        pts = geopandas.read_parquet(args.path)
+    else:
+        pts = geopandas.read_file(args.path, engine="pyogrio")
+    pts = pts.set_crs(MOLLWEIDE, allow_override=True).to_crs(epsg=4326)
+    count = 0
+    checksum = 0.0
+    for index, row in pts.iterrows():
+        count = count + 1
+        checksum = checksum + row.geometry.x + row.geometry.y + row["PID"]
+    print(json.dumps({"rows": count, "seconds": time.perf_counter() - start, "checksum": checksum, "peak_rss_mb": peak_rss_mb()}))
+
+def run_stream(args):
+    from originSource import OriginSource, origin_rows
+    from preparedInputs import MOLLWEIDE
+    start = time.perf_counter()
+    count = 0
+    checksum = 0.0
+    for lon, lat, pids in OriginSource(args.path, crs=MOLLWEIDE, chunk_rows=args.chunk_rows).chunks():
+        for row in origin_rows(lon, lat, pids):
+            count = count + 1
+            checksum = checksum + row.geometry.x + row.geometry.y + row["PID"]
+    print(json.dumps({"rows": count, "seconds": time.perf_counter() - start, "checksum": checksum, "peak_rss_mb": peak_rss_mb()}))
+
+def child(mode, path, chunkRows):
+    command = [sys.executable, os.path.abspath(__file__), "--run", mode, "--path", path, "--chunk-rows", str(chunkRows)]
+    out = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True, cwd=ROOT).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="250000,1000000,2000000")
+    parser.add_argument("--chunk-rows", type=int, default=100000)
+    parser.add_argument("--formats", default="parquet,gpkg")
+    parser.add_argument("--rss-growth", type=float, default=100)
+    parser.add_argument("--run", choices=["old", "stream"], help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        (run_old if args.run == "old" else run_stream)(args)
+        return
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    failures = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for fmt in args.formats.split(","):
+            streamRss = []
+            for n in sizes:
+                path = os.path.join(workdir, "origins-" + str(n) + "." + fmt)
+                write_grid(path, n)
+                old = child("old", path, args.chunk_rows)
+                new = child("stream", path, args.chunk_rows)
+                print("%-7s %9d origins   iterrows %9.0f rows/s %7.0f MB   stream %9.0f rows/s %7.0f MB"
+                      % (fmt, n, old["rows"] / old["seconds"], old["peak_rss_mb"], new["rows"] / new["seconds"], new["peak_rss_mb"]))
+                if old["rows"] != n or new["rows"] != n:
+                    failures.append("%s, %d origins: read %d (iterrows) and %d (stream)" % (fmt, n, old["rows"], new["rows"]))
+                if abs(old["checksum"] - new["checksum"]) > 1e-6 * abs(old["checksum"]):
+                    failures.append("%s, %d origins: coordinates or PIDs differ" % (fmt, n))
+                streamRss.append(new["peak_rss_mb"])
+                os.remove(path)
+            if len(streamRss) > 1 and streamRss[-1] - streamRss[-2] > args.rss_growth:
+                failures.append("%s: streaming peak RSS grew from %.0f MB to %.0f MB" % (fmt, streamRss[-2], streamRss[-1]))
+    finally:
+        shutil.rmtree(workdir)
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
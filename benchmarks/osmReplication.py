@@ -0,0 +1,139 @@
+#Checks incremental extract updates against a local replication server: a small
+#synthetic PBF at a known sequence number, plus .osc.gz diffs and a state.txt
+#laid out the way Geofabrik's <continent>-updates/ directories are.
+#
+#Usage: python benchmarks/osmReplication.py
+#
+#Needs the osmium command line tool (osmium-tool) on PATH, as the pipeline does.
+#Exits non-zero if any check fails.
+
+import functools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import osmium
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sourceData"))
+from osmUpdates import header_option, sequence_path, update_extract
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+BASE_SEQUENCE = 100
+NODES = 200
+
+def write_osm(path, nodes=(), ways=(), sequence=None):
+    header = osmium.io.Header()
+    if sequence is not None:
+        header.set("osmosis_replication_sequence_number", str(sequence))
+    with osmium.SimpleWriter(path, header=header) as writer:
+        for node in nodes:
+            writer.add_node(node)
+        for way in ways:
+            writer.add_way(way)
+
+def node(id, x, y, version=1, visible=True):
+    return osmium.osm.mutable.Node(id=id, location=(x, y), version=version, visible=visible)
+
+def way(id, nodes, version=1, visible=True, tags=None):
+    return osmium.osm.mutable.Way(id=id, nodes=nodes, version=version, visible=visible, tags=tags or {})
+
+def write_replication(root, diffs, state):
+    #diffs: {sequence: (nodes, ways)}
+    for sequence, (nodes, ways) in diffs.items():
+        path = os.path.join(root, sequence_path(sequence) + ".osc.gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        write_osm(path, nodes, ways)
+    with open(os.path.join(root, "state.txt"), "w") as f:
+        f.write("#Sat Jan 01 00:00:00 UTC 2000\nsequenceNumber=" + str(state) + "\ntimestamp=2000-01-01T00\\:00\\:00Z\n")
+
+def read_osm(path):
+    nodes = {}
+    ways = {}
+    for obj in osmium.FileProcessor(path):
+        if obj.is_node():
+            nodes[obj.id] = (round(obj.location.lon, 6), round(obj.location.lat, 6))
+        elif obj.is_way():
+            ways[obj.id] = [n.ref for n in obj.nodes]
+    return nodes, ways
+
+def base_extract(path):
+    nodes = [node(n, 80 + n * 1e-3, 20) for n in range(1, NODES + 1)]
+    ways = [way(w, [w, w + 1], tags={"highway": "residential"}) for w in range(1, NODES)]
+    write_osm(path, nodes, ways, BASE_SEQUENCE)
+
+def main():
+    if shutil.which("osmium") is None:
+        print("osmium (osmium-tool) not found on PATH.")
+        sys.exit(2)
+    workdir = tempfile.mkdtemp()
+    root = os.path.join(workdir, "asia-updates")
+    os.makedirs(root)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=workdir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseUrl = "http://127.0.0.1:" + str(server.server_address[1]) + "/asia-updates"
+    quiet = lambda message: None
+    failures = []
+
+    def check(name, ok):
+        print(("ok   " if ok else "FAIL ") + name)
+        if not ok:
+            failures.append(name)
+
+    try:
+        pbf = os.path.join(workdir, "asia-latest.osm.pbf")
+        base_extract(pbf)
+        write_replication(root, {
+            101: ([node(1, 81.5, 21.5, version=2), node(NODES + 1, 90, 30)], []),
+            102: ([], [way(1, [1, 2], version=2, visible=False), way(NODES, [NODES, NODES + 1])]),
+        }, 102)
+
+        #A copy stands in for the global PBF, which takes in the kept diffs as buildGlobalPBF does.
+        globalPbf = os.path.join(workdir, "global.osm.pbf")
+        shutil.copy(pbf, globalPbf)
+        pending = os.path.join(workdir, "pending")
+        check("applies the diff chain", update_extract(pbf, baseUrl, os.path.join(workdir, "diffs"), log=quiet, keep=pending))
+        kept = sorted(os.path.join(pending, name) for name in os.listdir(pending)) if os.path.isdir(pending) else []
+        check("applied diffs kept", [os.path.basename(p) for p in kept] == ["101.osc.gz", "102.osc.gz"])
+        subprocess.run(["osmium", "apply-changes", globalPbf] + kept + ["--overwrite", "-o", globalPbf + ".updated.osm.pbf"],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        check("kept diffs bring a copy up to date", read_osm(globalPbf + ".updated.osm.pbf") == read_osm(pbf))
+        nodes, ways = read_osm(pbf)
+        check("modified node moved", nodes.get(1) == (81.5, 21.5))
+        check("created node added", NODES + 1 in nodes)
+        check("deleted way removed", 1 not in ways)
+        check("created way added", ways.get(NODES) == [NODES, NODES + 1])
+        check("untouched objects kept", len(nodes) == NODES + 1 and len(ways) == NODES - 1)
+        check("header sequence advanced", header_option(pbf, "osmosis_replication_sequence_number") == "102")
+        check("diff workdir cleaned up", not os.path.exists(os.path.join(workdir, "diffs")))
+
+        check("no-op when current", update_extract(pbf, baseUrl, os.path.join(workdir, "diffs"), log=quiet))
+
+        #103 is missing on the server: the chain is broken, so a full download is needed.
+        write_replication(root, {104: ([node(2, 0, 0, version=2)], [])}, 104)
+        before = read_osm(pbf)
+        check("broken chain falls back", not update_extract(pbf, baseUrl, os.path.join(workdir, "diffs"), log=quiet))
+        check("broken chain leaves extract untouched", read_osm(pbf) == before)
+
+        write_replication(root, {103: ([], [])}, 104)
+        check("too far behind falls back",
+              not update_extract(pbf, baseUrl, os.path.join(workdir, "diffs"), max_diffs=1, log=quiet))
+
+        plain = os.path.join(workdir, "plain.osm.pbf")
+        write_osm(plain, [node(1, 0, 0)])
+        check("no sequence number falls back", not update_extract(plain, baseUrl, os.path.join(workdir, "diffs"), log=quiet))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
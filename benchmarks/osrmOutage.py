@@ -0,0 +1,123 @@
+#Runs processPoints through OSRM outages: the fake OSRM server answers every
+#request with a 503 for each of --outage-seconds in turn, starting
+#--outage-start seconds into the run, as while an osrm pod restarts.  The
+#default outages are a short one and one longer than REQUEST_DEADLINE, which
+#every request gives up on and only the retry passes get through.
+#
+#Usage: python benchmarks/osrmOutage.py [--origins 5000] [--outage-start 1] [--outage-seconds 8 45] [--concurrency 32]
+#
+#Uses the production retry settings (RETRIES, RESPONSEWAIT, REQUEST_DEADLINE,
+#the osrmHealth breaker).  First checks that a request whose backoff runs
+#into its deadline (against a closed port) leaves the breaker able to probe
+#again, with osm_request and AsyncRoutingClient.  Then checks that every
+#origin is still written exactly once with the same result as a run without
+#the outage (floats to within rounding, as retried origins are routed in
+#different blocks), and reports how many requests hit the server while it
+#was down and how much longer the run took.
+
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import osrmHealth
+import processDegurb
+from asyncRouting import AsyncRoutingClient
+from fakeOsrm import FakeOSRM
+from routingClient import ListWriter, synthetic_points
+from synthetic import origin_grid
+
+def probe_recovers(host, request):
+    #Breaker that opens on one failure for 0.1 s; each request backs off far
+    #past its 0.5 s deadline, so the wait is cut short by the deadline.
+    url = "http://" + host + ":9/route/v1/driving/80,26;81,27"
+    breaker = osrmHealth.breaker_for(url)
+    breaker.failure_threshold = 1
+    breaker.reset_seconds = breaker.reset = breaker.max_reset_seconds = 0.1
+    for i in range(3):
+        request(url)
+        time.sleep(0.2)
+    time.sleep(breaker.retry_after())
+    recovered = breaker.allow()
+    breaker.release()
+    return recovered
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=5000)
+    parser.add_argument("--urban", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--outage-start", type=float, default=1)
+    parser.add_argument("--outage-seconds", type=float, nargs="+",
+                        default=[8, processDegurb.REQUEST_DEADLINE + 15])
+    parser.add_argument("--concurrency", type=int, default=processDegurb.ROUTING_CONCURRENCY)
+    args = parser.parse_args()
+
+    failures = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        with AsyncRoutingClient(1, 5, 100, deadline=0.5) as client:
+            recovered = {"osm_request": probe_recovers("127.0.0.1", lambda url: processDegurb.osm_request(url, 5, base_wait=100, deadline=0.5)),
+                         "AsyncRoutingClient": probe_recovers("localhost", lambda url: client.get_many([url]))}
+    finally:
+        sys.stdout = stdout
+    for name, ok in recovered.items():
+        if not ok:
+            failures.append(name + ": the breaker never lets a probe through after a request ran out of time")
+
+    urbanPoints = synthetic_points(args.urban, 3)
+    pts = origin_grid(args.origins)
+    processDegurb.ROUTE_CACHE = False
+    processDegurb.ROUTING_CONCURRENCY = args.concurrency
+
+    def run(outage_seconds):
+        writer = ListWriter()
+        with FakeOSRM(latency=args.latency) as osrm:
+            processDegurb.OSRM_URL = osrm.url
+
+            def roll():
+                time.sleep(args.outage_start)
+                osrm.down = True
+                time.sleep(outage_seconds)
+                osrm.down = False
+
+            if outage_seconds:
+                threading.Thread(target=roll, daemon=True).start()
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                start = time.perf_counter()
+                processDegurb.processPoints(pts, writer, urbanPoints)
+                elapsed = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+            return writer.rows, elapsed, dict(osrm.counts)
+
+    def same(a, b):
+        return a.keys() == b.keys() and all(math.isclose(a[k], b[k], rel_tol=1e-9) if isinstance(a[k], float) else a[k] == b[k]
+                                            for k in a)
+
+    baseRows, baseTime, baseCounts = run(0)
+    print("Without outage: %d origins in %.1f s, %d requests" % (len(baseRows), baseTime, baseCounts["table"] + baseCounts["route"]))
+    base = {r["urbanID"]: r for r in baseRows}
+    for outage in args.outage_seconds:
+        rows, elapsed, counts = run(outage)
+        print("With a %.0f s outage: %d origins in %.1f s (+%.1f s), %d requests, %d of them while down"
+              % (outage, len(rows), elapsed, elapsed - baseTime, counts["table"] + counts["route"] + counts["down"], counts["down"]))
+        pids = [r["urbanID"] for r in rows]
+        if len(pids) != len(set(pids)) or len(pids) != args.origins:
+            failures.append("%.0f s outage: expected each of %d origins once, got %d rows for %d origins"
+                            % (outage, args.origins, len(pids), len(set(pids))))
+        elif set(pids) != set(base) or not all(same(r, base[r["urbanID"]]) for r in rows):
+            failures.append("%.0f s outage: results differ from the run without an outage" % outage)
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#Checks the checksum-keyed OSRM build cache on a tiny synthetic PBF.
+#
+#Usage: python benchmarks/osrmPreprocess.py [--bindir /path/to/osrm-backend/bin --profile /path/to/car.lua]
+#
+#Without --bindir, stub osrm-extract/-partition/-customize scripts that write
+#the files the real tools would (and log each call) stand in for osrm-backend.
+#Exits non-zero if any check fails.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from osrmBuild import build_osrm, osrm_base
+from synthetic import synthetic_pbf
+
+STUB = """#!/bin/sh
+echo "$(basename "$0") $@" >> "%(calls)s"
+for last; do :; done
+case "$(basename "$0")" in
+  osrm-extract) base="${last%%.osm.pbf}.osrm"; touch "$base" "$base.ebg" "$base.nbg_nodes" ;;
+  osrm-partition) touch "$last.partition" "$last.cells" ;;
+  osrm-customize) touch "$last.cell_metrics" "$last.mldgr" ;;
+esac
+"""
+
+def write_stubs(bindir, calls):
+    os.makedirs(bindir)
+    for tool in ("osrm-extract", "osrm-partition", "osrm-customize"):
+        path = os.path.join(bindir, tool)
+        with open(path, "w") as f:
+            f.write(STUB % {"calls": calls})
+        os.chmod(path, 0o755)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bindir", default=None)
+    parser.add_argument("--profile", default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    calls = os.path.join(workdir, "calls.log")
+    quiet = lambda message: None
+    failures = []
+
+    def check(name, ok):
+        print(("ok   " if ok else "FAIL ") + name)
+        if not ok:
+            failures.append(name)
+
+    def tools_run():
+        if not os.path.exists(calls):
+            return []
+        with open(calls) as f:
+            tools = [line.split()[0] for line in f if line.strip()]
+        os.remove(calls)
+        return tools
+
+    try:
+        bindir = args.bindir
+        if bindir is None:
+            bindir = os.path.join(workdir, "bin")
+            write_stubs(bindir, calls)
+        profile = args.profile
+        if profile is None:
+            profile = os.path.join(workdir, "car.lua")
+            with open(profile, "w") as f:
+                f.write("-- stand-in profile\n")
+        pbf = os.path.join(workdir, "region-latest.osm.pbf")
+        synthetic_pbf(pbf, 200)
+        speeds = os.path.join(workdir, "speeds.csv")
+        with open(speeds, "w") as f:
+            f.write("1,2,30\n")
+
+        def build(speedFiles=()):
+            return build_osrm(pbf, profile, speedFiles, threads=2, bindir=bindir, log=quiet)
+
+        check("first build runs everything", build() == "FULL")
+        if args.bindir is None:
+            check("  extract, partition, customize", tools_run() == ["osrm-extract", "osrm-partition", "osrm-customize"])
+        check("unchanged inputs are skipped", build() == "SKIP")
+        if args.bindir is None:
+            check("  no tools run", tools_run() == [])
+
+        os.utime(pbf)
+        check("touched but identical PBF is skipped", build() == "SKIP")
+
+        check("new speed file only re-customizes", build([speeds]) == "CUSTOMIZE")
+        if args.bindir is None:
+            check("  customize with the speed file", tools_run() == ["osrm-customize"])
+        with open(speeds, "a") as f:
+            f.write("2,3,40\n")
+        check("changed speed file only re-customizes", build([speeds]) == "CUSTOMIZE")
+
+        with open(profile, "a") as f:
+            f.write("-- edited\n")
+        check("changed profile rebuilds", build([speeds]) == "FULL")
+
+        os.remove(pbf)
+        synthetic_pbf(pbf, 200, seed=1)
+        check("changed PBF rebuilds", build([speeds]) == "FULL")
+
+        os.remove(osrm_base(pbf) + ".partition")
+        check("missing outputs rebuild", build([speeds]) == "FULL")
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
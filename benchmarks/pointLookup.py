@@ -0,0 +1,187 @@
+#Checks the point-query index (pointQuery.py) against a brute-force nearest
+#origin search and reports its lookup latency and throughput.
+#
+#Usage: python benchmarks/pointLookup.py [--spacing 0.01] [--queries 50000] [--batch 10000]
+#
+#Results for a jittered origin grid over Nepal (--spacing degrees, about 1 km
+#by default) go through the Parquet result sink and compaction, and the index
+#is built from the compacted dataset.  Random query points, some on tile
+#edges and some off the grid, must get the nearest origin within
+#MAX_METERS, as a KD-tree over every origin finds it, from both query_batch
+#and the single-point query.  A second index built
+#from a SQLite roadresults table with rewritten rows must keep the latest
+#row per origin.  Then reports single-point latency (cold and with the tiles
+#cached) and batch throughput, and checks the HTTP endpoints.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquetResults import ParquetResultWriter, compact_results
+from pointQuery import MAX_METERS, PointIndex, build_index, dataset_batches, serve, sql_batches
+from resultWrites import CREATE, SQLiteConnection
+from resultWriter import COLUMNS
+from urbanIndex import chord_to_meters, unit_vectors
+
+EXTENT = (80, 26, 88, 30)
+
+def origin_results(spacing, seed=0):
+    #roadresults columns for a jittered grid, with travel times that vary smoothly.
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = EXTENT
+    gx, gy = np.meshgrid(np.arange(xmin, xmax, spacing), np.arange(ymin, ymax, spacing))
+    n = gx.size
+    lon = gx.ravel() + rng.uniform(0, spacing / 4, n)
+    lat = gy.ravel() + rng.uniform(0, spacing / 4, n)
+    pids = np.arange(n, dtype=np.int64)
+    dest = (pids % 300).astype(np.int64)
+    return {"latitude": lon, "longitude": lat, "name": np.array(["Urban " + str(d) for d in dest]),
+            "total_population": 10000.0 + dest, "urbanID": pids, "distance": 1000.0 + (lon - xmin) * 1000,
+            "traveltime": 60.0 + (lat - ymin) * 100, "dest_latitude": 80 + dest / 100.0,
+            "dest_longitude": 26 + dest / 100.0, "dest_ID": dest}
+
+def query_points(n, seed=1):
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = EXTENT
+    lon = rng.uniform(xmin - 0.05, xmax + 0.05, n)
+    lat = rng.uniform(ymin - 0.05, ymax + 0.05, n)
+    #A quarter right on tile edges.
+    edge = rng.random(n) < 0.25
+    lon[edge] = np.round(lon[edge]) + rng.uniform(-0.002, 0.002, edge.sum())
+    return lon, lat
+
+def brute_force(results, lon, lat):
+    tree = cKDTree(unit_vectors(results["latitude"], results["longitude"]))
+    chord, position = tree.query(unit_vectors(lon, lat))
+    meters = chord_to_meters(chord)
+    return np.where(meters <= MAX_METERS, results["urbanID"][np.minimum(position, len(results["urbanID"]) - 1)], -1)
+
+def quiet(message):
+    pass
+
+def check_sql(workdir, results):
+    #Index built from a SQLite roadresults table in which a tenth of the origins were written twice.
+    failures = []
+    conn = SQLiteConnection(os.path.join(workdir, "roadresults.sqlite"))
+    n = min(20000, len(results["urbanID"]))
+    rows = [tuple(str(results[c][i]) for c in COLUMNS) for i in range(n)]
+    rewritten = [tuple(str(results[c][i] + 5.0) if c == "traveltime" else str(results[c][i]) for c in COLUMNS) for i in range(0, n, 10)]
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE)
+        cursor.executemany("INSERT INTO roadresults (" + ", ".join(COLUMNS) + ") VALUES (" + ", ".join(["%s"] * len(COLUMNS)) + ")",
+                           rows + rewritten)
+    conn.commit()
+    indexPath = os.path.join(workdir, "sqlIndex")
+    indexed = build_index(lambda: sql_batches(conn, batch_rows=5000), indexPath, log=quiet)
+    conn.close()
+    index = PointIndex(indexPath)
+    found = index.query_batch(results["latitude"][:n], results["longitude"][:n])
+    expected = results["traveltime"][:n] + np.where(np.arange(n) % 10 == 0, 5.0, 0.0)
+    if indexed != n or index.meta["duplicates"] != len(rewritten):
+        failures.append("SQL index holds %d origins (%d duplicates dropped), expected %d (%d)" % (indexed, index.meta["duplicates"], n, len(rewritten)))
+    if not np.array_equal(found["urbanID"], results["urbanID"][:n]) or not np.allclose(found["traveltime"], expected):
+        failures.append("SQL index does not return the latest row for every origin")
+    if found["name"][0] != "Urban 0" or found["total_population"][1] != 10001.0:
+        failures.append("SQL index returns wrong urban centre details")
+    return failures
+
+def check_http(index):
+    failures = []
+    server = serve(index, 0, host="127.0.0.1")
+    base = "http://127.0.0.1:" + str(server.server_address[1])
+    try:
+        one = json.loads(urllib.request.urlopen(base + "/nearest?lon=85.3&lat=27.7").read())
+        request = urllib.request.Request(base + "/nearest", data=json.dumps({"lon": [85.3, 0.0], "lat": [27.7, 0.0]}).encode(),
+                                         headers={"Content-Type": "application/json"})
+        many = json.loads(urllib.request.urlopen(request).read())
+        if one["urbanID"] != many["urbanID"][0] or many["found"] != [True, False] or many["traveltime"][1] is not None:
+            failures.append("HTTP single and batch answers disagree: %s / %s" % (one, many))
+        try:
+            urllib.request.urlopen(base + "/nearest?lon=0&lat=0")
+            failures.append("HTTP lookup far from any origin did not return 404")
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                failures.append("HTTP lookup far from any origin returned %d" % e.code)
+    finally:
+        server.shutdown()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spacing", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=50000)
+    parser.add_argument("--batch", type=int, default=10000)
+    parser.add_argument("--single", type=int, default=20000)
+    args = parser.parse_args()
+    failures = []
+    workdir = tempfile.mkdtemp()
+    try:
+        results = origin_results(args.spacing)
+        shardDir = os.path.join(workdir, "shards")
+        with ParquetResultWriter(shardDir) as writer:
+            for i in range(0, len(results["urbanID"]), 100000):
+                writer.write_columns({c: v[i:i + 100000] for c, v in results.items()})
+        datasetPath = os.path.join(workdir, "roadresults")
+        compact_results(shardDir, datasetPath, log=quiet)
+        indexPath = os.path.join(workdir, "index")
+        start = time.perf_counter()
+        indexed = build_index(lambda: dataset_batches(datasetPath), indexPath, log=quiet)
+        print("Index: %d origins built in %.2f s" % (indexed, time.perf_counter() - start))
+        if indexed != len(results["urbanID"]):
+            failures.append("indexed %d origins, expected %d" % (indexed, len(results["urbanID"])))
+
+        lon, lat = query_points(args.queries)
+        index = PointIndex(indexPath)
+        found = index.query_batch(lon, lat)
+        expected = brute_force(results, lon, lat)
+        wrong = np.count_nonzero(found["urbanID"] != expected)
+        print("Correctness: %d queries, %d answered, %d differ from brute force" % (len(lon), found["found"].sum(), wrong))
+        if wrong:
+            failures.append("%d of %d queries differ from the brute-force nearest origin" % (wrong, len(lon)))
+        hit = found["found"]
+        if not np.allclose(found["traveltime"][hit], results["traveltime"][found["urbanID"][hit]]) \
+                or not np.array_equal(found["dest_ID"][hit], results["dest_ID"][found["urbanID"][hit]]) \
+                or np.any(found["origin_meters"][hit] > MAX_METERS):
+            failures.append("answers do not carry their origin's result")
+        single = np.array([(lambda r: -1 if r is None else r["urbanID"])(index.query(x, y)) for x, y in zip(lon[:5000], lat[:5000])])
+        if not np.array_equal(single, expected[:5000]):
+            failures.append("%d single-point answers differ from brute force" % np.count_nonzero(single != expected[:5000]))
+
+        #Single-point latency: first with an empty tile cache, then hot.
+        index = PointIndex(indexPath)
+        lon, lat = query_points(args.single, seed=2)
+        for label in ["cold", "hot"]:
+            times = np.empty(len(lon))
+            for i in range(len(lon)):
+                start = time.perf_counter()
+                index.query(lon[i], lat[i])
+                times[i] = time.perf_counter() - start
+            print("Single %-4s p50 %6.1f us  p99 %7.1f us  (%.0f queries/s)  %s"
+                  % (label, np.percentile(times, 50) * 1e6, np.percentile(times, 99) * 1e6, len(lon) / times.sum(), index.stats()))
+        lon, lat = query_points(args.queries, seed=3)
+        start = time.perf_counter()
+        for i in range(0, len(lon), args.batch):
+            index.query_batch(lon[i:i + args.batch], lat[i:i + args.batch])
+        elapsed = time.perf_counter() - start
+        print("Batch of %d: %.0f queries/s (%.2f us per point)" % (args.batch, len(lon) / elapsed, elapsed / len(lon) * 1e6))
+
+        failures = failures + check_sql(workdir, results) + check_http(index)
+    finally:
+        shutil.rmtree(workdir)
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
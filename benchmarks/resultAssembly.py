@@ -0,0 +1,86 @@
+#Result assembly cost once routing is done: the per-origin select_result loop
+#(iterrows over the candidates, str() for every field, a dict per row) against
+#the vectorized select_results on an origin x candidate matrix.
+#
+#Usage: python benchmarks/resultAssembly.py [--origins 20000] [--candidates 20]
+#
+#Checks that both pick the same destination and distance for every origin.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+from routingClient import synthetic_points
+from urbanIndex import UrbanIndex
+
+def select_result(row, closestPts, routed):
+    #The per-origin selection processPoints used before select_results.
+    mindist = 9999999999.0
+    results = {}
+    for (index_urbcent, row_urbcent), pair in zip(closestPts.iterrows(), routed):
+        if pair is None:
+            continue
+        distance, duration = pair
+        if(distance == 0):
+            distance = 9999999999.0
+        if(float(mindist) > float(distance)):
+            mindist = float(distance)
+            results["latitude"] = str(row.geometry.x)
+            results["longitude"] = str(row.geometry.y)
+            results["name"] = str(row_urbcent["CIESIN_NAME_TL"])
+            results["total_population"] = str(row_urbcent["Total_Pop"])
+            results["urbanID"] = str(row["PID"])
+            results["distance"] = str(distance)
+            results["traveltime"] = str(duration)
+            results["dest_latitude"] = str(row_urbcent.geometry.x)
+            results["dest_longitude"] = str(row_urbcent.geometry.y)
+            results["dest_ID"] = str(row_urbcent["UID"])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=20000)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--unroutable", type=float, default=0.05)
+    args = parser.parse_args()
+
+    pts = synthetic_points(args.origins, 2)
+    urbanPoints = synthetic_points(2000, 3)
+    urbanIndex = UrbanIndex(urbanPoints)
+    positions, meters = urbanIndex.query(pts.geometry.x.values, pts.geometry.y.values, args.candidates)
+    rng = np.random.default_rng(0)
+    origins = [row for index, row in pts.iterrows()]
+    candidates = [urbanIndex.candidates(p) for p in positions]
+    routed = []
+    for m in meters:
+        pairs = np.column_stack((m * 1.3, m * 1.3 / 13.9))
+        pairs[rng.random(len(m)) < args.unroutable] = np.nan
+        routed.append(pairs)
+    routedPairs = [[None if np.isnan(p[0]) else (float(p[0]), float(p[1])) for p in r] for r in routed]
+
+    start = time.perf_counter()
+    rows = [select_result(row, closestPts, pairs) for row, closestPts, pairs in zip(origins, candidates, routedPairs)]
+    loopTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns, failed = processDegurb.select_results(origins, candidates, routed, urbanPoints)
+    vectorTime = time.perf_counter() - start
+
+    rows = [r for r in rows if r]
+    mismatches = int(len(rows) != len(columns["dest_ID"]))
+    if not mismatches:
+        mismatches = sum(int(r["dest_ID"]) != d or abs(float(r["distance"]) - x) > 1e-6
+                         for r, d, x in zip(rows, columns["dest_ID"].tolist(), columns["distance"].tolist()))
+    print("Origins: %d x %d candidates, %d without a routable candidate" % (args.origins, args.candidates, failed.sum()))
+    print("select_result loop: %.0f origins/s" % (args.origins / loopTime))
+    print("select_results (vectorized): %.0f origins/s (%.1fx)" % (args.origins / vectorTime, loopTime / vectorTime))
+    print("Origins with a different pick: %d" % mismatches)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#Checks the Parquet result sink (parquetResults.py) and compares its write
+#throughput with the row-insert paths into roadresults.
+#
+#Usage: python benchmarks/resultSink.py [--rows 500000] [--window 1000] [--insert-rows 20000]
+#
+#Rows arrive as typed columns, --window origins at a time, as processPoints
+#writes them.  Reports rows/s for insert_results (one commit per row, on the
+#first --insert-rows rows), ResultWriter batches and ParquetResultWriter, the
+#last two into SQLite / shard files on local disk.  Then checks that the
+#shards are typed GeoParquet, that flushing every window (as processPoints
+#does) still gives file_rows-sized files, that when_committed waits for the
+#commit, that done_pids only opens files whose urbanID range overlaps the
+#PIDs asked for, that an unfinished shard is invisible, that
+#compaction keeps the latest row per urbanID (also when compacting into an
+#existing dataset), and that load_mariadb loads every compacted row.
+
+import argparse
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquetResults import RESULT_SCHEMA, ParquetResultWriter, compact_results, load_mariadb, shard_files, shard_pid_range
+from resultWriter import COLUMNS, ResultWriter
+from resultWrites import CREATE, SQLiteConnection, insert_results
+
+def synthetic_columns(start, n, distanceOffset=0.0):
+    pids = np.arange(start, start + n, dtype=np.int64)
+    rng = np.random.default_rng(start)
+    return {"latitude": rng.uniform(80, 88, n), "longitude": rng.uniform(26, 30, n),
+            "name": np.array(["Urban " + str(i % 500) for i in range(n)]),
+            "total_population": 10000 + (pids % 977).astype(np.float64),
+            "urbanID": pids, "distance": 1000.0 + pids + distanceOffset, "traveltime": 60.0 + pids,
+            "dest_latitude": np.full(n, 85.3), "dest_longitude": np.full(n, 27.7), "dest_ID": pids % 500}
+
+def windows(rows, window, distanceOffset=0.0, start=0):
+    for i in range(start, start + rows, window):
+        yield synthetic_columns(i, min(window, start + rows - i), distanceOffset)
+
+def sqlite_table(path):
+    conn = SQLiteConnection(path)
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE)
+    conn.commit()
+    return conn
+
+def quiet(message):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--window", type=int, default=1000)
+    parser.add_argument("--insert-rows", type=int, default=20000)
+    args = parser.parse_args()
+    failures = []
+    workdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite_table(os.path.join(workdir, "rows.sqlite"))
+        n = min(args.insert_rows, args.rows)
+        start = time.perf_counter()
+        for columns in windows(n, args.window):
+            for i in range(len(columns["urbanID"])):
+                insert_results(conn, {c: str(columns[c][i]) for c in COLUMNS})
+        perRow = n / (time.perf_counter() - start)
+        conn.close()
+
+        conn = sqlite_table(os.path.join(workdir, "batched.sqlite"))
+        start = time.perf_counter()
+        with ResultWriter(conn, batch_size=500) as writer:
+            for columns in windows(args.rows, args.window):
+                writer.write_columns(columns)
+        batched = args.rows / (time.perf_counter() - start)
+        conn.close()
+
+        shardDir = os.path.join(workdir, "shards")
+        start = time.perf_counter()
+        committed = []
+        with ParquetResultWriter(shardDir, row_group_rows=50000, file_rows=200000) as writer:
+            for columns in windows(args.rows, args.window):
+                writer.write_columns(columns)
+                writer.flush()
+            writer.when_committed(lambda: committed.append(writer.written))
+            if committed:
+                failures.append("when_committed ran before the open file was committed")
+        parquet = args.rows / (time.perf_counter() - start)
+        print("%d rows, windows of %d" % (args.rows, args.window))
+        print("insert_results (row + commit):  %9.0f rows/s" % perRow)
+        print("ResultWriter (batch 500):       %9.0f rows/s (%.1fx)" % (batched, batched / perRow))
+        print("ParquetResultWriter:            %9.0f rows/s (%.1fx)" % (parquet, parquet / perRow))
+
+        files = shard_files(shardDir)
+        table = ds.dataset(files, format="parquet").to_table()
+        if writer.written != args.rows or table.num_rows != args.rows:
+            failures.append("%d rows written, %d in the shards, expected %d" % (writer.written, table.num_rows, args.rows))
+        if not table.schema.equals(RESULT_SCHEMA):
+            failures.append("shard schema differs from RESULT_SCHEMA: " + str(table.schema))
+        geo = json.loads(pq.read_schema(files[0]).metadata[b"geo"])
+        if geo["columns"]["geometry"]["geometry_types"] != ["Point"]:
+            failures.append("shards lack GeoParquet point metadata")
+        if len(files) != -(-args.rows // 200000):
+            failures.append("%d shard files for %d rows at 200000 per file" % (len(files), args.rows))
+        if committed != [args.rows]:
+            failures.append("when_committed callback ran with %s rows committed, expected [%d]" % (committed, args.rows))
+        ranges = [shard_pid_range(f) for f in files]
+        if ranges[0][0] != 0 or ranges[-1][1] != args.rows - 1:
+            failures.append("shard names do not carry their urbanID ranges: " + str(ranges))
+        opened = []
+        openDataset = ds.dataset
+        ds.dataset = lambda source, **kwargs: opened.append(source) or openDataset(source, **kwargs)
+        try:
+            found = writer.done_pids([1, 2, 5])
+        finally:
+            ds.dataset = openDataset
+        if found != {"1", "2", "5"} or [len(o) for o in opened] != [1]:
+            failures.append("done_pids found %s opening %s, expected 1 file" % (found, opened))
+
+        #A writer that dies before flushing leaves only a .part file behind.
+        crashed = ParquetResultWriter(shardDir, row_group_rows=100)
+        crashed.write_columns(synthetic_columns(args.rows, 500))
+        if not any(p.endswith(".part") for p in os.listdir(shardDir)) or len(shard_files(shardDir)) != len(files):
+            failures.append("an unfinished shard is visible as a .parquet file")
+        if writer.done_pids([args.rows, args.rows + 1, 0]) != {"0"}:
+            failures.append("done_pids counts rows of an unfinished shard")
+        crashed.file.close()
+        atexit.unregister(crashed.close)
+
+        #Later shards rewrite the first tenth of the origins with new distances.
+        redo = args.rows // 10
+        with ParquetResultWriter(shardDir) as writer:
+            for columns in windows(redo, args.window, distanceOffset=1.0):
+                writer.write_columns(columns)
+        datasetPath = os.path.join(workdir, "roadresults")
+        start = time.perf_counter()
+        rows = compact_results(shardDir, datasetPath, log=quiet)
+        compactTime = time.perf_counter() - start
+        print("Compaction: %d shard rows -> %d rows in %.2f s (%.0f rows/s)"
+              % (args.rows + redo, rows, compactTime, (args.rows + redo) / compactTime))
+        with ParquetResultWriter(shardDir) as writer:
+            writer.write_columns(synthetic_columns(0, 10, distanceOffset=2.0))
+        rows = compact_results(shardDir, datasetPath, log=quiet)
+        result = ds.dataset(datasetPath, format="parquet", partitioning="hive").to_table(columns=["urbanID", "distance"])
+        pids = result.column("urbanID").to_numpy()
+        offset = result.column("distance").to_numpy() - 1000.0 - pids
+        expected = np.where(pids < 10, 2.0, np.where(pids < redo, 1.0, 0.0))
+        if rows != args.rows or len(np.unique(pids)) != args.rows:
+            failures.append("compacted dataset has %d rows, %d distinct urbanIDs, expected %d" % (rows, len(np.unique(pids)), args.rows))
+        elif not np.allclose(offset[np.argsort(pids)], expected[np.argsort(pids)]):
+            failures.append("compaction did not keep the latest row for every urbanID")
+        if shard_files(shardDir):
+            failures.append("compacted shards were not removed")
+        if len(os.listdir(datasetPath)) < 2:
+            failures.append("compacted dataset is not partitioned by tile")
+        reader = ParquetResultWriter(os.path.join(workdir, "empty"), dataset_path=datasetPath)
+        if reader.done_pids([5, args.rows - 1, args.rows + 5]) != {"5", str(args.rows - 1)}:
+            failures.append("done_pids does not see the compacted dataset")
+        reader.close()
+
+        conn = sqlite_table(os.path.join(workdir, "loaded.sqlite"))
+        start = time.perf_counter()
+        loaded = load_mariadb(datasetPath, conn, batch_rows=50000, load_data=False, log=quiet)
+        loadTime = time.perf_counter() - start
+        with conn.cursor() as cursor:
+            count, distinct = cursor.execute("SELECT COUNT(*), COUNT(DISTINCT urbanID) FROM roadresults").fetchone()
+        conn.close()
+        print("Bulk load: %d rows in %.2f s (%.0f rows/s)" % (loaded, loadTime, loaded / loadTime))
+        if loaded != args.rows or count != args.rows or distinct != args.rows:
+            failures.append("loaded %d rows (%d in the table, %d distinct), expected %d" % (loaded, count, distinct, args.rows))
+    finally:
+        shutil.rmtree(workdir)
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
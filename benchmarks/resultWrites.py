@@ -0,0 +1,125 @@
+#Throughput benchmark for roadresults writes: the original one-execute-and-commit
+#per row path against ResultWriter batches.
+#
+#Usage: python benchmarks/resultWrites.py [--rows 20000] [--batch-size 500]
+#       python benchmarks/resultWrites.py --mysql-host localhost --mysql-db globalroads_bench
+#
+#Without --mysql-host an on-disk SQLite database stands in for MariaDB; it fsyncs
+#on every commit, which is the cost the batching removes.  With --mysql-host the
+#roadresults table in that database is created if needed and truncated.
+
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resultWriter import COLUMNS, ResultWriter
+
+CREATE = ("CREATE TABLE IF NOT EXISTS roadresults ("
+          + ", ".join(c + " VARCHAR(255)" for c in COLUMNS) + ")")
+
+class SQLiteConnection:
+    #Just enough of the pymysql connection API for insert_results, ResultWriter, done_pids and pointQuery.sql_batches.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level="DEFERRED")
+
+    @contextlib.contextmanager
+    def cursor(self):
+        yield SQLiteCursor(self.db.cursor())
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=()):
+        return self.cursor.execute(query.replace("%s", "?"), args)
+
+    def executemany(self, query, args):
+        return self.cursor.executemany(query.replace("%s", "?"), args)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+def insert_results(conn, results):
+    #The original processDegurb.insert_results: one statement and one commit per row.
+    query = """INSERT INTO roadresults (latitude, longitude, name, total_population, urbanID, distance, traveltime, dest_latitude, dest_longitude, dest_ID)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+    with conn.cursor() as cursor:
+        cursor.execute(query, tuple(results[c] for c in COLUMNS))
+    conn.commit()
+
+def synthetic_rows(n):
+    for i in range(n):
+        yield {"latitude": str(80 + i * 1e-5), "longitude": str(28 + i * 1e-5),
+               "name": "Urban " + str(i % 500), "total_population": str(10000 + i % 977),
+               "urbanID": str(i), "distance": str(1000.0 + i), "traveltime": str(60.0 + i),
+               "dest_latitude": "85.3", "dest_longitude": "27.7", "dest_ID": str(i % 500)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--load-data-rows", type=int, default=None)
+    parser.add_argument("--mysql-host")
+    parser.add_argument("--mysql-user", default="root")
+    parser.add_argument("--mysql-password", default="")
+    parser.add_argument("--mysql-db", default="globalroads_bench")
+    args = parser.parse_args()
+
+    if args.mysql_host:
+        import pymysql
+        config = {"host": args.mysql_host, "user": args.mysql_user, "password": args.mysql_password,
+                  "db": args.mysql_db, "local_infile": True}
+        connect = lambda: pymysql.connect(**config)
+        target = "MariaDB " + args.mysql_host + "/" + args.mysql_db
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "roadresults.sqlite")
+        connect = lambda: SQLiteConnection(path)
+        target = "SQLite " + path
+
+    def reset():
+        conn = connect()
+        with conn.cursor() as cursor:
+            cursor.execute(CREATE)
+            cursor.execute("DELETE FROM roadresults")
+        conn.commit()
+        return conn
+
+    conn = reset()
+    start = time.perf_counter()
+    for r in synthetic_rows(args.rows):
+        insert_results(conn, r)
+    perRow = time.perf_counter() - start
+    conn.close()
+
+    conn = reset()
+    start = time.perf_counter()
+    with ResultWriter(conn, reconnect=connect, batch_size=args.batch_size,
+                      load_data_rows=args.load_data_rows) as writer:
+        for r in synthetic_rows(args.rows):
+            writer.write(r)
+    batched = time.perf_counter() - start
+    writer.conn.close()
+
+    print("Target: " + target + ", rows: " + str(args.rows))
+    print("insert_results (row + commit): %.0f rows/s" % (args.rows / perRow))
+    print("ResultWriter (batch %d): %.0f rows/s (%.1fx)" % (args.batch_size, args.rows / batched, perRow / batched))
+
+if __name__ == "__main__":
+    main()
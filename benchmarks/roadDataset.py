@@ -0,0 +1,82 @@
+#Regional road lookups: a full read of a monolithic per-continent parquet file
+#against read_roads on the partitioned road dataset.
+#
+#Usage: python benchmarks/roadDataset.py [--ways 500000] [--spacing 0.02] [--bbox-degrees 1] [--queries 20] [--long-ways 20]
+#
+#The synthetic PBF spreads roads over tens of degrees (ways * 4 nodes on a grid
+#`spacing` degrees apart) so that tiles matter, plus --long-ways roads across
+#the whole grid, many tiles wide or tall.  Checks that both paths return the
+#same roads for every query, including the long roads that start tiles away.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sourceData"))
+from roadExtract import extract_road_dataset, extract_roads, read_roads
+from synthetic import synthetic_pbf
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ways", type=int, default=500000)
+    parser.add_argument("--spacing", type=float, default=0.02)
+    parser.add_argument("--tile-degrees", type=float, default=5.0)
+    parser.add_argument("--bbox-degrees", type=float, default=1.0)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--long-ways", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    quiet = lambda message: None
+    try:
+        pbf = os.path.join(workdir, "synthetic.osm.pbf")
+        synthetic_pbf(pbf, args.ways, spacing=args.spacing, long_ways=args.long_ways)
+        monolithic = os.path.join(workdir, "continent.parquet")
+        dataset = os.path.join(workdir, "continent")
+        extract_roads(pbf, monolithic, log=quiet)
+        start = time.perf_counter()
+        rows = extract_road_dataset(pbf, dataset, tile_degrees=args.tile_degrees, log=quiet)
+        print("Roads: %d, partitioned dataset written in %.2f s" % (rows, time.perf_counter() - start))
+
+        full = gpd.read_parquet(monolithic)
+        xmin, ymin, xmax, ymax = full.total_bounds
+        rng = np.random.default_rng(0)
+        fullTime = 0.0
+        datasetTime = 0.0
+        mismatches = 0
+        longFound = 0
+        for _ in range(args.queries):
+            x = rng.uniform(xmin, xmax - args.bbox_degrees)
+            y = rng.uniform(ymin, ymax - args.bbox_degrees)
+            bbox = (x, y, x + args.bbox_degrees, y + args.bbox_degrees)
+
+            start = time.perf_counter()
+            roads = gpd.read_parquet(monolithic)
+            expected = roads[roads.intersects(shapely.box(*bbox)) & roads["highway"].isin(["primary", "secondary"])]
+            fullTime = fullTime + time.perf_counter() - start
+
+            start = time.perf_counter()
+            got = read_roads(dataset, polygon=shapely.box(*bbox), highways=["primary", "secondary"])
+            datasetTime = datasetTime + time.perf_counter() - start
+
+            if sorted(expected["osm_id"]) != sorted(got["osm_id"]):
+                mismatches = mismatches + 1
+            longFound = longFound + int(got["name"].str.startswith("Long road").sum())
+
+        print("Full read + filter: %.1f ms/query" % (1000 * fullTime / args.queries))
+        print("read_roads (partition + row-group pruning): %.1f ms/query (%.1fx)"
+              % (1000 * datasetTime / args.queries, fullTime / datasetTime))
+        print("Queries with differing results: %d (%d long roads found)" % (mismatches, longFound))
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#Compares the original PBF -> GeoJSON -> GeoDataFrame -> Parquet road path with
+#the streaming extractor in sourceData/roadExtract.py, on a synthetic PBF.
+#
+#Usage: python benchmarks/roadExtraction.py [--ways 200000] [--pbf existing.osm.pbf]
+#
+#Each path runs in its own subprocess so peak RSS is measured independently.
+#The original path uses ogr2ogr if it is installed, otherwise the equivalent
+#GDAL GeoJSON conversion through pyogrio.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "sourceData"))
+from synthetic import synthetic_pbf
+
+def run_original(pbf, workdir):
+    import geopandas as gpd
+    import pyogrio
+    from roadExtract import ROADS_SUBSET
+    geojson = os.path.join(workdir, "roads.geojson")
+    if shutil.which("ogr2ogr"):
+        os.system("ogr2ogr -f GeoJSON " + geojson + " " + pbf + " lines")
+    else:
+        pyogrio.write_dataframe(pyogrio.read_dataframe(pbf, layer="lines"), geojson, driver="GeoJSON")
+    jsonOSM = gpd.read_file(geojson)
+    roadways = jsonOSM.loc[jsonOSM['highway'].isin(ROADS_SUBSET)]
+    roadways.to_parquet(os.path.join(workdir, "original.parquet"))
+    return len(roadways)
+
+def run_streaming(pbf, workdir):
+    from roadExtract import extract_roads
+    return extract_roads(pbf, os.path.join(workdir, "streaming.parquet"), tmpdir=workdir, log=lambda message: None)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ways", type=int, default=200000)
+    parser.add_argument("--pbf")
+    parser.add_argument("--run", choices=["original", "streaming"], help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        start = time.perf_counter()
+        rows = (run_original if args.run == "original" else run_streaming)(args.pbf, args.workdir)
+        print(json.dumps({"rows": rows, "seconds": time.perf_counter() - start,
+                          "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}))
+        return
+
+    workdir = tempfile.mkdtemp()
+    try:
+        pbf = args.pbf
+        if pbf is None:
+            pbf = os.path.join(workdir, "synthetic.osm.pbf")
+            synthetic_pbf(pbf, args.ways)
+        print("Input: " + pbf + " (%.1f MB)" % (os.path.getsize(pbf) / 1024.0 ** 2))
+        results = {}
+        for mode in ["original", "streaming"]:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", mode, "--pbf", pbf, "--workdir", workdir],
+                                 check=True, stdout=subprocess.PIPE, text=True).stdout
+            results[mode] = json.loads(out.strip().splitlines()[-1])
+            print("%-10s %8d roads  %7.2f s  peak RSS %7.1f MB"
+                  % (mode, results[mode]["rows"], results[mode]["seconds"], results[mode]["peak_rss_mb"]))
+        if results["original"]["rows"] != results["streaming"]["rows"]:
+            print("FAIL: road counts differ")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
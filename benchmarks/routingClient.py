@@ -0,0 +1,99 @@
+#Checks the OSRM routing clients against the fake OSRM server, which injects
+#latency and 5xx errors, then runs processPoints end to end on it.
+#
+#Usage: python benchmarks/routingClient.py [--requests 400] [--latency 0.02] [--error-rate 0.05]
+#
+#Reports requests/s for sequential osm_request and for AsyncRoutingClient, and
+#exits non-zero if any request was lost despite the retries.
+
+import argparse
+import os
+import sys
+import time
+
+import geopandas
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+from asyncRouting import AsyncRoutingClient
+from fakeOsrm import FakeOSRM
+
+class ListWriter:
+    #Collects rows in memory in place of ResultWriter.
+    def __init__(self):
+        self.rows = []
+
+    def write(self, results):
+        self.rows.append(results)
+
+    def write_columns(self, columns):
+        names = list(columns)
+        values = [columns[c].tolist() if hasattr(columns[c], "tolist") else list(columns[c]) for c in names]
+        self.rows.extend(dict(zip(names, row)) for row in zip(*values))
+
+    def flush(self):
+        pass
+
+def synthetic_points(n, seed):
+    rng = np.random.default_rng(seed)
+    return geopandas.GeoDataFrame({"PID": np.arange(n), "UID": np.arange(n),
+                                   "CIESIN_NAME_TL": ["Urban " + str(i) for i in range(n)],
+                                   "Total_Pop": rng.integers(50000, 500000, n)},
+                                  geometry=geopandas.points_from_xy(rng.uniform(80, 88, n), rng.uniform(26, 30, n)),
+                                  crs="EPSG:4326")
+
+def route_urls(base, n, seed=1):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(80, 88, (n, 2))
+    lat = rng.uniform(26, 30, (n, 2))
+    return [base + "/route/v1/driving/%f,%f;%f,%f?overview=false&steps=true" % (lon[i, 0], lat[i, 0], lon[i, 1], lat[i, 1])
+            for i in range(n)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--base-wait", type=float, default=0.05)
+    parser.add_argument("--origins", type=int, default=200)
+    args = parser.parse_args()
+
+    lost = 0
+    with FakeOSRM(latency=args.latency, error_rate=args.error_rate) as osrm:
+        urls = route_urls(osrm.url, args.requests)
+
+        start = time.perf_counter()
+        sequential = [processDegurb.osm_request(url, processDegurb.RETRIES, args.base_wait) for url in urls]
+        sequentialTime = time.perf_counter() - start
+
+        with AsyncRoutingClient(args.concurrency, processDegurb.RETRIES, args.base_wait) as client:
+            start = time.perf_counter()
+            concurrent = client.get_many(urls)
+            concurrentTime = time.perf_counter() - start
+
+        lost = sequential.count(None) + concurrent.count(None)
+        mismatched = sum(a is not None and b is not None and a["routes"][0]["distance"] != b["routes"][0]["distance"]
+                         for a, b in zip(sequential, concurrent))
+        print("Requests: %d, injected errors: %d" % (2 * args.requests, osrm.counts["errors"]))
+        print("osm_request (sequential): %.0f req/s" % (args.requests / sequentialTime))
+        print("AsyncRoutingClient (%d in flight): %.0f req/s (%.1fx)"
+              % (args.concurrency, args.requests / concurrentTime, sequentialTime / concurrentTime))
+        print("Failed after retries: %d, mismatched responses: %d" % (lost, mismatched))
+
+        processDegurb.OSRM_URL = osrm.url
+        processDegurb.RESPONSEWAIT = args.base_wait
+        processDegurb.ROUTING_CONCURRENCY = args.concurrency
+        writer = ListWriter()
+        start = time.perf_counter()
+        processDegurb.processPoints(synthetic_points(args.origins, 2), writer, synthetic_points(300, 3))
+        elapsed = time.perf_counter() - start
+        print("processPoints: %d of %d origins routed, %.1f origins/s"
+              % (len(writer.rows), args.origins, args.origins / elapsed))
+        lost = lost + args.origins - len(writer.rows)
+
+    sys.exit(1 if lost or mismatched else 0)
+
+if __name__ == "__main__":
+    main()
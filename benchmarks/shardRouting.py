@@ -0,0 +1,97 @@
+#Checks regional OSRM sharding in processPoints: two fake OSRM servers, each
+#covering one half of the synthetic origins plus a border buffer, and an
+#optional fallback server for origins whose candidates straddle both.
+#
+#Usage: python benchmarks/shardRouting.py [--origins 500] [--buffer-km 100]
+#
+#Compares every run against a single server covering everything.  Exits
+#non-zero if, with a fallback server, a shard was sent coordinates outside its
+#coverage or any result differs from the single-server results.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+from fakeOsrm import FakeOSRM
+from osrmShards import KM_DEGREES
+from routingClient import ListWriter, synthetic_points
+
+BORDER = 84.0
+
+def shard_geojson(path, west, east, buffer_km):
+    features = []
+    for name, url, (xmin, xmax) in (("west", west, (70.0, BORDER)), ("east", east, (BORDER, 100.0))):
+        ring = [[xmin, 20.0], [xmax, 20.0], [xmax, 35.0], [xmin, 35.0], [xmin, 20.0]]
+        features.append({"type": "Feature", "properties": {"name": name, "url": url, "buffer_km": buffer_km},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+def run(origins, urbanPoints, shards=None, fallback=None):
+    processDegurb.OSRM_SHARDS = shards
+    processDegurb.OSRM_FALLBACK_URL = fallback
+    writer = ListWriter()
+    processDegurb.processPoints(origins, writer, urbanPoints)
+    return {row["urbanID"]: (row["dest_ID"], round(float(row["distance"]), 3)) for row in writer.rows}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=500)
+    parser.add_argument("--urban", type=int, default=300)
+    parser.add_argument("--buffer-km", type=float, default=100.0)
+    args = parser.parse_args()
+
+    processDegurb.ROUTE_CACHE = False
+    origins = synthetic_points(args.origins, 2)
+    urbanPoints = synthetic_points(args.urban, 3)
+    pad = args.buffer_km * KM_DEGREES
+    workdir = tempfile.mkdtemp()
+    failures = []
+    stdout = sys.stdout
+    try:
+        with FakeOSRM(latency=0) as single, \
+             FakeOSRM(latency=0, coverage=(70.0 - pad, 20.0 - pad, BORDER + pad, 35.0 + pad)) as west, \
+             FakeOSRM(latency=0, coverage=(BORDER - pad, 20.0 - pad, 100.0 + pad, 35.0 + pad)) as east, \
+             FakeOSRM(latency=0) as fallback:
+            shards = os.path.join(workdir, "shards.geojson")
+            shard_geojson(shards, west.url, east.url, args.buffer_km)
+
+            #processPoints prints every row; keep the report readable.
+            sys.stdout = open(os.devnull, "w")
+            processDegurb.OSRM_URL = single.url
+            expected = run(origins, urbanPoints)
+            withFallback = run(origins, urbanPoints, shards, fallback.url)
+            outsideFallback = west.counts["outside"] + east.counts["outside"]
+            westRequests = west.counts["table"]
+            eastRequests = east.counts["table"]
+            fallbackRequests = fallback.counts["table"]
+            withoutFallback = run(origins, urbanPoints, shards)
+            sys.stdout = stdout
+
+            print("Single server: %d origins routed in %d table requests" % (len(expected), single.counts["table"]))
+            print("Shards + fallback: west %d, east %d, fallback %d table requests"
+                  % (westRequests, eastRequests, fallbackRequests))
+            if withFallback != expected:
+                failures.append("results with a fallback differ from a single server")
+            if outsideFallback:
+                failures.append("shards were sent coordinates outside their coverage")
+            print("  identical to single server: %s" % (withFallback == expected))
+
+            differing = sum(withoutFallback.get(k) != v for k, v in expected.items())
+            print("Shards only: %d origins routed, %d differ from a single server (straddling origins lose candidates)"
+                  % (len(withoutFallback), differing))
+            print("  coordinates sent outside shard coverage: %d" % (west.counts["outside"] + east.counts["outside"] - outsideFallback))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+    for failure in failures:
+        print("FAIL " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#Compares routing every origin with routing each distinct snapped point once
+#(SNAP_ORIGINS) on a dense origin grid, against the fake OSRM server.
+#
+#Usage: python benchmarks/snapDedupe.py [--origins 4000] [--extent-degrees 0.15] [--urban 2000]
+#
+#Runs against two fake road networks.  "nodes" snaps every coordinate to a
+#0.005 degree node grid, so the denser the origin grid relative to it, the
+#more origins share a snapped point: the best case.  "edges" projects every
+#coordinate onto the nearest of a set of slanted roads, as osrm-routed
+#projects onto the nearest edge, so origins rarely share a snapped location
+#and the saving is close to none: the worst case, and nearer to what a real
+#network gives wherever origins lie alongside roads rather than beyond their
+#ends.  Runs both ROUTING_MODEs.  Checks that every origin gets a row, and
+#that its distance is never longer than without snapping: the snapped point is
+#routed to the candidates around it, which may turn up a closer one.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processDegurb
+from fakeOsrm import FakeOSRM
+from routingClient import ListWriter, synthetic_points
+from synthetic import origin_grid
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=4000)
+    parser.add_argument("--extent-degrees", type=float, default=0.15)
+    parser.add_argument("--urban", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.005)
+    args = parser.parse_args()
+
+    urbanPoints = synthetic_points(args.urban, 3)
+    pts = origin_grid(args.origins, (84, 28, 84 + args.extent_degrees, 28 + args.extent_degrees / 2))
+    processDegurb.ROUTE_CACHE = False
+
+    def run(snap, snapEdges):
+        processDegurb.SNAP_ORIGINS = snap
+        writer = ListWriter()
+        with FakeOSRM(latency=args.latency, snap_edges=snapEdges) as osrm:
+            processDegurb.OSRM_URL = osrm.url
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                start = time.perf_counter()
+                processDegurb.processPoints(pts, writer, urbanPoints)
+                elapsed = time.perf_counter() - start
+            finally:
+                sys.stdout = stdout
+            counts = dict(osrm.counts)
+        return {r["urbanID"]: (r["dest_ID"], r["distance"]) for r in writer.rows}, len(writer.rows), counts, elapsed
+
+    failures = []
+    for roads in ["nodes", "edges"]:
+        for routingMode in ["table", "route"]:
+            processDegurb.ROUTING_MODE = routingMode
+            base, baseRows, baseCounts, baseTime = run(False, roads == "edges")
+            snapped, rows, counts, elapsed = run(True, roads == "edges")
+            label = "%s roads, %s mode" % (roads, routingMode)
+            print("%s, %d origins:" % (label, len(pts)))
+            snapRequests = -(-len(pts) // processDegurb.SNAP_CHUNK)
+            print("  every origin     %6d %s requests                    %6.2f s" % (baseCounts[routingMode], routingMode, baseTime))
+            print("  snapped once     %6d %s requests + %3d for snapping  %6.2f s"
+                  % (counts[routingMode] - (snapRequests if routingMode == "table" else 0), routingMode, snapRequests, elapsed))
+            same = sum(snapped.get(pid, (None,))[0] == dest for pid, (dest, dist) in base.items())
+            longer = [pid for pid, (dest, dist) in base.items() if pid in snapped and snapped[pid][1] > dist + 1e-6]
+            print("  %d of %d origins keep their destination; %d got a longer distance" % (same, len(base), len(longer)))
+            if rows != len(pts) or len(snapped) != len(pts):
+                failures.append(label + ": expected one row per origin, got %d rows for %d origins" % (rows, len(snapped)))
+            if longer:
+                failures.append(label + ": %d origins got a longer distance, e.g. PID %s" % (len(longer), longer[0]))
+    for f in failures:
+        print("FAIL: " + f)
+    print("OK" if not failures else str(len(failures)) + " check(s) failed")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
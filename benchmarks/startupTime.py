@@ -0,0 +1,121 @@
+#Worker startup: time from process start to the first routed origin, loading
+#the urban centroids and origins from GeoJSON (parse + Mollweide reprojection,
+#as before) against the prepared GeoParquet copies.
+#
+#Usage: python benchmarks/startupTime.py [--urban 60000] [--origins 250000]
+#
+#The synthetic GeoJSONs carry extra attribute columns, like the real inputs,
+#which the prepared copies leave out.  Each scenario runs in a fresh Python
+#process against the fake OSRM server; checks that all of them load the same
+#points and route the first origin to the same destination.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import geopandas
+import numpy as np
+import pyproj
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def synthetic_geojson(path, n, idColumn, seed, extra=12):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(80, 88, n)
+    lat = rng.uniform(26, 30, n)
+    x, y = pyproj.Transformer.from_crs("EPSG:4326", "+proj=moll +lon_0=0 +datum=WGS84", always_xy=True).transform(lon, lat)
+    data = {idColumn: np.arange(n), "CIESIN_NAME_TL": ["Place " + str(i) for i in range(n)],
+            "Total_Pop": rng.integers(50000, 500000, n)}
+    for i in range(extra):
+        data["attr_" + str(i)] = rng.random(n)
+    frame = geopandas.GeoDataFrame(data, geometry=geopandas.points_from_xy(x, y))
+    with warnings.catch_warnings():
+        #Like the real inputs: Mollweide coordinates with no CRS recorded.
+        warnings.simplefilter("ignore")
+        frame.to_file(path, driver="GeoJSON")
+
+def run_scenario(args):
+    #Runs inside the child process: load, index, route one origin, report timings.
+    start = time.perf_counter()
+    warnings.simplefilter("ignore", FutureWarning)
+    import processDegurb
+    from fakeOsrm import FakeOSRM
+    from routingClient import ListWriter
+    processDegurb.URBAN_PATH = args.urban_path
+    processDegurb.ORIGIN_PATH = args.origin_path
+    processDegurb.PREPARED_PATH = args.prepared
+    processDegurb.ROUTE_CACHE = False
+    imported = time.perf_counter()
+    urbanPoints = processDegurb.load_urban_points()
+    pts = processDegurb.load_origin_points()
+    loaded = time.perf_counter()
+    with FakeOSRM(latency=0) as osrm:
+        processDegurb.OSRM_URL = osrm.url
+        writer = ListWriter()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        processDegurb.processPoints(pts.head(1), writer, urbanPoints)
+        sys.stdout = stdout
+    routed = time.perf_counter()
+    print(json.dumps({"import": imported - start, "load": loaded - imported, "first_route": routed - start,
+                      "urban": len(urbanPoints), "origins": len(pts), "columns": list(urbanPoints.columns),
+                      "checksum": float(urbanPoints.geometry.x.sum() + pts.geometry.y.sum()),
+                      "dest": writer.rows[0]["dest_ID"] if writer.rows else None}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urban", type=int, default=60000)
+    parser.add_argument("--origins", type=int, default=250000)
+    parser.add_argument("--run", default=None)
+    parser.add_argument("--urban-path")
+    parser.add_argument("--origin-path")
+    parser.add_argument("--prepared", default=None)
+    args = parser.parse_args()
+    if args.run:
+        run_scenario(args)
+        return
+
+    workdir = tempfile.mkdtemp()
+    try:
+        urbanPath = os.path.join(workdir, "urbanCentroids.geojson")
+        originPath = os.path.join(workdir, "degurbaPoints.geojson")
+        synthetic_geojson(urbanPath, args.urban, "UID", 3)
+        synthetic_geojson(originPath, args.origins, "PID", 2)
+        print("Inputs: %d urban centroids (%.0f MB), %d origins (%.0f MB) of GeoJSON"
+              % (args.urban, os.path.getsize(urbanPath) / 1e6, args.origins, os.path.getsize(originPath) / 1e6))
+
+        def scenario(prepared):
+            command = [sys.executable, os.path.abspath(__file__), "--run", "1",
+                       "--urban-path", urbanPath, "--origin-path", originPath]
+            if prepared:
+                command = command + ["--prepared", prepared]
+            out = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True, cwd=ROOT).stdout
+            return json.loads(out.strip().splitlines()[-1])
+
+        prepared = os.path.join(workdir, "prepared")
+        results = [("GeoJSON + to_crs (before)", scenario(None)),
+                   ("prepare on first start", scenario(prepared)),
+                   ("prepared GeoParquet (after)", scenario(prepared))]
+        for name, r in results:
+            print("%-30s import %.2f s, load %.2f s, time to first route %.2f s"
+                  % (name, r["import"], r["load"], r["first_route"]))
+        before = results[0][1]
+        after = results[2][1]
+        print("Speedup in time to first route: %.1fx" % (before["first_route"] / after["first_route"]))
+        same = all(r["checksum"] == before["checksum"] or abs(r["checksum"] - before["checksum"]) < 1e-6 * abs(before["checksum"])
+                   for name, r in results) and all(r["dest"] == before["dest"] for name, r in results)
+        print("Same points and first route in every scenario: %s" % same)
+        print("Columns kept when prepared: %s" % after["columns"])
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(0 if same else 1)
+
+if __name__ == "__main__":
+    main()
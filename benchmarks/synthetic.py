@@ -0,0 +1,53 @@
+#Synthetic inputs shared by the benchmark scripts.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sourceData"))
+
+OTHER_TAGS = [("highway", "footway"), ("highway", "path"), ("highway", "service"), ("waterway", "stream"),
+              ("railway", "rail"), ("power", "line")]
+
+def synthetic_pbf(path, ways, seed=0, spacing=1e-3, long_ways=0):
+    #A grid of nodes spacing degrees apart joined by short ways, roughly half of
+    #them roads in ROADS_SUBSET, plus long_ways primary roads running across the
+    #whole grid, alternately east-west and north-south.
+    import osmium
+    from roadExtract import ROADS_SUBSET
+    rng = random.Random(seed)
+    side = int((ways * 4) ** 0.5) + 2
+    #Uncompressed blocks: some GDAL wheel builds cannot inflate libosmium's zlib blocks.
+    with osmium.SimpleWriter(osmium.io.File(path, "pbf,pbf_compression=none")) as writer:
+        for n in range(side * side):
+            writer.add_node(osmium.osm.mutable.Node(id=n + 1, location=(60 + (n % side) * spacing, 5 + (n // side) * spacing)))
+        for w in range(ways):
+            start = rng.randrange(side * (side - 4))
+            nodes = [start + 1 + k * side for k in range(4)]
+            if rng.random() < 0.5:
+                tags = {"highway": rng.choice(ROADS_SUBSET), "name": "Road " + str(w)}
+            else:
+                key, value = rng.choice(OTHER_TAGS)
+                tags = {key: value}
+            writer.add_way(osmium.osm.mutable.Way(id=w + 1, nodes=nodes, tags=tags))
+        for w in range(long_ways):
+            line = rng.randrange(side)
+            if w % 2 == 0:
+                nodes = [line * side + k + 1 for k in range(side)]
+            else:
+                nodes = [k * side + line + 1 for k in range(side)]
+            writer.add_way(osmium.osm.mutable.Way(id=ways + w + 1, nodes=nodes,
+                                                  tags={"highway": "primary", "name": "Long road " + str(w)}))
+
+def origin_grid(n, extent=(80, 26, 88, 30)):
+    #n origins on a regular lon/lat grid over extent (xmin, ymin, xmax, ymax),
+    #in EPSG:4326 like the prepared inputs, with PIDs in grid order.
+    import geopandas
+    import numpy as np
+    xmin, ymin, xmax, ymax = extent
+    cols = int(np.ceil(np.sqrt(n * (xmax - xmin) / (ymax - ymin))))
+    rows = int(np.ceil(n / cols))
+    lon, lat = np.meshgrid(np.linspace(xmin, xmax, cols), np.linspace(ymin, ymax, rows))
+    return geopandas.GeoDataFrame({"PID": np.arange(n)},
+                                  geometry=geopandas.points_from_xy(lon.ravel()[:n], lat.ravel()[:n]),
+                                  crs="EPSG:4326")
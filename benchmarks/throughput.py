@@ -0,0 +1,280 @@
+#End-to-end throughput benchmark for comparing commits: processPoints against
+#the fake OSRM server with SQLite standing in for MariaDB, and the PBF
+#download + road conversion path (extract_road_dataset, as retrieveData runs
+#it) against a local file server.
+#
+#Usage: python benchmarks/throughput.py [--origins 5000] [--urban 2000] [--latency 0.02] [--ways 50000]
+#                                       [--tree DIR] [--output report.json] [--compare baseline.json] [--tolerance 0.1]
+#
+#Each scenario runs in a fresh subprocess, so its peak RSS is its own and the
+#fake servers (which stay in this process) don't compete with it for the GIL.
+#Inputs are generated from fixed seeds, so reports from different commits with
+#the same parameters are comparable: write one per commit with --output and
+#pass the baseline with --compare, which exits non-zero if any metric got
+#worse by more than --tolerance.  --tree runs the scenarios against the
+#modules of another checkout (e.g. a `git worktree` of an older commit) with
+#this script's inputs and stand-ins.  Older trees are feature-detected: a
+#scenario the tree can't run is skipped, and the APIs each scenario used are
+#recorded so --compare can warn when they differ.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "sourceData"))
+
+#Whether a larger value of each reported metric is better.
+HIGHER_IS_BETTER = {"origins_per_second": True, "requests_per_origin": False, "db_rows_per_second": True,
+                    "download_mb_per_second": True, "convert_roads_per_second": True, "peak_rss_mb": False}
+
+#As sourceData/retrieveData.TILE_DEGREES (retrieveData itself needs Prefect).
+TILE_DEGREES = 5.0
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def use_tree(tree):
+    #Put the checkout under test on sys.path in place of this one, so modules
+    #it lacks aren't picked up from here; the benchmark helpers put this
+    #checkout's root back when imported, so call again after importing them.
+    for path in (ROOT, os.path.join(ROOT, "sourceData")):
+        while path in sys.path:
+            sys.path.remove(path)
+    for path in (os.path.join(tree, "sourceData"), tree):
+        while path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+
+def skipped(reason):
+    print(json.dumps({"skipped": reason}))
+
+def run_route(args):
+    #Child process: route the synthetic origin grid and write the results to SQLite.
+    import inspect
+    use_tree(args.tree)
+    try:
+        import processDegurb
+    except Exception as e:
+        #The oldest trees load their inputs when processDegurb is imported.
+        return skipped("processDegurb failed to import: " + str(e)[:200])
+    if not hasattr(processDegurb, "OSRM_URL") or "urbanPoints" not in inspect.signature(processDegurb.processPoints).parameters:
+        return skipped("processPoints takes no urbanPoints / OSRM_URL, so it can't run against the stand-ins")
+    from resultWriter import ResultWriter
+    try:
+        import routingMetrics
+    except ImportError:
+        routingMetrics = None
+    from resultWrites import CREATE, SQLiteConnection
+    from routingClient import synthetic_points
+    from synthetic import origin_grid
+    use_tree(args.tree)
+    processDegurb.OSRM_URL = args.osrm_url
+    processDegurb.ROUTE_CACHE = False
+    urbanPoints = synthetic_points(args.urban, 3)
+    pts = origin_grid(args.origins)
+    conn = SQLiteConnection(args.db)
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE)
+    conn.commit()
+    metrics = routingMetrics.enable() if routingMetrics is not None else None
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        with ResultWriter(conn, batch_size=processDegurb.WRITE_BATCH_SIZE,
+                          flush_interval=processDegurb.WRITE_FLUSH_SECONDS) as writer:
+            processed = processDegurb.processPoints(pts, writer, urbanPoints)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+    with conn.cursor() as cursor:
+        rows = cursor.execute("SELECT COUNT(*) FROM roadresults").fetchone()[0]
+    result = {"origins": processed, "seconds": elapsed, "rows": rows, "peak_rss_mb": peak_rss_mb(),
+              "apis": "processPoints + ResultWriter" + (" + routingMetrics" if metrics is not None else "")}
+    if metrics is not None:
+        result["db_seconds"] = metrics.summary()["stages"].get("db_write", {}).get("total_seconds", 0.0)
+    print(json.dumps(result))
+
+def run_download(args):
+    #Child process: download the served PBF and convert its roads as retrieveData does.
+    use_tree(args.tree)
+    try:
+        from pbfDownload import download
+        import roadExtract
+    except ImportError as e:
+        return skipped(str(e))
+    quiet = lambda message: None
+    pbf = os.path.join(args.workdir, "download.osm.pbf")
+    start = time.perf_counter()
+    download(args.url, pbf, base_wait=0.01, log=quiet)
+    downloaded = time.perf_counter()
+    if hasattr(roadExtract, "extract_road_dataset"):
+        converter = "extract_road_dataset"
+        roads = roadExtract.extract_road_dataset(pbf, os.path.join(args.workdir, "roads"), roadExtract.ROADS_SUBSET,
+                                                 tile_degrees=TILE_DEGREES, tmpdir=args.workdir, log=quiet)
+    else:
+        converter = "extract_roads"
+        roads = roadExtract.extract_roads(pbf, os.path.join(args.workdir, "roads.parquet"), tmpdir=args.workdir, log=quiet)
+    converted = time.perf_counter()
+    print(json.dumps({"bytes": os.path.getsize(pbf), "download_seconds": downloaded - start,
+                      "roads": roads, "convert_seconds": converted - downloaded, "peak_rss_mb": peak_rss_mb(),
+                      "apis": "pbfDownload.download + " + converter}))
+
+def child(args, scenario, *extra):
+    command = [sys.executable, os.path.abspath(__file__), "--run", scenario, "--tree", args.tree,
+               "--origins", str(args.origins), "--urban", str(args.urban)] + list(extra)
+    out = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True, cwd=ROOT).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def route_scenario(args, workdir):
+    from fakeOsrm import FakeOSRM
+    best = None
+    for i in range(args.repeat):
+        db = os.path.join(workdir, "roadresults-" + str(i) + ".sqlite")
+        with FakeOSRM(latency=args.latency, latency_sigma=args.latency_sigma, error_rate=args.error_rate, seed=i) as osrm:
+            r = child(args, "route", "--osrm-url", osrm.url, "--db", db)
+            requests = osrm.counts["route"] + osrm.counts["table"] + osrm.counts["nearest"]
+        if os.path.exists(db):
+            os.remove(db)
+        if "skipped" in r:
+            return r
+        result = {"origins_per_second": r["origins"] / r["seconds"],
+                  "requests_per_origin": requests / max(r["origins"], 1),
+                  "peak_rss_mb": r["peak_rss_mb"], "apis": r["apis"]}
+        #Without routingMetrics there is no db_write timer to divide by.
+        if r.get("db_seconds"):
+            result["db_rows_per_second"] = r["rows"] / r["db_seconds"]
+        if best is None or result["origins_per_second"] > best["origins_per_second"]:
+            best = result
+    return best
+
+def download_scenario(args, workdir):
+    from downloadResume import FlakyFileServer
+    from synthetic import synthetic_pbf
+    served = os.path.join(workdir, "served", "bench-latest.osm.pbf")
+    os.makedirs(os.path.dirname(served))
+    synthetic_pbf(served, args.ways)
+    server = FlakyFileServer(served, drop_every=0, drops=0)
+    url = server.start()
+    best = None
+    try:
+        for i in range(args.repeat):
+            target = os.path.join(workdir, "download-" + str(i))
+            os.makedirs(target)
+            r = child(args, "download", "--url", url, "--workdir", target)
+            shutil.rmtree(target)
+            if "skipped" in r:
+                return r
+            result = {"download_mb_per_second": r["bytes"] / 1024.0 ** 2 / r["download_seconds"],
+                      "convert_roads_per_second": r["roads"] / r["convert_seconds"],
+                      "peak_rss_mb": r["peak_rss_mb"], "apis": r["apis"]}
+            if best is None or result["convert_roads_per_second"] > best["convert_roads_per_second"]:
+                best = result
+    finally:
+        server.stop()
+    return best
+
+def git_commit(tree=ROOT):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=tree, check=True,
+                                stdout=subprocess.PIPE, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=tree, check=True,
+                               stdout=subprocess.PIPE, text=True).stdout.strip() != ""
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline, tolerance):
+    """Print each metric against the baseline report; returns the metrics that regressed beyond tolerance."""
+    if report["params"] != baseline["params"]:
+        print("Warning: parameters differ from the baseline, so the numbers are not comparable:")
+        print("  baseline " + json.dumps(baseline["params"]))
+        print("  current  " + json.dumps(report["params"]))
+    for scenario in baseline["results"]:
+        if scenario not in report["results"]:
+            print("Warning: " + scenario + " was not run, so it is not compared.")
+        elif baseline.get("apis", {}).get(scenario) != report["apis"].get(scenario):
+            print("Warning: " + scenario + " ran different code paths: baseline %s, current %s"
+                  % (baseline.get("apis", {}).get(scenario), report["apis"].get(scenario)))
+    print("%-34s %12s %12s %8s   (baseline %s)" % ("metric", "baseline", "current", "change", baseline.get("commit")))
+    regressions = []
+    for scenario, results in report["results"].items():
+        for metric, value in results.items():
+            old = baseline["results"].get(scenario, {}).get(metric)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            worse = -change if HIGHER_IS_BETTER[metric] else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            print("%-34s %12.2f %12.2f %+7.1f%%%s" % (scenario + "." + metric, old, value, 100 * change, flag))
+            if flag:
+                regressions.append(scenario + "." + metric)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--origins", type=int, default=5000)
+    parser.add_argument("--urban", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--ways", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--scenarios", default="route,download")
+    parser.add_argument("--tree", default=ROOT)
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--run", choices=["route", "download"], help=argparse.SUPPRESS)
+    parser.add_argument("--osrm-url", help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.tree = os.path.abspath(args.tree)
+    if args.run:
+        (run_route if args.run == "route" else run_download)(args)
+        return
+
+    scenarios = args.scenarios.split(",")
+    params = {"origins": args.origins, "urban": args.urban, "latency": args.latency, "latency_sigma": args.latency_sigma,
+              "error_rate": args.error_rate, "ways": args.ways, "repeat": args.repeat, "scenarios": scenarios}
+    report = {"commit": git_commit(args.tree), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": sys.version.split()[0], "params": params, "results": {}, "apis": {}}
+    workdir = tempfile.mkdtemp()
+    try:
+        for scenario, run in (("route", route_scenario), ("download", download_scenario)):
+            if scenario not in scenarios:
+                continue
+            result = run(args, workdir)
+            if "skipped" in result:
+                print(scenario + ": skipped, " + result["skipped"])
+                continue
+            report["apis"][scenario] = result.pop("apis")
+            report["results"][scenario] = result
+    finally:
+        shutil.rmtree(workdir)
+
+    for scenario, results in report["results"].items():
+        print(scenario + ": " + ", ".join("%s %.2f" % (k, v) for k, v in results.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(str(len(regressions)) + " metric(s) regressed by more than " + str(int(args.tolerance * 100)) + "%")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
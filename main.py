@@ -1,10 +1,31 @@
 from prefect import flow, serve, task
+from prefect_dask import DaskTaskRunner
 import time
 import os
 from datetime import datetime, timedelta
 import requests
 import subprocess
 import sys
+import glob
+import shutil
+from sourceData.pbfDownload import download, DownloadError
+from sourceData.osmUpdates import update_extract
+from osrmBuild import build_osrm
+
+def osmium_env():
+    #Note we're using the system executable here,
+    #which assumes the conda environment main.py is running on
+    #is the same one osmium is installed into.
+    conda_base = os.path.dirname(os.path.dirname(sys.executable))
+    env_bin_path = os.path.join(conda_base, 'envs', "pT", 'bin')
+    env = os.environ.copy()
+    env['PATH'] = f"{env_bin_path}:{env['PATH']}"
+    env['CONDA_PREFIX'] = os.path.join(conda_base, 'envs', "pT")
+    return env
+
+def pendingDiffs(PBFPATH):
+    #Replication diffs applied to a continent since the global PBF last took them in.
+    return PBFPATH + ".pending"
 
 @task(name="Continent Download",
       description="Function to download individual country files from geoFabrik",
@@ -12,7 +33,9 @@ import sys
       retries=2, retry_delay_seconds=5)
 def downloadContinent(continent: str = "none",
                       DOWNLOADPATH: str = "none",
-                      STALE_DAYS: int = 7):
+                      STALE_DAYS: int = 7,
+                      UPDATES: bool = True,
+                      MAX_DIFFS: int = 60):
     """
     A function which downloads the most recent continent-scale PBFs
     from geofabrik and saves them into a local directory.
@@ -20,30 +43,38 @@ def downloadContinent(continent: str = "none",
     Parameters:
     continent (string): The continent (topmost level) to retrieve data for.
     DOWNLOADPATH (string): The folder to output the retrieved PBF.
+    STALE_DAYS (int): Unused; staleness is decided by the server's ETag/Last-Modified.
+    UPDATES (bool): Update an existing PBF from geofabrik's daily replication diffs
+        rather than re-downloading it.  Falls back to a full download when the
+        file has no sequence number, is more than MAX_DIFFS days behind, or the
+        diff chain is broken.
+    MAX_DIFFS (int): Most diffs to apply before a full download is preferred.
 
     Returns:
     str: Either the path of the download, or raised error code.
     """
     FILEPATH = DOWNLOADPATH + continent + "-latest.osm.pbf"
 
-    if os.path.exists(FILEPATH):
-        file_mod_time = datetime.fromtimestamp(os.path.getmtime(FILEPATH))
-        if datetime.now() - file_mod_time < timedelta(days=STALE_DAYS):
-            print(str(FILEPATH) + ": Current file is less than "+str(STALE_DAYS)+" day(s) old. Skipping download.")
-            return(FILEPATH)
-
+    #Streams to a partial file, resumes after interruptions, checks the .md5
+    #sidecar and only re-downloads when the server's ETag/Last-Modified change.
     url = "https://download.geofabrik.de/"+str(continent)+"-latest.osm.pbf"
-    response = requests.get(url)
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Open a local file in binary write mode
-        with open(FILEPATH, 'wb') as file:
-            # Write the content of the response to the file
-            file.write(response.content)
-        print(str(FILEPATH) + ": Successfully downloaded and updated.")
+    if UPDATES and os.path.exists(FILEPATH):
+        updatesUrl = "https://download.geofabrik.de/"+str(continent)+"-updates"
+        try:
+            if update_extract(FILEPATH, updatesUrl, FILEPATH + ".diffs", env=osmium_env(), max_diffs=MAX_DIFFS,
+                              keep=pendingDiffs(FILEPATH)):
+                return(FILEPATH)
+        #OSError covers a missing osmium binary and disk errors while applying diffs.
+        except (requests.exceptions.RequestException, subprocess.CalledProcessError, ValueError, OSError) as e:
+            print(str(FILEPATH) + ": Incremental update failed, falling back to a full download.  " + str(e))
+    #The kept diffs no longer describe how the file changed, so the global PBF is re-merged.
+    shutil.rmtree(pendingDiffs(FILEPATH), ignore_errors=True)
+    try:
+        if download(url, FILEPATH):
+            print(str(FILEPATH) + ": Successfully downloaded and updated.")
         return(FILEPATH)
-    else:
-        raise Exception(str(FILEPATH) + ": Error during download.  Status code: " + str(response.status_code))
+    except DownloadError as e:
+        raise Exception(str(FILEPATH) + ": Error during download.  " + str(e))
         
 
 
@@ -57,10 +88,11 @@ def downloadContinent(continent: str = "none",
 def downloadGlobe(CONTINENTS: list,
                   DOWNLOADPATH: str,
                   STALE_DAYS: int = 7,
+                  UPDATES: bool = True,
                   TIMESTAMP: str = str(datetime.now())):
     jobs = []
     for continent in CONTINENTS:
-        job = downloadContinent.submit(continent, DOWNLOADPATH)
+        job = downloadContinent.submit(continent, DOWNLOADPATH, STALE_DAYS, UPDATES)
         jobs.append(job)
     
     #Execute the jobs and collect results
@@ -77,29 +109,52 @@ def buildGlobalPBF(CONTINENTS: list,
                    DOWNLOADPATH: str,
                    GLOBALPBFPATH: str,
                    STALE_DAYS: int = 7):
+    """
+    Builds the global PBF from the continent PBFs.  If every continent that
+    changed since the last build was only updated from replication diffs,
+    those diffs (kept by downloadContinent) are applied to the global PBF with
+    osmium apply-changes; a continent that was downloaded in full needs a
+    full osmium merge.
+    """
+    inputs = [DOWNLOADPATH + continent + "-latest.osm.pbf" for continent in CONTINENTS]
+    env = osmium_env()
 
     if os.path.exists(GLOBALPBFPATH):
         file_mod_time = datetime.fromtimestamp(os.path.getmtime(GLOBALPBFPATH))
         if datetime.now() - file_mod_time < timedelta(days=STALE_DAYS):
             print(str(GLOBALPBFPATH) + ": Current file is less than "+str(STALE_DAYS)+" day(s) old. Skipping download.")
             return(GLOBALPBFPATH)
-    
-    
-    #Note we're using the system executable here,
-    #which assumes the conda environment main.py is running on
-    #is the same one osmium is installed into.
-    conda_base = os.path.dirname(os.path.dirname(sys.executable))
-    env_bin_path = os.path.join(conda_base, 'envs', "pT", 'bin')
-    env = os.environ.copy()
-    env['PATH'] = f"{env_bin_path}:{env['PATH']}"
-    env['CONDA_PREFIX'] = os.path.join(conda_base, 'envs', "pT")
-    
+        #With incremental updates most runs change nothing; only rebuild if a continent did.
+        changed = [p for p in inputs if os.path.exists(p) and os.path.getmtime(p) > os.path.getmtime(GLOBALPBFPATH)]
+        if not changed:
+            print(str(GLOBALPBFPATH) + ": No continent has changed since the last merge. Skipping merge.")
+            return(GLOBALPBFPATH)
+        diffs = {p: sorted(glob.glob(os.path.join(pendingDiffs(p), "*.osc.gz"))) for p in changed}
+        downloaded = [p for p in changed if not diffs[p]]
+        if not downloaded:
+            #apply-changes sorts all the diffs together and keeps each object's latest version.
+            updated = GLOBALPBFPATH + ".updated.osm.pbf"
+            changes = [d for p in changed for d in diffs[p]]
+            command = ["osmium", "apply-changes", GLOBALPBFPATH] + changes + ["--overwrite", "-o", updated]
+            try:
+                subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                os.replace(updated, GLOBALPBFPATH)
+                print(str(GLOBALPBFPATH) + ": Applied " + str(len(changes)) + " diffs from " + str(len(changed)) + " continent(s).")
+                for p in inputs:
+                    shutil.rmtree(pendingDiffs(p), ignore_errors=True)
+                return(GLOBALPBFPATH)
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(str(GLOBALPBFPATH) + ": Applying diffs failed, falling back to a full merge.  " + str(e))
+        else:
+            print(str(GLOBALPBFPATH) + ": Downloaded in full since the last merge: " + ", ".join(downloaded) + ".  Merging.")
+
     #Build the command
     command = []
     command.append("osmium")
     command.append("merge")
     for continent in CONTINENTS:
         command.append(DOWNLOADPATH + continent + "-latest.osm.pbf")
+    command.append("--overwrite")
     command.append("-o")
     command.append(GLOBALPBFPATH)
 
@@ -107,6 +162,9 @@ def buildGlobalPBF(CONTINENTS: list,
     try:
         result = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         print("Output:\n", result.stdout)
+        #The merge took in every continent as it is now.
+        for p in inputs:
+            shutil.rmtree(pendingDiffs(p), ignore_errors=True)
         return(GLOBALPBFPATH)
     except subprocess.CalledProcessError as e:
         print("An error occurred:", e)
@@ -114,6 +172,71 @@ def buildGlobalPBF(CONTINENTS: list,
 
     print(DOWNLOADPATH)
 
+@task(name="OSRM Preprocessing",
+      description="osrm-extract, osrm-partition and osrm-customize for one PBF",
+      task_run_name="osrm-{PBFPATH}",
+      log_prints=True)
+def preprocessOSRM(PBFPATH: str,
+                   PROFILE: str = "/opt/car.lua",
+                   SPEEDFILES: list = [],
+                   THREADS: int = 8,
+                   OSRMBIN: str = None):
+    """
+    Builds the MLD routing files for a PBF, skipping the build if neither
+    the PBF nor the profile changed (and only re-customizing if just the
+    speed files did).
+
+    Parameters:
+    PBFPATH (string): The PBF to preprocess; outputs are written next to it.
+    PROFILE (string): The OSRM profile (car.lua).
+    SPEEDFILES (list): Optional segment speed CSVs for osrm-customize.
+    THREADS (int): Threads for each OSRM tool.
+    OSRMBIN (string): Folder holding the osrm-* binaries; None uses PATH.
+
+    Returns:
+    str: SKIP, CUSTOMIZE or FULL.
+    """
+    try:
+        return(build_osrm(PBFPATH, PROFILE, SPEEDFILES, threads=THREADS, bindir=OSRMBIN))
+    except subprocess.CalledProcessError as e:
+        print("An error occurred:", e)
+        raise Exception("Error output:\n", e.stderr)
+
+
+@flow(name="OSRM Preprocessing Flow",
+      description="Build OSRM routing files for each continent (or the global PBF) in parallel.",
+      flow_run_name="{TIMESTAMP}",
+      log_prints=True)
+def osrmPreprocess(PBFPATHS: list,
+                   PROFILE: str = "/opt/car.lua",
+                   SPEEDFILES: list = [],
+                   THREADS: int = 8,
+                   OSRMBIN: str = None,
+                   TIMESTAMP: str = str(datetime.now())):
+    jobs = []
+    for pbf in PBFPATHS:
+        job = preprocessOSRM.submit(pbf, PROFILE, SPEEDFILES, THREADS, OSRMBIN)
+        jobs.append(job)
+
+    results = []
+    for j in jobs:
+        results.append(j.result())
+
+    print(dict(zip(PBFPATHS, results)))
+    return(results)
+
+
+def osrmRunner(builds: int,
+               THREADS: int,
+               BUILD_MEMORY_GB: int,
+               NODE_CPUS: int,
+               NODE_MEMORY_GB: int):
+    #OSRM runs in subprocesses, so Dask can't cap its memory; instead run only
+    #as many builds at once as the node has cores and memory for.
+    workers = max(1, min(builds, NODE_CPUS // THREADS, NODE_MEMORY_GB // BUILD_MEMORY_GB))
+    return(DaskTaskRunner(cluster_kwargs={"n_workers": workers, "threads_per_worker": 1}))
+
+
 @flow(name="globalRoads main",
       description="Full download and build for globalRoads products.",
       flow_run_name="{TIMESTAMP}",
@@ -125,8 +248,26 @@ def globalRoads(TIMESTAMP: str = str(datetime.now())):
     DOWNLOADPATH = "/sciclone/geograd/globalRoads/sourceData/"
     GLOBALPBFPATH = "/sciclone/geograd/globalRoads/globalPBF/global-latest-osm.pbf"
     STALE_DAYS = 7
-    downloads = downloadGlobe(CONTINENTS,DOWNLOADPATH,STALE_DAYS)
-    buildGlobalPBF.submit(CONTINENTS, DOWNLOADPATH, GLOBALPBFPATH, STALE_DAYS, wait_for=[downloads])
+    UPDATES = True
+
+    #OSRM preprocessing: per continent, or once on the merged global PBF.
+    OSRM_GLOBAL = False
+    OSRM_PROFILE = "/opt/car.lua"
+    OSRM_SPEEDFILES = []
+    OSRM_THREADS = 16
+    OSRM_BUILD_MEMORY_GB = 64
+    NODE_CPUS = 64
+    NODE_MEMORY_GB = 256
+
+    downloads = downloadGlobe(CONTINENTS,DOWNLOADPATH,STALE_DAYS,UPDATES)
+    merged = buildGlobalPBF.submit(CONTINENTS, DOWNLOADPATH, GLOBALPBFPATH, STALE_DAYS, wait_for=[downloads])
+
+    if OSRM_GLOBAL:
+        PBFPATHS = [merged.result()]
+    else:
+        PBFPATHS = [DOWNLOADPATH + continent + "-latest.osm.pbf" for continent in CONTINENTS]
+    runner = osrmRunner(len(PBFPATHS), OSRM_THREADS, OSRM_BUILD_MEMORY_GB, NODE_CPUS, NODE_MEMORY_GB)
+    osrmPreprocess.with_options(task_runner=runner)(PBFPATHS, OSRM_PROFILE, OSRM_SPEEDFILES, OSRM_THREADS)
 
 if __name__ == "__main__":
     globalRoads()
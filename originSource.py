@@ -0,0 +1,218 @@
+import json
+import os
+
+import geopandas
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+
+#Origins read (and handed to routing) per chunk; memory use scales with this,
+#not with the size of the grid.
+CHUNK_ROWS = 100000
+
+#Little-endian 2D WKB Point: byte order, geometry type, x, y.
+WKB_POINT = np.dtype([("order", "u1"), ("type", "<u4"), ("x", "<f8"), ("y", "<f8")])
+
+class _XY:
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+class Origin:
+    """One origin as the routing stage sees it: .geometry.x/.geometry.y and origin["PID"].
+
+    A lightweight stand-in for the pandas Series iterrows() builds per row.
+    """
+    __slots__ = ("geometry", "pid")
+
+    def __init__(self, x, y, pid):
+        self.geometry = _XY(x, y)
+        self.pid = pid
+
+    def __getitem__(self, key):
+        if key != "PID":
+            raise KeyError(key)
+        return self.pid
+
+def origin_rows(lon, lat, pids):
+    """Origins for coordinate and PID arrays, as plain Python numbers."""
+    return [Origin(x, y, pid) for x, y, pid in zip(lon.tolist(), lat.tolist(), pids.tolist())]
+
+def point_coordinates(wkb):
+    """(x, y) float arrays from a pyarrow binary array of WKB points.
+
+    Little-endian 2D points (what GDAL, geopandas and point_wkb write) are
+    decoded straight from the Arrow buffer; anything else goes through shapely.
+    """
+    wkb = wkb.combine_chunks() if isinstance(wkb, pa.ChunkedArray) else wkb
+    n = len(wkb)
+    if n and wkb.null_count == 0 and wkb.type in (pa.binary(), pa.large_binary()):
+        offsets = np.frombuffer(wkb.buffers()[1], dtype=np.int32 if wkb.type == pa.binary() else np.int64)[wkb.offset:wkb.offset + n + 1]
+        if offsets[-1] - offsets[0] == n * WKB_POINT.itemsize and np.all(np.diff(offsets) == WKB_POINT.itemsize):
+            data = np.frombuffer(wkb.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]]
+            points = data.view(WKB_POINT)
+            if np.all(points["order"] == 1) and np.all(points["type"] == 1):
+                return points["x"].copy(), points["y"].copy()
+    coords = shapely.get_coordinates(shapely.from_wkb(wkb.to_numpy(zero_copy_only=False)))
+    return coords[:, 0], coords[:, 1]
+
+def point_wkb(x, y):
+    #The inverse of point_coordinates: a pyarrow binary array of WKB points.
+    points = np.empty(len(x), dtype=WKB_POINT)
+    points["order"] = 1
+    points["type"] = 1
+    points["x"] = x
+    points["y"] = y
+    offsets = np.arange(len(x) + 1, dtype=np.int32) * WKB_POINT.itemsize
+    return pa.Array.from_buffers(pa.binary(), len(x), [None, pa.py_buffer(offsets), pa.py_buffer(points.tobytes())])
+
+def geoparquet_point_metadata(crs="EPSG:4326"):
+    return {"version": "1.0.0", "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"], "crs": CRS.from_user_input(crs).to_json_dict()}}}
+
+class OriginSource:
+    """Origin points read from a GeoParquet file (or dataset) or any OGR format, chunk_rows at a time.
+
+    Each chunk is reprojected to EPSG:4326 in one vectorized call, so memory
+    stays flat however large the grid is.  crs is the source CRS when the
+    file doesn't declare one (the degurba GeoJSONs are Mollweide without
+    saying so).  bbox (xmin, ymin, xmax, ymax, in EPSG:4326) and pid_range
+    (pid_min, pid_max, inclusive) restrict the origins read; where the format
+    allows, they are pushed down to the reader (Parquet row-group statistics
+    for PIDs, which skip most of a file written in PID order, and the OGR
+    spatial index for the bbox).
+    """
+
+    def __init__(self, path, crs=None, bbox=None, pid_range=None, chunk_rows=CHUNK_ROWS, id_column="PID"):
+        self.path = path
+        self.crs = crs
+        self.bbox = bbox
+        self.pid_range = pid_range
+        self.chunk_rows = chunk_rows
+        self.id_column = id_column
+        self.parquet = os.path.isdir(path) or path.endswith(".parquet")
+
+    def subset(self, bbox=None, pid_range=None):
+        """A source over the same file restricted to bbox and/or pid_range."""
+        return OriginSource(self.path, self.crs, bbox if bbox is not None else self.bbox,
+                            pid_range if pid_range is not None else self.pid_range, self.chunk_rows, self.id_column)
+
+    def source_crs(self):
+        if self.crs is not None:
+            return CRS.from_user_input(self.crs)
+        if self.parquet:
+            geo = json.loads(ds.dataset(self.path, format="parquet").schema.metadata[b"geo"])
+            crs = geo["columns"][geo["primary_column"]].get("crs")
+            #GeoParquet: no crs key means OGC:CRS84.
+            return CRS.from_user_input(crs if crs is not None else "OGC:CRS84")
+        crs = pyogrio.read_info(self.path)["crs"]
+        return CRS.from_user_input(crs if crs is not None else "EPSG:4326")
+
+    def raw_batches(self, geometry=True):
+        #(x, y, pids) in the source CRS; x and y are None without geometry.
+        if self.parquet:
+            dataset = ds.dataset(self.path, format="parquet")
+            geometryName = json.loads(dataset.schema.metadata[b"geo"])["primary_column"]
+            columns = [self.id_column] + ([geometryName] if geometry else [])
+            expr = None
+            if self.pid_range is not None:
+                expr = (pc.field(self.id_column) >= self.pid_range[0]) & (pc.field(self.id_column) <= self.pid_range[1])
+            #One batch in flight at a time, and no pre-buffering of whole files,
+            #keeps memory at about one chunk.
+            for batch in dataset.to_batches(columns=columns, filter=expr, batch_size=self.chunk_rows,
+                                            batch_readahead=1, fragment_readahead=1,
+                                            fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=False)):
+                pids = batch.column(self.id_column).to_numpy(zero_copy_only=False)
+                if geometry:
+                    x, y = point_coordinates(batch.column(geometryName))
+                    yield x, y, pids
+                else:
+                    yield None, None, pids
+            return
+        where = None
+        if self.pid_range is not None:
+            where = self.id_column + " >= " + str(int(self.pid_range[0])) + " AND " + self.id_column + " <= " + str(int(self.pid_range[1]))
+        bbox = None
+        if self.bbox is not None:
+            bbox = Transformer.from_crs("EPSG:4326", self.source_crs(), always_xy=True).transform_bounds(*self.bbox, densify_pts=21)
+        with pyogrio.open_arrow(self.path, columns=[self.id_column], where=where, bbox=bbox, batch_size=self.chunk_rows,
+                                read_geometry=geometry, use_pyarrow=True) as (meta, reader):
+            for batch in reader:
+                pids = batch.column(self.id_column).to_numpy(zero_copy_only=False)
+                if geometry:
+                    x, y = point_coordinates(batch.column(meta["geometry_name"] or "wkb_geometry"))
+                    yield x, y, pids
+                else:
+                    yield None, None, pids
+
+    def chunks(self):
+        """Yield (lon, lat, pids) arrays in EPSG:4326, chunk_rows origins at most."""
+        crs = self.source_crs()
+        transformer = None
+        if not crs.equals(CRS.from_user_input("OGC:CRS84"), ignore_axis_order=True):
+            transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+        for x, y, pids in self.raw_batches():
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            if self.bbox is not None:
+                xmin, ymin, xmax, ymax = self.bbox
+                keep = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+                x, y, pids = x[keep], y[keep], pids[keep]
+            if len(pids):
+                yield x, y, pids
+
+    def frames(self):
+        """Yield the chunks as GeoDataFrames with a PID column, as processPoints takes them."""
+        for lon, lat, pids in self.chunks():
+            yield geopandas.GeoDataFrame({self.id_column: pids}, geometry=geopandas.points_from_xy(lon, lat), crs="EPSG:4326")
+
+    def read(self):
+        """All origins in the source as one GeoDataFrame; for subsets (a PID range), not whole grids."""
+        frames = list(self.frames())
+        if not frames:
+            return geopandas.GeoDataFrame({self.id_column: np.empty(0, dtype=np.int64)},
+                                          geometry=geopandas.points_from_xy([], []), crs="EPSG:4326")
+        return geopandas.GeoDataFrame({self.id_column: np.concatenate([f[self.id_column].values for f in frames])},
+                                      geometry=geopandas.points_from_xy(np.concatenate([f.geometry.x.values for f in frames]),
+                                                                        np.concatenate([f.geometry.y.values for f in frames])),
+                                      crs="EPSG:4326")
+
+    def pids(self):
+        """Every PID in the source (reading no geometry unless a bbox needs it)."""
+        if self.bbox is not None:
+            parts = [pids for lon, lat, pids in self.chunks()]
+        else:
+            parts = [pids for x, y, pids in self.raw_batches(geometry=False)]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def write_parquet(self, path, row_group_size=CHUNK_ROWS):
+        """Stream the source, reprojected to EPSG:4326, into a GeoParquet file (PID and point geometry).
+
+        Returns the number of origins written.
+        """
+        schema = None
+        writer = None
+        rows = 0
+        try:
+            for lon, lat, pids in self.chunks():
+                batch = pa.RecordBatch.from_arrays([pa.array(pids), point_wkb(lon, lat)], names=[self.id_column, "geometry"])
+                if writer is None:
+                    schema = batch.schema.with_metadata({b"geo": json.dumps(geoparquet_point_metadata()).encode()})
+                    writer = pq.ParquetWriter(path, schema, compression="snappy")
+                writer.write_batch(batch.cast(schema), row_group_size=row_group_size)
+                rows = rows + len(pids)
+            if writer is None:
+                schema = pa.schema([(self.id_column, pa.int64()), ("geometry", pa.binary())],
+                                   metadata={b"geo": json.dumps(geoparquet_point_metadata()).encode()})
+                writer = pq.ParquetWriter(path, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
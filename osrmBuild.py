@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import subprocess
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    """Content hash of a file, remembered in a <path>.sha256 sidecar.
+
+    The sidecar is reused while the file's size and mtime are unchanged, so a
+    continent PBF is only re-read after it has actually been rewritten.
+    """
+    stat = os.stat(path)
+    sidecar = path + ".sha256"
+    try:
+        with open(sidecar, "r") as f:
+            cached = json.load(f)
+        if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    try:
+        with open(sidecar + ".tmp", "w") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}, f)
+        os.replace(sidecar + ".tmp", sidecar)
+    except OSError:
+        pass
+    return digest
+
+def combined_key(*parts):
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+def osrm_base(pbfPath):
+    """The .osrm base path osrm-extract writes for a PBF: asia.osm.pbf -> asia.osrm."""
+    for suffix in (".osm.pbf", ".pbf"):
+        if pbfPath.endswith(suffix):
+            return pbfPath[:-len(suffix)] + ".osrm"
+    return pbfPath + ".osrm"
+
+def read_manifest(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(path, manifest):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def run_osrm(tool, args, bindir=None, env=None, log=print):
+    executable = os.path.join(bindir, tool) if bindir else tool
+    command = [executable] + [str(a) for a in args]
+    log("Running: " + " ".join(command))
+    result = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return result.stdout
+
+def build_osrm(pbfPath, profilePath, speedFiles=(), turnPenaltyFiles=(), threads=8, bindir=None, env=None, log=print):
+    """Run osrm-extract / osrm-partition / osrm-customize (MLD) for one PBF, skipping what is current.
+
+    Builds are keyed on content hashes, recorded in <base>.osrm.build.json:
+    the extract key is the PBF hash plus the profile (car.lua) hash, and the
+    customize key is the extract key plus the hashes of the traffic/speed
+    files.  An unchanged region is skipped entirely; if only speedFiles or
+    turnPenaltyFiles changed, osrm-customize is re-run on the existing
+    partition.
+
+    Returns "SKIP", "CUSTOMIZE" or "FULL" for what was run.
+    """
+    base = osrm_base(pbfPath)
+    manifestPath = base + ".build.json"
+    manifest = read_manifest(manifestPath)
+
+    extractKey = combined_key("pbf=" + file_sha256(pbfPath), "profile=" + file_sha256(profilePath))
+    customizeKey = combined_key(extractKey,
+                                *["speed=" + file_sha256(p) for p in speedFiles],
+                                *["turn=" + file_sha256(p) for p in turnPenaltyFiles])
+
+    ran = "SKIP"
+    if manifest.get("extract") != extractKey or not os.path.exists(base + ".partition"):
+        log(str(pbfPath) + ": Input or profile changed; running full OSRM preprocessing.")
+        manifest = {}
+        write_manifest(manifestPath, manifest)
+        run_osrm("osrm-extract", ["-p", profilePath, "-t", threads, pbfPath], bindir, env, log)
+        run_osrm("osrm-partition", ["-t", threads, base], bindir, env, log)
+        manifest["extract"] = extractKey
+        manifest["pbf"] = os.path.basename(pbfPath)
+        manifest["profile"] = profilePath
+        write_manifest(manifestPath, manifest)
+        ran = "FULL"
+
+    if manifest.get("customize") != customizeKey or not os.path.exists(base + ".cell_metrics"):
+        if ran == "SKIP":
+            log(str(pbfPath) + ": Only speed data changed; re-running osrm-customize.")
+            ran = "CUSTOMIZE"
+        args = ["-t", threads]
+        for p in speedFiles:
+            args = args + ["--segment-speed-file", p]
+        for p in turnPenaltyFiles:
+            args = args + ["--turn-penalty-file", p]
+        run_osrm("osrm-customize", args + [base], bindir, env, log)
+        manifest["customize"] = customizeKey
+        manifest["speedFiles"] = [os.path.basename(p) for p in speedFiles]
+        manifest["turnPenaltyFiles"] = [os.path.basename(p) for p in turnPenaltyFiles]
+        write_manifest(manifestPath, manifest)
+
+    if ran == "SKIP":
+        log(str(pbfPath) + ": OSRM files are current. Skipping preprocessing.")
+    return ran
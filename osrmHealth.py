@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import routingMetrics
+
+#Consecutive failed requests that open a server's breaker, how long it then
+#stays open before a probe request is let through, and the longest that wait
+#grows to while probes keep failing.
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECONDS = 10
+BREAKER_MAX_RESET_SECONDS = 120
+#Retries allowed per request made, on average, plus a reserve for quiet periods.
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_RESERVE = 10
+RETRY_BUDGET_MAX = 100
+#Upper bound (seconds) on a single jittered backoff.
+BACKOFF_CAP = 30
+#How often (seconds) a request refused while a probe is in flight checks
+#whether the probe found the server back.
+PROBE_POLL_SECONDS = 0.05
+
+class CircuitBreaker:
+    """Client-side circuit breaker for one OSRM server.
+
+    Closed, every request goes through.  After `failure_threshold` failures in
+    a row it opens and requests are refused (the caller should give up on them
+    rather than wait) for `reset_seconds`.  Then a single probe request is let
+    through: if it succeeds the breaker closes, if it fails the breaker opens
+    again for twice as long, up to `max_reset_seconds`.  Requests refused
+    while the probe is in flight can wait for its outcome (see probing).
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS,
+                 max_reset_seconds=BREAKER_MAX_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.reset = reset_seconds
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print("OSRM " + self.name + " is answering again; circuit closed.")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.reset = self.reset_seconds
+
+    def record_failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.probing:
+                self.probing = False
+                self.opened_at = time.monotonic()
+                self.reset = min(self.reset * 2, self.max_reset_seconds)
+            elif self.opened_at is None and self.failures >= self.failure_threshold:
+                print("OSRM " + self.name + ": " + str(self.failures) + " failures in a row; circuit open for " + str(self.reset) + " s.")
+                routingMetrics.metrics.inc("breaker_opened")
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Give back a probe that ended without an answer, so the next request can probe instead."""
+        with self.lock:
+            self.probing = False
+
+    def retry_after(self):
+        """Seconds until the breaker lets a request through again (0 if closed)."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset - time.monotonic())
+
+class RetryBudget:
+    """Token bucket limiting retries to a fraction of requests across all clients in the process.
+
+    Every request deposits `ratio` tokens and every retry withdraws one, so
+    when most requests fail (OSRM is down, not just flaky) retries stop
+    instead of multiplying the load.  The bucket starts with `reserve` tokens.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, reserve=RETRY_BUDGET_RESERVE, maximum=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = float(reserve)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens = self.tokens - 1
+            return True
+
+def backoff(retry, base_wait, cap=BACKOFF_CAP):
+    #"Full jitter": a uniform wait up to the exponential bound, so workers that
+    #failed together don't all retry together.
+    return random.uniform(0, min(cap, base_wait * (2 ** retry)))
+
+_breakers = {}
+_lock = threading.Lock()
+budget = RetryBudget()
+
+def breaker_for(url):
+    """The shared CircuitBreaker for the server url points at."""
+    name = urlsplit(url).netloc
+    with _lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+def wait_for_recovery(max_wait, log=print):
+    """Sleep until no breaker is open any more, or for max_wait seconds at most."""
+    with _lock:
+        breakers = list(_breakers.values())
+    wait = min(max([b.retry_after() for b in breakers], default=0.0), max_wait)
+    if wait > 0:
+        log("Waiting " + str(round(wait, 1)) + " s for OSRM to recover.")
+        time.sleep(wait)
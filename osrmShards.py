@@ -0,0 +1,93 @@
+import geopandas
+import numpy as np
+import shapely
+
+#Degrees of latitude per kilometer; buffers are applied in lon/lat degrees.
+KM_DEGREES = 1 / 111.32
+
+class ShardMap:
+    """Map from regions to the osrm-routed server holding their roads.
+
+    Each shard has a core polygon (the area it is responsible for) and a
+    coverage polygon: the core grown by buffer_km, which must match the extract
+    the server was built from, so that routes near a border can be computed by
+    either neighbour.
+
+    assign() picks a server for each origin and its candidates:
+      1. the origin's home shard (the one whose core contains it, else the
+         nearest core) if its coverage holds the origin and every candidate;
+      2. otherwise any other shard whose coverage holds all of them;
+      3. otherwise fallback_url, if one is configured (e.g. a larger server);
+      4. otherwise the home shard, with the candidates outside its coverage
+         dropped (they count as unroutable).  If none of the candidates are
+         covered all of them are sent, and OSRM snaps them to the shard's edge.
+    """
+
+    def __init__(self, names, urls, cores, buffer_km=0, fallback_url=None):
+        self.names = list(names)
+        self.urls = list(urls)
+        self.cores = np.asarray(cores, dtype=object)
+        self.coverage = shapely.buffer(self.cores, np.asarray(buffer_km, dtype=np.float64) * KM_DEGREES)
+        for geom in list(self.cores) + list(self.coverage):
+            shapely.prepare(geom)
+        self.fallback_url = fallback_url
+        self.urbanCovered = None
+
+    @classmethod
+    def from_geojson(cls, path, fallback_url=None):
+        """Load shards from a GeoJSON of polygons with "name", "url" and optional "buffer_km" properties."""
+        shards = geopandas.read_file(path)
+        if shards.crs is not None:
+            shards = shards.to_crs(epsg=4326)
+        buffer_km = shards["buffer_km"].fillna(0).values if "buffer_km" in shards else 0
+        return cls(shards["name"], shards["url"], shards.geometry.values, buffer_km, fallback_url)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def index_candidates(self, urbanPoints):
+        #Which shards cover each urban centroid, as a (n_shards, n_urban) array.
+        x = urbanPoints.geometry.x.values
+        y = urbanPoints.geometry.y.values
+        self.urbanCovered = np.array([shapely.contains_xy(c, x, y) for c in self.coverage]).reshape(len(self), len(x))
+
+    def home(self, lon, lat):
+        """Home shard position for each origin: the core containing it, else the nearest core."""
+        inCore = np.array([shapely.contains_xy(c, lon, lat) for c in self.cores]).reshape(len(self), len(lon))
+        home = np.argmax(inCore, axis=0)
+        outside = ~inCore.any(axis=0)
+        if outside.any():
+            points = shapely.points(lon[outside], lat[outside])
+            distances = np.array([shapely.distance(c, points) for c in self.cores]).reshape(len(self), -1)
+            home[outside] = np.argmin(distances, axis=0)
+        return home
+
+    def assign(self, lon, lat, positions):
+        """Server URL and candidate mask for a batch of origins.
+
+        positions are the UrbanIndex.query() candidate positions (n, k) for
+        origins at lon/lat.  Returns (urls, keep): a list of n base URLs and an
+        (n, k) bool array of the candidates to route (see rule 4 above).
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        positions = np.asarray(positions)
+        candidatesCovered = self.urbanCovered[:, positions]
+        originCovered = np.array([shapely.contains_xy(c, lon, lat) for c in self.coverage]).reshape(len(self), len(lon))
+        full = originCovered & candidatesCovered.all(axis=2)
+        home = self.home(lon, lat)
+
+        urls = []
+        keep = np.ones(positions.shape, dtype=bool)
+        for i, h in enumerate(home):
+            if full[h, i]:
+                urls.append(self.urls[h])
+            elif full[:, i].any():
+                urls.append(self.urls[int(np.argmax(full[:, i]))])
+            elif self.fallback_url is not None:
+                urls.append(self.fallback_url)
+            else:
+                urls.append(self.urls[h])
+                if candidatesCovered[h, i].any():
+                    keep[i] = candidatesCovered[h, i]
+        return urls, keep
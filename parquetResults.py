@@ -0,0 +1,333 @@
+import argparse
+import atexit
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import routingMetrics
+from originSource import geoparquet_point_metadata, point_wkb
+from resultWriter import COLUMNS, ResultWriter
+from workQueue import worker_name
+
+#roadresults as typed columns, plus the origin as a GeoParquet point.  As in
+#roadresults, "latitude"/"dest_latitude" hold the x (longitude) coordinate and
+#"longitude"/"dest_longitude" the y.  Total_Pop is fractional in the UCDB, so
+#total_population stays a float.
+RESULT_SCHEMA = pa.schema([("latitude", pa.float64()), ("longitude", pa.float64()), ("name", pa.string()),
+                           ("total_population", pa.float64()), ("urbanID", pa.int64()), ("distance", pa.float64()),
+                           ("traveltime", pa.float64()), ("dest_latitude", pa.float64()), ("dest_longitude", pa.float64()),
+                           ("dest_ID", pa.int64()), ("geometry", pa.binary())],
+                          metadata={b"geo": json.dumps(geoparquet_point_metadata()).encode()})
+
+#Shard files are written as <name>.parquet.part and renamed to
+#<name>.<min urbanID>_<max urbanID>.parquet once closed; readers (compaction,
+#done_pids) only ever see finished files.
+PART_SUFFIX = ".part"
+#Compacted datasets list each file's urbanID range in this file, so lookups
+#by PID only open the files that can hold them.
+MANIFEST = "_manifest.json"
+ANY_PID = (np.iinfo(np.int64).min, np.iinfo(np.int64).max)
+#Compacted datasets are Hive-partitioned by the origin's tile (see
+#sourceData/roadExtract.tile_ids) of this many degrees.
+TILE_DEGREES = 5.0
+
+def result_batch(columns):
+    """A RecordBatch of RESULT_SCHEMA from roadresults columns (arrays or lists, as write_columns takes them).
+
+    Values are cast safely, so a non-integral ID or a non-numeric distance
+    raises instead of being truncated.
+    """
+    arrays = [pa.array(columns[c], from_pandas=True).cast(RESULT_SCHEMA.field(c).type) for c in COLUMNS]
+    x = np.asarray(columns["latitude"], dtype=np.float64)
+    y = np.asarray(columns["longitude"], dtype=np.float64)
+    return pa.RecordBatch.from_arrays(arrays + [point_wkb(x, y)], schema=RESULT_SCHEMA)
+
+def shard_files(directory):
+    #Finished shards, oldest first: names start with the time they were started.
+    return sorted(glob.glob(os.path.join(directory, "*.parquet")))
+
+def shard_pid_range(path):
+    #(min, max) urbanID of a finished shard, from its name (see ParquetResultWriter.commit);
+    #shards named before ranges were recorded may hold any urbanID.
+    name = os.path.basename(path)[:-len(".parquet")]
+    if "." not in name:
+        return ANY_PID
+    low, high = name.rsplit(".", 1)[1].split("_")
+    return int(low), int(high)
+
+def dataset_files(datasetPath):
+    if not os.path.isdir(datasetPath):
+        return []
+    return sorted(glob.glob(os.path.join(datasetPath, "**", "*.parquet"), recursive=True))
+
+def dataset_manifest(datasetPath):
+    #{file: (min, max) urbanID} for a compacted dataset (see compact_results).
+    path = os.path.join(datasetPath, MANIFEST)
+    if not os.path.exists(path):
+        return {f: ANY_PID for f in dataset_files(datasetPath)}
+    with open(path) as f:
+        return {os.path.join(datasetPath, name): tuple(pids) for name, pids in json.load(f).items()}
+
+class ParquetResultWriter:
+    """Result sink writing roadresults rows as typed GeoParquet shard files instead of MariaDB rows.
+
+    Takes the same calls as ResultWriter (write, write_columns, flush, commit,
+    when_committed, close, done_pids).  Each writer owns its files in
+    directory, named after the time, worker_name() and a sequence number, so
+    any number of pods, worker processes and threads can share the directory.
+    Buffered rows are written to the open file as a row group once
+    row_group_rows are buffered and on flush().  Rows only become durable
+    when the file is committed: closed and renamed into place, with its
+    urbanID range in the name.  That happens once it holds file_rows rows,
+    when a row arrives more than flush_interval seconds after the last
+    commit, on commit() and on close/exit, so files stay large.  A crash
+    loses only the unfinished .part file, whose origins done_pids still
+    reports as not done.  compact_results merges the shards into one
+    deduplicated dataset.
+    """
+
+    def __init__(self, directory, dataset_path=None, row_group_rows=50000, file_rows=1000000,
+                 flush_interval=600, compression="snappy"):
+        self.directory = directory
+        self.dataset_path = dataset_path
+        self.row_group_rows = row_group_rows
+        self.file_rows = file_rows
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.name = worker_name()
+        self.sequence = 0
+        self.batches = []
+        self.buffered = 0
+        self.file = None
+        self.path = None
+        self.file_written = 0
+        self.pid_min = None
+        self.pid_max = None
+        self.pending = []
+        self.written = 0
+        self.last_commit = time.monotonic()
+        self.manifest = (None, {})
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.close)
+
+    def write(self, results):
+        self.write_columns({c: [results[c]] for c in COLUMNS})
+
+    def write_columns(self, columns):
+        """Buffer a batch of rows given as one array (or list) per column in COLUMNS."""
+        batch = result_batch(columns)
+        if batch.num_rows:
+            self.batches.append(batch)
+            self.buffered = self.buffered + batch.num_rows
+        if self.buffered >= self.row_group_rows:
+            self.flush()
+        if self.file_written >= self.file_rows or time.monotonic() - self.last_commit >= self.flush_interval:
+            self.commit()
+
+    def flush(self):
+        """Write the buffered rows to the open file as a row group (not yet durable; see commit)."""
+        if not self.batches:
+            return 0
+        table = pa.Table.from_batches(self.batches, schema=RESULT_SCHEMA)
+        with routingMetrics.metrics.timer("db_write"):
+            if self.file is None:
+                self.sequence = self.sequence + 1
+                self.path = os.path.join(self.directory, "%020d-%s-%05d" % (time.time_ns(), self.name, self.sequence))
+                self.file = pq.ParquetWriter(self.path + ".parquet" + PART_SUFFIX, RESULT_SCHEMA, compression=self.compression)
+            self.file.write_table(table, row_group_size=self.row_group_rows)
+        pids = table.column("urbanID")
+        low, high = pc.min(pids).as_py(), pc.max(pids).as_py()
+        self.pid_min = low if self.pid_min is None else min(self.pid_min, low)
+        self.pid_max = high if self.pid_max is None else max(self.pid_max, high)
+        count = self.buffered
+        self.file_written = self.file_written + count
+        self.batches = []
+        self.buffered = 0
+        return count
+
+    def commit(self):
+        """Finish the current file, making its rows durable; returns the number of rows committed."""
+        self.last_commit = time.monotonic()
+        self.flush()
+        count = 0
+        if self.file is not None:
+            with routingMetrics.metrics.timer("db_write"):
+                self.file.close()
+                os.replace(self.path + ".parquet" + PART_SUFFIX, self.path + "." + str(self.pid_min) + "_" + str(self.pid_max) + ".parquet")
+            count = self.file_written
+            self.written = self.written + count
+            routingMetrics.metrics.inc("db_rows", count)
+            self.file = None
+            self.file_written = 0
+            self.pid_min = None
+            self.pid_max = None
+        pending = self.pending
+        self.pending = []
+        for callback in pending:
+            callback()
+        return count
+
+    def when_committed(self, callback):
+        """Call callback() once every row written so far is durable: now if nothing is pending, else after the next commit."""
+        if self.file is None and not self.batches:
+            callback()
+        else:
+            self.pending.append(callback)
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def done_pids(self, pids):
+        """The subset of pids (as strings, like workQueue.done_pids) with a row in a finished shard or the compacted dataset.
+
+        Only files whose urbanID range (from shard names and the compacted
+        dataset's manifest) overlaps the pids are opened.
+        """
+        pids = np.unique(np.asarray(pids, dtype=np.int64))
+        if not len(pids):
+            return set()
+        low, high = pids[0].item(), pids[-1].item()
+        ranges = {path: shard_pid_range(path) for path in shard_files(self.directory)}
+        if self.dataset_path:
+            manifestPath = os.path.join(self.dataset_path, MANIFEST)
+            if not os.path.exists(manifestPath):
+                ranges.update(dataset_manifest(self.dataset_path))
+            else:
+                if os.path.getmtime(manifestPath) != self.manifest[0]:
+                    self.manifest = (os.path.getmtime(manifestPath), dataset_manifest(self.dataset_path))
+                ranges.update(self.manifest[1])
+        files = [path for path, (fileLow, fileHigh) in ranges.items() if fileLow <= high and fileHigh >= low]
+        if not files:
+            return set()
+        expr = (pc.field("urbanID") >= low) & (pc.field("urbanID") <= high) & pc.field("urbanID").isin(pa.array(pids))
+        table = ds.dataset(files, format="parquet", schema=RESULT_SCHEMA).to_table(columns=["urbanID"], filter=expr)
+        return set(str(p) for p in np.unique(table.column("urbanID").to_numpy()))
+
+def keep_last(urbanID, order):
+    #Positions of the row with the highest order for each urbanID, sorted by urbanID.
+    positions = np.lexsort((-order, urbanID))
+    first = np.ones(len(positions), dtype=bool)
+    first[1:] = urbanID[positions][1:] != urbanID[positions][:-1]
+    return positions[first]
+
+def compact_results(shardDir, datasetPath, tile_degrees=TILE_DEGREES, row_group_rows=100000, log=print):
+    """Merge the finished shards in shardDir into the compacted dataset at datasetPath.
+
+    The dataset is Hive-partitioned as tile=<n> by the origin's tile_degrees
+    cell, one file per tile sorted by urbanID.  Rows are deduplicated on
+    urbanID, keeping the most recent (a later shard wins over an earlier one
+    and over the existing dataset).  An origin's coordinates don't change, so
+    all of its rows share a tile and each tile is deduplicated on its own:
+    the shards are first spread into per-tile staging files, then each tile is
+    read, deduplicated and written, so memory is bounded by the largest tile.
+    The new dataset is built next to datasetPath and swapped into place, then
+    the merged shards are deleted; shards finished during the compaction are
+    left for the next one.  MANIFEST lists every file's urbanID range, for
+    done_pids.  Returns the number of rows in the dataset.
+    """
+    from sourceData.roadExtract import tile_ids
+    shards = shard_files(shardDir)
+    inputs = dataset_files(datasetPath) + shards
+    if not shards:
+        log("No shards to compact in " + shardDir + ".")
+        return None
+    stagePath = datasetPath + ".staging"
+    partPath = datasetPath + ".part"
+    for path in (stagePath, partPath):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def staged():
+        #Every row tagged with its tile and its position in input order.
+        for i, path in enumerate(inputs):
+            offset = 0
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=row_group_rows, columns=RESULT_SCHEMA.names):
+                order = (np.int64(i) << 32) + offset + np.arange(batch.num_rows, dtype=np.int64)
+                tiles = tile_ids(batch.column("latitude").to_numpy(), batch.column("longitude").to_numpy(), tile_degrees)
+                offset = offset + batch.num_rows
+                yield pa.RecordBatch.from_arrays(list(batch.columns) + [pa.array(order), pa.array(tiles, type=pa.int32())],
+                                                 names=RESULT_SCHEMA.names + ["_order", "tile"])
+
+    stageSchema = pa.schema(list(RESULT_SCHEMA) + [("_order", pa.int64()), ("tile", pa.int32())])
+    partitioning = ds.partitioning(pa.schema([("tile", pa.int32())]), flavor="hive")
+    ds.write_dataset(pa.RecordBatchReader.from_batches(stageSchema, staged()), stagePath, format="parquet",
+                     partitioning=partitioning, existing_data_behavior="overwrite_or_ignore")
+    log("Staged " + str(len(inputs)) + " files (" + str(len(shards)) + " new shards).")
+
+    rows = 0
+    duplicates = 0
+    manifest = {}
+    os.makedirs(partPath)
+    for tileDir in sorted(glob.glob(os.path.join(stagePath, "tile=*"))):
+        table = ds.dataset(tileDir, format="parquet").to_table()
+        keep = keep_last(table.column("urbanID").to_numpy(), table.column("_order").to_numpy())
+        table = table.take(pa.array(keep)).select(RESULT_SCHEMA.names).cast(RESULT_SCHEMA)
+        os.makedirs(os.path.join(partPath, os.path.basename(tileDir)))
+        pq.write_table(table, os.path.join(partPath, os.path.basename(tileDir), "part-0.parquet"), row_group_size=row_group_rows)
+        ids = table.column("urbanID")
+        manifest[os.path.basename(tileDir) + "/part-0.parquet"] = [pc.min(ids).as_py(), pc.max(ids).as_py()]
+        duplicates = duplicates + ds.dataset(tileDir, format="parquet").count_rows() - table.num_rows
+        rows = rows + table.num_rows
+    shutil.rmtree(stagePath)
+    with open(os.path.join(partPath, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+    oldPath = datasetPath + ".old"
+    if os.path.exists(datasetPath):
+        os.replace(datasetPath, oldPath)
+    os.replace(partPath, datasetPath)
+    if os.path.exists(oldPath):
+        shutil.rmtree(oldPath)
+    for path in shards:
+        os.remove(path)
+    log("Compacted " + str(len(shards)) + " shards into " + datasetPath + ": " + str(rows) + " rows, "
+        + str(duplicates) + " duplicates dropped.")
+    return rows
+
+def load_mariadb(datasetPath, conn, batch_rows=100000, load_data=True, table="roadresults", log=print):
+    """Bulk load a compacted dataset into roadresults, batch_rows rows per transaction.
+
+    Goes through ResultWriter, so with load_data each batch is one LOAD DATA
+    LOCAL INFILE (the connection needs local_infile=True).  Rows are
+    appended: load into an empty table, since the dataset is already
+    deduplicated but the table may hold some of the same origins.  Returns
+    the number of rows loaded.
+    """
+    dataset = ds.dataset(datasetPath, format="parquet", partitioning="hive")
+    with ResultWriter(conn, batch_size=batch_rows, flush_interval=float("inf"),
+                      load_data_rows=batch_rows if load_data else None, table=table) as writer:
+        for batch in dataset.to_batches(columns=COLUMNS, batch_size=batch_rows):
+            writer.write_columns({c: batch.column(c).to_numpy(zero_copy_only=False) for c in COLUMNS})
+            log("Loaded " + str(writer.written) + " rows.")
+    return writer.written
+
+if __name__ == "__main__":
+    import processDegurb
+    parser = argparse.ArgumentParser(description="Compact Parquet result shards, or load the compacted results into MariaDB.")
+    parser.add_argument("command", choices=["compact", "load"])
+    parser.add_argument("--shards", default=os.path.join(processDegurb.RESULTS_PATH, "shards"))
+    parser.add_argument("--dataset", default=os.path.join(processDegurb.RESULTS_PATH, "roadresults"))
+    args = parser.parse_args()
+    if args.command == "compact":
+        compact_results(args.shards, args.dataset)
+    else:
+        conn = processDegurb.connect_with_retry(processDegurb.mysql_config_db)
+        try:
+            print(load_mariadb(args.dataset, conn, processDegurb.LOAD_DATA_ROWS))
+        finally:
+            conn.close()
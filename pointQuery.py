@@ -0,0 +1,419 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
+
+from urbanIndex import EARTH_RADIUS, chord_to_meters, unit_vectors
+
+#Index tiles, in degrees.  At the 1 km degurba grid a 1 degree tile holds at
+#most ~12k origins, so a tile's KD-tree builds in a few milliseconds.
+TILE_DEGREES = 1.0
+#A query is answered from the nearest routed origin, if one is within
+#MAX_METERS (the grid spacing is 1 km, so ~700 m at most on land).
+MAX_METERS = 2000
+#Tiles (KD-tree plus position) kept in the in-process LRU.
+CACHE_TILES = 4096
+INDEX_PATH = os.getenv('POINT_INDEX_PATH', "/sciclone/geograd/_deployed/globalRoads/pointIndex")
+
+#Per-origin arrays of the index, one memory-mapped .npy file each.
+INDEX_COLUMNS = {"lon": np.float64, "lat": np.float64, "urbanID": np.int64, "distance": np.float64,
+                 "traveltime": np.float64, "dest_ID": np.int64}
+ROADRESULTS_COLUMNS = ["latitude", "longitude", "name", "total_population", "urbanID", "distance", "traveltime",
+                       "dest_latitude", "dest_longitude", "dest_ID"]
+
+def tile_xy(lon, lat, tile_degrees):
+    ncols = int(math.ceil(360.0 / tile_degrees))
+    tx = np.clip(np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / tile_degrees), 0, ncols - 1).astype(np.int64)
+    ty = np.clip(np.floor((np.asarray(lat, dtype=np.float64) + 90.0) / tile_degrees), 0, int(math.ceil(180.0 / tile_degrees)) - 1).astype(np.int64)
+    return ty * ncols + tx
+
+def tile_count(tile_degrees):
+    return int(math.ceil(360.0 / tile_degrees)) * int(math.ceil(180.0 / tile_degrees))
+
+def dataset_batches(datasetPath, batch_rows=100000):
+    """roadresults columns, batch by batch, from Parquet results (a compacted dataset or a shard directory; see parquetResults.py)."""
+    dataset = ds.dataset(datasetPath, format="parquet", partitioning="hive")
+    for batch in dataset.to_batches(columns=ROADRESULTS_COLUMNS, batch_size=batch_rows):
+        yield {c: batch.column(c).to_numpy(zero_copy_only=False) for c in ROADRESULTS_COLUMNS}
+
+def sql_batches(conn, batch_rows=100000, table="roadresults"):
+    """roadresults columns, batch by batch, from the MariaDB table.
+
+    Open conn with cursorclass=pymysql.cursors.SSCursor, so rows are streamed
+    rather than fetched into memory all at once.  roadresults stores
+    everything as text; numbers are parsed here.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT " + ", ".join(ROADRESULTS_COLUMNS) + " FROM " + table)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            values = list(zip(*rows))
+            columns = {c: np.asarray(values[i], dtype=np.float64) for i, c in enumerate(ROADRESULTS_COLUMNS) if c != "name"}
+            columns["name"] = np.asarray([str(v) for v in values[ROADRESULTS_COLUMNS.index("name")]], dtype=object)
+            yield columns
+
+def index_rows(columns):
+    #The index columns of a batch, rows without usable coordinates dropped.
+    lon = np.asarray(columns["latitude"], dtype=np.float64)
+    lat = np.asarray(columns["longitude"], dtype=np.float64)
+    keep = np.isfinite(lon) & np.isfinite(lat)
+    rows = {"lon": lon[keep], "lat": lat[keep]}
+    for c in ["urbanID", "distance", "traveltime", "dest_ID"]:
+        rows[c] = np.asarray(columns[c], dtype=np.float64)[keep].astype(INDEX_COLUMNS[c])
+    return rows, keep
+
+def build_index(batches, indexPath, tile_degrees=TILE_DEGREES, log=print):
+    """Build the point-query index at indexPath from completed results.
+
+    batches() returns an iterator of roadresults column batches
+    (dataset_batches or sql_batches); it is called twice, once to count the
+    origins per tile and once to place every origin in its tile's slot of
+    the memory-mapped column files, so memory stays at about one batch.
+    Duplicate urbanIDs keep the last row read.  The urban centres chosen are
+    stored once each in centres.parquet.  The index is built next to
+    indexPath and swapped into place when complete.  Returns the number of
+    origins indexed.
+    """
+    partPath = indexPath + ".part"
+    if os.path.exists(partPath):
+        shutil.rmtree(partPath)
+    os.makedirs(partPath)
+    ntiles = tile_count(tile_degrees)
+
+    counts = np.zeros(ntiles, dtype=np.int64)
+    for columns in batches():
+        rows, keep = index_rows(columns)
+        counts = counts + np.bincount(tile_xy(rows["lon"], rows["lat"], tile_degrees), minlength=ntiles)
+    total = int(counts.sum())
+    log("Counted " + str(total) + " origins in " + str(int(np.count_nonzero(counts))) + " tiles.")
+
+    starts = np.zeros(ntiles, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    arrays = {c: np.lib.format.open_memmap(os.path.join(partPath, c + ".npy"), mode="w+", dtype=t, shape=(total,))
+              for c, t in INDEX_COLUMNS.items()}
+    cursor = starts.copy()
+    centres = {}
+    placed = 0
+    for columns in batches():
+        rows, keep = index_rows(columns)
+        tiles = tile_xy(rows["lon"], rows["lat"], tile_degrees)
+        order = np.argsort(tiles, kind="stable")
+        sortedTiles = tiles[order]
+        positions = cursor[sortedTiles] + np.arange(len(order)) - np.searchsorted(sortedTiles, sortedTiles)
+        for c in INDEX_COLUMNS:
+            arrays[c][positions] = rows[c][order]
+        cursor = cursor + np.bincount(tiles, minlength=ntiles)
+        destIDs, first = np.unique(rows["dest_ID"], return_index=True)
+        for destID, i in zip(destIDs.tolist(), np.flatnonzero(keep)[first].tolist()):
+            if destID not in centres:
+                centres[destID] = (str(columns["name"][i]), float(columns["total_population"][i]),
+                                   float(columns["dest_latitude"][i]), float(columns["dest_longitude"][i]))
+        placed = placed + len(order)
+        log("Indexed " + str(placed) + " of " + str(total) + " origins.")
+
+    #Keep the last row of each urbanID within its tile (an origin only ever falls
+    #in one tile), and sort every tile by latitude for PointIndex.query.
+    duplicates = 0
+    for t in np.flatnonzero(counts > 1):
+        s, e = starts[t], starts[t] + counts[t]
+        ids = np.asarray(arrays["urbanID"][s:e])
+        unique, lastFromEnd = np.unique(ids[::-1], return_index=True)
+        kept = len(ids) - 1 - lastFromEnd
+        kept = kept[np.argsort(np.asarray(arrays["lat"][s:e])[kept], kind="stable")]
+        for c in INDEX_COLUMNS:
+            arrays[c][s:s + len(kept)] = np.asarray(arrays[c][s:e])[kept]
+        duplicates = duplicates + len(ids) - len(kept)
+        counts[t] = len(kept)
+    for a in arrays.values():
+        a.flush()
+    del arrays
+
+    np.save(os.path.join(partPath, "tile_start.npy"), starts)
+    np.save(os.path.join(partPath, "tile_count.npy"), counts)
+    ids = np.array(sorted(centres), dtype=np.int64)
+    pq.write_table(pa.table({"dest_ID": ids,
+                             "name": pa.array([centres[i][0] for i in ids.tolist()], type=pa.string()),
+                             "total_population": [centres[i][1] for i in ids.tolist()],
+                             "dest_latitude": [centres[i][2] for i in ids.tolist()],
+                             "dest_longitude": [centres[i][3] for i in ids.tolist()]}),
+                   os.path.join(partPath, "centres.parquet"))
+    with open(os.path.join(partPath, "index.json"), "w") as f:
+        json.dump({"tile_degrees": tile_degrees, "origins": int(counts.sum()), "duplicates": duplicates,
+                   "tiles": int(np.count_nonzero(counts)), "centres": len(ids), "built": time.time()}, f)
+
+    oldPath = indexPath + ".old"
+    if os.path.exists(indexPath):
+        os.replace(indexPath, oldPath)
+    os.replace(partPath, indexPath)
+    if os.path.exists(oldPath):
+        shutil.rmtree(oldPath)
+    log("Built " + indexPath + ": " + str(int(counts.sum())) + " origins, " + str(duplicates) + " duplicates dropped.")
+    return int(counts.sum())
+
+class PointIndex:
+    """Nearest-urban-centre lookups for any point, from an index written by build_index.
+
+    A query point is answered with the result of the nearest routed origin
+    within max_meters (origin_meters says how far that was), without OSRM or
+    MariaDB.  The per-origin columns are memory-mapped, so opening an index
+    reads next to nothing and pages are shared between processes; each tile's
+    KD-tree is built on first use and kept in an LRU of cache_tiles tiles.
+    Points near a tile edge are also looked up in the neighbouring tiles.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path, max_meters=MAX_METERS, cache_tiles=CACHE_TILES):
+        with open(os.path.join(path, "index.json")) as f:
+            self.meta = json.load(f)
+        self.tile_degrees = self.meta["tile_degrees"]
+        self.ncols = int(math.ceil(360.0 / self.tile_degrees))
+        self.nrows = int(math.ceil(180.0 / self.tile_degrees))
+        self.max_meters = max_meters
+        self.max_chord = 2 * math.sin(max_meters / (2 * EARTH_RADIUS))
+        self.margin = math.degrees(max_meters / EARTH_RADIUS)
+        self.cache_tiles = cache_tiles
+        #Plain ndarray views of the maps: indexing np.memmap itself is several times slower.
+        self.columns = {c: np.asarray(np.load(os.path.join(path, c + ".npy"), mmap_mode="r")) for c in INDEX_COLUMNS}
+        self.starts = np.load(os.path.join(path, "tile_start.npy"))
+        self.counts = np.load(os.path.join(path, "tile_count.npy"))
+        centres = pq.read_table(os.path.join(path, "centres.parquet"))
+        self.centre_ids = centres.column("dest_ID").to_numpy()
+        self.centres = {c: centres.column(c).to_numpy(zero_copy_only=False) for c in centres.column_names}
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.meta["origins"]
+
+    def tile(self, t):
+        """(KD-tree, first position, latitudes, unit vectors) for tile t from the LRU, or None if the tile has no origins."""
+        with self.lock:
+            entry = self.tiles.get(t)
+            if entry is not None:
+                self.tiles.move_to_end(t)
+                self.hits = self.hits + 1
+                return entry
+            self.misses = self.misses + 1
+        if self.counts[t] == 0:
+            return None
+        s, e = self.starts[t], self.starts[t] + self.counts[t]
+        lat = np.array(self.columns["lat"][s:e])
+        vectors = unit_vectors(self.columns["lon"][s:e], lat)
+        entry = (cKDTree(vectors), s, lat, vectors)
+        with self.lock:
+            self.tiles[t] = entry
+            while len(self.tiles) > self.cache_tiles:
+                self.tiles.popitem(last=False)
+        return entry
+
+    def near_tiles(self, lon, lat):
+        #(point, tile) pairs: every point's own tile plus the tiles its max_meters box reaches into.
+        n = len(lon)
+        marginLon = self.margin / np.maximum(np.cos(np.radians(lat)), 1e-6)
+        pairs = [tile_xy(lon, lat, self.tile_degrees)]
+        for dx, dy in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
+            pairs.append(tile_xy(lon + dx * marginLon, lat + dy * self.margin, self.tile_degrees))
+        tiles = np.concatenate(pairs)
+        points = np.tile(np.arange(n), len(pairs))
+        keep = self.counts[tiles] > 0
+        tiles, points = tiles[keep], points[keep]
+        order = np.lexsort((points, tiles))
+        tiles, points = tiles[order], points[order]
+        first = np.ones(len(tiles), dtype=bool)
+        first[1:] = (tiles[1:] != tiles[:-1]) | (points[1:] != points[:-1])
+        return points[first], tiles[first]
+
+    def query_batch(self, lon, lat):
+        """Look up many points at once; returns a dict of arrays.
+
+        found marks the points with an origin within max_meters; for the rest
+        the numeric columns are NaN (IDs -1) and name is None.  Columns are
+        urbanID (the origin used), origin_meters, distance and traveltime
+        (from that origin, as routed), and dest_ID, name, total_population,
+        dest_latitude and dest_longitude of its nearest urban centre.
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        n = len(lon)
+        bestChord = np.full(n, np.inf)
+        bestRow = np.full(n, -1, dtype=np.int64)
+        points, tiles = self.near_tiles(lon, lat)
+        if len(tiles):
+            vectors = unit_vectors(lon, lat)
+            bounds = np.flatnonzero(np.diff(tiles)) + 1
+            for group in np.split(np.arange(len(tiles)), bounds):
+                entry = self.tile(tiles[group[0]])
+                if entry is None:
+                    continue
+                tree, start = entry[:2]
+                chord, position = tree.query(vectors[points[group]], distance_upper_bound=self.max_chord)
+                better = chord < bestChord[points[group]]
+                bestChord[points[group][better]] = chord[better]
+                bestRow[points[group][better]] = start + position[better]
+        return self.results(bestRow, bestChord)
+
+    def query(self, lon, lat):
+        """Look up one point: a dict of the query_batch columns, or None if no origin is within max_meters.
+
+        A single point skips the KD-tree, whose per-call overhead dominates
+        here: tiles are sorted by latitude, so only the band of origins within
+        max_meters north or south of the point is compared with it.
+        """
+        lon = float(lon)
+        lat = float(lat)
+        marginLon = self.margin / max(math.cos(math.radians(lat)), 1e-6)
+        tiles = {self.tile_id(lon, lat)}
+        for dx in (-marginLon, marginLon):
+            for dy in (-self.margin, self.margin):
+                tiles.add(self.tile_id(lon + dx, lat + dy))
+        cosLat = math.cos(math.radians(lat))
+        vector = np.array([cosLat * math.cos(math.radians(lon)), cosLat * math.sin(math.radians(lon)), math.sin(math.radians(lat))])
+        bestSquared = self.max_chord ** 2
+        bestRow = -1
+        for t in tiles:
+            if not self.counts[t]:
+                continue
+            tree, start, lats, vectors = self.tile(t)
+            i0, i1 = lats.searchsorted((lat - self.margin, lat + self.margin)).tolist()
+            if i0 == i1:
+                continue
+            squared = np.square(vectors[i0:i1] - vector).sum(axis=1)
+            j = int(squared.argmin())
+            if squared[j] <= bestSquared:
+                bestSquared = squared[j]
+                bestRow = start + i0 + j
+        if bestRow < 0:
+            return None
+        bestChord = math.sqrt(bestSquared)
+        destID = self.columns["dest_ID"][bestRow].item()
+        centre = int(np.searchsorted(self.centre_ids, destID))
+        return {"found": True, "origin_meters": 2 * math.asin(min(bestChord / 2, 1)) * EARTH_RADIUS,
+                "urbanID": self.columns["urbanID"][bestRow].item(), "distance": self.columns["distance"][bestRow].item(),
+                "traveltime": self.columns["traveltime"][bestRow].item(), "dest_ID": destID,
+                "total_population": self.centres["total_population"][centre].item(),
+                "dest_latitude": self.centres["dest_latitude"][centre].item(),
+                "dest_longitude": self.centres["dest_longitude"][centre].item(),
+                "name": self.centres["name"][centre]}
+
+    def tile_id(self, lon, lat):
+        #tile_xy for one point.
+        tx = min(max(math.floor((lon + 180.0) / self.tile_degrees), 0), self.ncols - 1)
+        ty = min(max(math.floor((lat + 90.0) / self.tile_degrees), 0), self.nrows - 1)
+        return ty * self.ncols + tx
+
+    def results(self, rows, chord):
+        found = rows >= 0
+        picked = rows[found]
+        out = {"found": found, "origin_meters": np.where(found, chord_to_meters(np.where(found, chord, 0)), np.nan)}
+        for c, fill in [("urbanID", -1), ("distance", np.nan), ("traveltime", np.nan), ("dest_ID", -1)]:
+            values = np.full(len(rows), fill, dtype=INDEX_COLUMNS[c])
+            values[found] = self.columns[c][picked]
+            out[c] = values
+        centre = np.searchsorted(self.centre_ids, out["dest_ID"][found])
+        for c in ["total_population", "dest_latitude", "dest_longitude"]:
+            values = np.full(len(rows), np.nan)
+            values[found] = self.centres[c][centre]
+            out[c] = values
+        names = np.full(len(rows), None, dtype=object)
+        names[found] = self.centres["name"][centre]
+        out["name"] = names
+        return out
+
+    def stats(self):
+        return {"origins": len(self), "tiles_cached": len(self.tiles), "tile_hits": self.hits, "tile_misses": self.misses}
+
+def json_columns(result):
+    #query_batch output as JSON-ready lists, NaN as null.
+    return {c: [None if isinstance(v, float) and math.isnan(v) else v for v in np.asarray(values).tolist()]
+            for c, values in result.items()}
+
+def serve(index, port, host="0.0.0.0"):
+    """Serve lookups over HTTP from a daemon thread; returns the server.
+
+    GET /nearest?lon=<x>&lat=<y> answers one point (404 when nothing is
+    within max_meters); POST /nearest with {"lon": [...], "lat": [...]}
+    answers a batch as one list per column.  GET /stats reports the cache.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                return self.reply(200, index.stats())
+            if url.path != "/nearest":
+                return self.reply(404, {"error": "unknown path"})
+            try:
+                params = parse_qs(url.query)
+                result = index.query(float(params["lon"][0]), float(params["lat"][0]))
+            except (KeyError, ValueError) as e:
+                return self.reply(400, {"error": "lon and lat are required numbers: " + str(e)})
+            if result is None:
+                return self.reply(404, {"found": False})
+            return self.reply(200, result)
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/nearest":
+                return self.reply(404, {"error": "unknown path"})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                result = index.query_batch(request["lon"], request["lat"])
+            except (KeyError, ValueError, TypeError) as e:
+                return self.reply(400, {"error": "expected {\"lon\": [...], \"lat\": [...]}: " + str(e)})
+            return self.reply(200, json_columns(result))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the point-query index from completed results, or serve lookups from it.")
+    parser.add_argument("command", choices=["build", "serve"])
+    parser.add_argument("--index", default=INDEX_PATH)
+    parser.add_argument("--dataset", help="Parquet results (default: RESULTS_PATH/roadresults with the parquet sink, else the MariaDB table)")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    if args.command == "build":
+        import processDegurb
+        if args.dataset is None and processDegurb.RESULT_SINK == "parquet":
+            args.dataset = os.path.join(processDegurb.RESULTS_PATH, "roadresults")
+        if args.dataset is not None:
+            build_index(lambda: dataset_batches(args.dataset), args.index)
+        else:
+            import pymysql
+            conn = processDegurb.connect_with_retry(dict(processDegurb.mysql_config_db, cursorclass=pymysql.cursors.SSCursor))
+            try:
+                build_index(lambda: sql_batches(conn), args.index)
+            finally:
+                conn.close()
+    else:
+        index = PointIndex(args.index)
+        serve(index, args.port)
+        print("Serving " + str(len(index)) + " origins from " + args.index + " on port " + str(args.port) + ".")
+        threading.Event().wait()
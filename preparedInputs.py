@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+import geopandas
+import pyogrio
+
+from originSource import CHUNK_ROWS, OriginSource
+from osrmBuild import file_sha256
+
+#CRS the source GeoJSONs are in (they carry no CRS of their own).
+MOLLWEIDE = {'proj': 'moll', 'lon_0': 0, 'datum': 'WGS84'}
+
+def prepared_path(sourcePath, columns, cacheDir, crs=MOLLWEIDE):
+    #Named after the source content hash plus the columns and CRS, so a changed
+    #source (or a different selection) gets a new file rather than a stale one.
+    key = hashlib.sha256((file_sha256(sourcePath) + "|" + ",".join(columns) + "|" + str(crs)).encode()).hexdigest()
+    name = os.path.basename(sourcePath).split(".")[0]
+    return os.path.join(cacheDir, name + "-" + key[:16] + ".parquet")
+
+def prepared_points(sourcePath, columns, cacheDir, crs=MOLLWEIDE, log=print):
+    """Points from a GeoJSON in EPSG:4326 with only `columns`, via a GeoParquet cache.
+
+    The first call parses the GeoJSON (reading only the needed columns),
+    reprojects it from `crs` and writes the result to cacheDir; later calls,
+    from any pod sharing cacheDir, just read that file.  Columns missing from
+    the source are skipped.  The file is written under a temporary name and
+    renamed, so pods preparing the same input at once don't see partial files.
+    """
+    path = prepared_path(sourcePath, columns, cacheDir, crs)
+    if os.path.exists(path):
+        return geopandas.read_parquet(path, memory_map=True)
+
+    log("Preparing " + str(sourcePath) + " -> " + path)
+    fields = set(pyogrio.read_info(sourcePath)["fields"])
+    columns = [c for c in columns if c in fields]
+    pts = geopandas.read_file(sourcePath, columns=columns, engine="pyogrio")
+    #GeoJSON readers assume EPSG:4326; these files are really in `crs`.
+    pts = pts.set_crs(crs, allow_override=True).to_crs(epsg=4326)[columns + ["geometry"]]
+
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = path + "." + str(os.getpid()) + ".tmp"
+    pts.to_parquet(tmpPath)
+    os.replace(tmpPath, path)
+    return pts
+
+def prepared_source(sourcePath, idColumn, cacheDir, crs=MOLLWEIDE, chunk_rows=CHUNK_ROWS, log=print):
+    """OriginSource over the prepared GeoParquet copy of sourcePath, streaming the preparation if it is missing.
+
+    The same file prepared_points(sourcePath, [idColumn], ...) uses, but the
+    source is converted chunk_rows points at a time rather than loaded whole.
+    """
+    path = prepared_path(sourcePath, [idColumn], cacheDir, crs)
+    if not os.path.exists(path):
+        log("Preparing " + str(sourcePath) + " -> " + path)
+        os.makedirs(cacheDir, exist_ok=True)
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        OriginSource(sourcePath, crs=crs, chunk_rows=chunk_rows, id_column=idColumn).write_parquet(tmpPath)
+        os.replace(tmpPath, path)
+    return OriginSource(path, chunk_rows=chunk_rows, id_column=idColumn)
+
+if __name__ == "__main__":
+    #Prepare the inputs processDegurb uses, e.g. from an init container, so
+    #worker pods start straight from the cached files.
+    import processDegurb
+    print(str(len(processDegurb.load_urban_points())) + " urban centroids prepared.")
+    print(str(len(processDegurb.load_origin_source().pids())) + " origins prepared.")
@@ -5,22 +5,175 @@ from datetime import datetime
 import sys
 import requests
 import time
-import warnings
 import traceback 
+import signal
+import itertools
+import numpy as np
+from urbanIndex import UrbanIndex
+from roadGraph import RoadGraph
+from resultWriter import ResultWriter
+from asyncRouting import AsyncRoutingClient
+from routeCache import RouteCache
+from osrmShards import ShardMap
+from preparedInputs import MOLLWEIDE, prepared_points, prepared_source
+from originSource import origin_rows, OriginSource
+import osrmHealth
+import routingMetrics
+from workQueue import claim_shard, complete_shard, create_shards, worker_name
 
 mysql_config_db = {
     'host': 'mariadb-service',  # Your MySQL host/service
     'user': 'root',           # Your MySQL user
     'port': 3306,
     'password': '',           # Your MySQL password
-    'db': 'globalroads'
+    'db': 'globalroads',
+    'local_infile': True      # Needed for LOAD DATA LOCAL bulk flushes
 }
 
 logging_path = "/kube/home/logs/globalRoads"
 #table: roadresults
 
+#Rows per roadresults transaction, and the longest (seconds) a row waits in
+#the buffer before a flush (checked as rows arrive).  Flushes of
+#LOAD_DATA_ROWS or more rows use LOAD DATA LOCAL INFILE instead of
+#executemany, so every full batch is bulk loaded; the partial batches left by
+#the flush interval and the end of processPoints use executemany.
+WRITE_BATCH_SIZE = 5000
+WRITE_FLUSH_SECONDS = 60
+LOAD_DATA_ROWS = 5000
+#"mariadb" writes results to roadresults as above.  "parquet" instead writes
+#typed GeoParquet shard files to RESULTS_PATH/shards, one set per worker (see
+#parquetResults.py); `python parquetResults.py compact` merges them into the
+#deduplicated dataset RESULTS_PATH/roadresults and `python parquetResults.py
+#load` bulk loads that into roadresults.  The work queue stays in MariaDB.
+RESULT_SINK = os.getenv('RESULT_SINK', "mariadb")
+RESULTS_PATH = os.getenv('RESULTS_PATH', "/sciclone/geograd/_deployed/globalRoads/results")
+PARQUET_ROW_GROUP_ROWS = 50000
+
+#Work-queue mode: pods claim shards of SHARD_SIZE origins (by PID range) from
+#the roadshards table.  A claim older than SHARD_LEASE_SECONDS is assumed to
+#belong to a dead pod and is handed out again.
+WORK_QUEUE = True
+SHARD_SIZE = 5000
+SHARD_LEASE_SECONDS = 6 * 60 * 60
+
+#Attempts per OSRM request, the base of the jittered exponential backoff
+#between them (seconds), and the most time (seconds) one request may take in
+#all.  Circuit breaking and the retry budget are set in osrmHealth.py.
 RETRIES = 5
 RESPONSEWAIT = 5
+REQUEST_DEADLINE = 30
+#Origins with a request that still failed are not written but queued for up
+#to RETRY_PASSES more passes over the queue, each after waiting (at most
+#RETRY_PASS_WAIT seconds) for open circuit breakers to let requests through.
+RETRY_PASSES = 3
+RETRY_PASS_WAIT = 120
+
+OSRM_URL = "http://osrm:80"
+#Regional routing: a GeoJSON of shard polygons with "name", "url" and
+#"buffer_km" properties (see osrmShards.ShardMap).  Each origin and its
+#candidates go to a shard that covers all of them; when they straddle shards
+#they go to OSRM_FALLBACK_URL if set.  Unset, everything goes to OSRM_URL.
+OSRM_SHARDS = os.getenv('OSRM_SHARDS')
+OSRM_FALLBACK_URL = os.getenv('OSRM_FALLBACK_URL')
+#"osrm" routes origins through osrm-routed as below.  "graph" instead loads
+#the roads of ROADS_PATH (a road dataset written by retrieveData.py) around
+#the origins into a roadGraph.RoadGraph and finds every origin's nearest urban
+#area in a single multi-source search (see processGraph), minimizing
+#GRAPH_WEIGHT ("distance", like select_results, or "duration").  Roads are
+#read for the origins' bbox grown by ROADS_BUFFER_DEGREES, so routes that
+#leave it and urban areas outside it are not seen.
+ROUTING_ENGINE = os.getenv('ROUTING_ENGINE', "osrm")
+ROADS_PATH = os.getenv('ROADS_PATH', "/sciclone/geograd/_deployed/globalRoads/sourceData/parquet/asia.parquet")
+GRAPH_WEIGHT = "distance"
+ROADS_BUFFER_DEGREES = 1.0
+#Urban centroids and origins farther than this (meters) from the nearest road
+#node are left out of the graph search rather than given a long off-road leg.
+#Points snap to the nearest road vertex, not the nearest point on a segment,
+#so along long straight ways the off-road leg can be overstated.
+GRAPH_MAX_SNAP_METERS = 10000
+#"table" sends one /table request for a block of origins and all of their
+#candidates; "route" sends one /route request per origin/candidate pair.
+ROUTING_MODE = "table"
+N_CANDIDATES = 20
+#"fixed" routes every origin to its N_CANDIDATES nearest urban areas.
+#"adaptive" routes them ADAPTIVE_STEP at a time, nearest first, and stops once
+#the next one's great-circle distance times CROW_LOWER_BOUND is no shorter than
+#the best road distance found: a route by road (plus the off-road legs) is never
+#shorter than the straight line, so 1.0 is exact and lower values leave a margin
+#for OSRM's distance approximations.  Origins none of whose N_CANDIDATES route
+#are widened to up to ADAPTIVE_MAX_CANDIDATES.  Adaptive saves requests in
+#"route" mode, where each pair is a request; in "table" mode a block's
+#candidates share one request anyway, and the extra rounds only add requests
+#and round-trips.  "auto" (see candidate_mode) picks adaptive for "route" and
+#fixed for "table".
+CANDIDATE_MODE = "auto"
+ADAPTIVE_STEP = 4
+CROW_LOWER_BOUND = 0.95
+ADAPTIVE_MAX_CANDIDATES = 80
+#Snap every origin to the road network once, SNAP_CHUNK per request, and route
+#each distinct snapped location only once: every origin that snaps there gets
+#its result plus its own off-road leg.  Origins are grouped by the exact
+#location OSRM snapped them to, not by road node: OSRM projects each origin
+#onto its nearest edge, so origins only share a location where they share a
+#foot point, mostly where the nearest road point is a dead end or a bend
+#vertex, as for grid cells far from a sparse rural network.  Origins spread
+#along the same road each get their own projection and are routed separately
+#(routing them from one shared node would misplace all but one of them).
+#benchmarks/snapDedupe.py measures both cases.  Urban
+#centroids are still snapped by OSRM inside each request, where a table
+#already shares one destination column among all the origins of a block.
+SNAP_ORIGINS = True
+SNAP_CHUNK = 250
+#Origins per vectorized candidate lookup.
+CANDIDATE_CHUNK = 10000
+#osrm-routed rejects table requests larger than max-table-size^2 cells
+#(--max-table-size, 100 by default), so blocks are capped to fit.
+TABLE_MAX_LOCATIONS = 100
+TABLE_BLOCK_SIZE = 10
+#Requests in flight at once against osrm-routed (1 sends them one at a time),
+#and how many blocks are routed together per concurrent round.
+ROUTING_CONCURRENCY = 32
+ROUTING_WINDOW = 128
+
+#Cache of routed origin/candidate pairs, keyed on coordinates rounded to
+#CACHE_PRECISION decimals.  The on-disk tier is cleared whenever
+#OSRM_DATASET_VERSION changes, so set it to identify the data osrm-routed serves.
+#CACHE_PATH must be on node-local storage (SQLite is not safe on NFS); mount a
+#hostPath there to keep the cache across pod restarts.  Each process uses the
+#first of routeCache-0.sqlite, routeCache-1.sqlite, ... that no other process
+#has open, so restarts and later flow runs reuse the same files.
+ROUTE_CACHE = True
+OSRM_DATASET_VERSION = os.getenv('OSRM_DATASET_VERSION', "asia.osm.pbf")
+CACHE_PATH = os.getenv('CACHE_PATH', "/tmp/globalRoads/routeCache.sqlite")
+CACHE_PRECISION = 4
+CACHE_MEMORY_ITEMS = 200000
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+#Source points (GeoJSON, Mollweide) and the columns results need from them.
+#With PREPARED_PATH set they are read from GeoParquet copies in EPSG:4326,
+#prepared once per source file hash (see preparedInputs.py); on a shared
+#volume, one pod prepares them and the rest just read the Parquet.
+URBAN_PATH = "./sourceData/urbanCentroids.geojson"
+URBAN_COLUMNS = ["CIESIN_NAME_TL", "Total_Pop", "UID"]
+ORIGIN_PATH = "./sourceData/nepalDegurbaPoints.geojson"
+ORIGIN_COLUMNS = ["PID"]
+PREPARED_PATH = os.getenv('PREPARED_PATH', "./sourceData/prepared")
+#Origins are streamed from their file ORIGIN_CHUNK_ROWS at a time (see
+#originSource.py) rather than loaded whole, so memory doesn't grow with the grid.
+ORIGIN_CHUNK_ROWS = 100000
+
+#Stage timings and counters (see routingMetrics.py).  With METRICS_PORT set,
+#Prometheus metrics are served on it at /metrics; with METRICS_SUMMARY set, a
+#JSON summary is written to logging_path + POD_NAME + "-metrics.json" every
+#METRICS_SUMMARY_SECONDS.  With neither, the instrumentation is a no-op.
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_SUMMARY = os.getenv('METRICS_SUMMARY') is not None
+METRICS_SUMMARY_SECONDS = 60
+
+#Assumed speed (km/h) for the off-road distance between each point and the
+#road it snaps to.
+OFFROAD_KMH = 20
 
 def kLog(type, message, logPath=logging_path):
     podName = os.getenv('POD_NAME')
@@ -50,170 +203,938 @@ def insert_results(conn, results):
                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
     
     try:
-        with conn.cursor() as cursor:
-            # Execute the SQL command with values from the results dictionary
-            cursor.execute(query, (results["latitude"], 
-                                   results["longitude"], 
-                                   results["name"], 
-                                   results["total_population"], 
-                                   results["urbanID"],
-                                   results["distance"],
-                                   results["traveltime"],
-                                   results["dest_latitude"],
-                                   results["dest_longitude"],
-                                   results["dest_ID"]))
-        # Commit the changes to the database
-        conn.commit()
+        with routingMetrics.metrics.timer("db_write"):
+            with conn.cursor() as cursor:
+                # Execute the SQL command with values from the results dictionary
+                cursor.execute(query, (results["latitude"], 
+                                       results["longitude"], 
+                                       results["name"], 
+                                       results["total_population"], 
+                                       results["urbanID"],
+                                       results["distance"],
+                                       results["traveltime"],
+                                       results["dest_latitude"],
+                                       results["dest_longitude"],
+                                       results["dest_ID"]))
+            # Commit the changes to the database
+            conn.commit()
+        routingMetrics.metrics.inc("db_rows")
     except pymysql.Error as e:
         print(f"Error: {e}")
+        routingMetrics.metrics.inc("db_write_failures")
         conn.rollback()  # Rollback in case of error
 
-def osm_request(url, retries, base_wait=1):
+#Shared session so sequential requests reuse the keep-alive connection to OSRM.
+session = requests.Session()
+
+def osm_request(url, retries, base_wait=1, deadline=None):
+    """GET an OSRM url; returns the parsed response, or None if the request failed.
+
+    OSRM's own error responses (4xx, e.g. NoRoute) are returned as they are.
+    Other failures are retried after a jittered backoff while the shared retry
+    budget allows, for at most `deadline` seconds (REQUEST_DEADLINE) in all.
+    Nothing is sent while the server's circuit breaker is open; while its
+    probe is in flight, the request waits for the probe's answer.
+    """
+    deadline = time.monotonic() + (REQUEST_DEADLINE if deadline is None else deadline)
+    breaker = osrmHealth.breaker_for(url)
+    osrmHealth.budget.deposit()
     for retry in range(retries):
+        #The deadline is checked first: allow() may hand this request the
+        #breaker's only probe, which must end in a success or a failure.
+        if deadline - time.monotonic() <= 0:
+            routingMetrics.metrics.inc("deadline_exceeded")
+            return None
+        while not breaker.allow():
+            #While a probe is finding out whether the server is back, wait for
+            #its answer instead of failing (at most until the deadline).
+            if not breaker.probing or time.monotonic() >= deadline:
+                routingMetrics.metrics.inc("breaker_rejections")
+                return None
+            time.sleep(osrmHealth.PROBE_POLL_SECONDS)
+        remaining = max(deadline - time.monotonic(), osrmHealth.PROBE_POLL_SECONDS)
         try:
-            r = requests.get(url, timeout=10, allow_redirects=False)
-            r.raise_for_status()  # Raise an exception for HTTP errors
-            res = r.json()
+            with routingMetrics.metrics.timer("osrm_request"):
+                r = session.get(url, timeout=min(10, remaining), allow_redirects=False)
+                if 400 <= r.status_code < 500 and r.status_code != 429:
+                    #OSRM answered, just not with a route: not worth retrying.
+                    breaker.record_success()
+                    return r.json()
+                r.raise_for_status()  # Raise an exception for HTTP errors
+                res = r.json()
+            breaker.record_success()
             return res  # Success, return the result
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
+            breaker.record_failure()
             print(f"Attempt {retry + 1}/{retries}: Request failed - {str(e)}")
             
             if retry < retries - 1:
-                # Calculate the wait time exponentially increasing
-                wait_time = base_wait * (2 ** retry)
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+                if not osrmHealth.budget.withdraw():
+                    print("Retry budget exhausted, giving up on the request.")
+                    routingMetrics.metrics.inc("budget_exhausted")
+                    break
+                wait_time = min(osrmHealth.backoff(retry, base_wait), deadline - time.monotonic())
+                if wait_time <= 0:
+                    break
+                print(f"Retrying in {wait_time:.1f} seconds...")
+                routingMetrics.metrics.inc("retries")
+                with routingMetrics.metrics.timer("backoff"):
+                    time.sleep(wait_time)
+        except BaseException:
+            #Interrupted mid-request: neither outcome is known.
+            breaker.release()
+            raise
     
+    routingMetrics.metrics.inc("request_failures")
     return None  # All retries failed
 
-def processPoints(pts, conn):
-    print("Processing " + str(len(pts)) + " total locations.")
-    total = 0
-    with open("./sourceData/urbanCentroids.geojson", "r") as u:
-        urbanPoints = geopandas.read_file(u)
-    urbanPoints.crs = {'proj': 'moll', 'lon_0': 0, 'datum': 'WGS84'}
-    urbanPoints = urbanPoints.to_crs(epsg=4326)
-    
-    #List to hold all results
-    distanceResults = []
+def offroad_seconds(meters):
+    #Distances are in meters.
+    #Total distance / 1000 (kilometers)
+    #/OFFROAD_KMH = duration in hours
+    #*60*60 = duration in seconds
+    return (meters / 1000 / OFFROAD_KMH) * 60 * 60
 
-    
-    for index, row in pts.iterrows():
-        print("Starting job " + str(total+1) + " of " + str(len(pts)))
-        mindist = 9999999999.0
-        total = total + 1
-        results = {}
-
- 
-        
-        #Reset from any past runs
-        urbanPoints["distance"] = 999999999999
-        #Ignoring the projection errors for distance calculations - we're just filtering here, so 
-        #don't need perfect accuracy.  The actual distances we use will be calculated by the OSM routing
-        #server in the next step.
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", UserWarning)
-            urbanPoints["distance"] = urbanPoints.geometry.distance(row.geometry)
-
-        #Identify 20 closest urban areas as the crow flies.
-        #We'll then calculate driving duration for all of them,
-        #and select the closest as our match.
-        closestPts = urbanPoints.nsmallest(20, 'distance')
-        
+def with_offroad(roadDist, roadDur, fromSnap, toSnap):
+    """(n, 2) array of total distance and duration: the road legs plus the off-road legs.
+
+    The snap distances are cases in which no road is known, which we cover at
+    OFFROAD_KMH.  Arguments are arrays (or scalars) that broadcast together;
+    NaN road values, for pairs OSRM could not route, stay NaN.
+    """
+    dist = roadDist + fromSnap + toSnap
+    dur = roadDur + offroad_seconds(fromSnap) + offroad_seconds(toSnap)
+    return np.column_stack((np.ravel(dist), np.ravel(dur)))
+
+def parse_route(query):
+    """(road distance, road duration, origin snap, destination snap) for one /route response; NaNs if it failed."""
+    if query is None or query.get("code") != "Ok":
+        return (np.nan, np.nan, np.nan, np.nan)
+    route = query["routes"][0]
+    return (route["distance"], route["duration"], query["waypoints"][0]["distance"], query["waypoints"][1]["distance"])
+
+def route_requests(block, baseUrl=OSRM_URL):
+    """One /route request per origin/candidate pair in the block.
+    Returns (urls, parse), where parse(responses) gives the routed block."""
+    urls = []
+    for row, closestPts in block:
         from_lon = row.geometry.y
         from_lat = row.geometry.x
+        for to_lat, to_lon in zip(closestPts.geometry.x, closestPts.geometry.y):
+            urls.append(baseUrl + "/route/v1/driving/" + str(from_lat) + "," + str(from_lon) + ";" + str(to_lat) + "," + str(to_lon) + "?overview=false")
 
-        for index_urbcent, row_urbcent in closestPts.iterrows():
-            to_lon = row_urbcent.geometry.y
-            to_lat = row_urbcent.geometry.x
+    def parse(responses):
+        parsed = np.array([parse_route(query) for query in responses], dtype=np.float64).reshape(-1, 4)
+        routed = with_offroad(parsed[:, 0], parsed[:, 1], parsed[:, 2], parsed[:, 3])
+        return np.split(routed, np.cumsum([len(closestPts) for row, closestPts in block])[:-1])
+    return urls, parse
 
-            url = "http://osrm:80/route/v1/driving/" + str(from_lat) + "," + str(from_lon) + ";" + str(to_lat) + "," + str(to_lon) + "?overview=false&steps=true"
-            #print(url)
-            query = osm_request(url, RETRIES, RESPONSEWAIT)
+def table_requests(block, baseUrl=OSRM_URL):
+    """A single /table request routing every origin in the block to all of their candidates.
 
-            dist = 0
-            dur = 0
-            for i in query["routes"][0]["legs"][0]["steps"]:
-                #print(str(i["name"]) + ", " + str(i["distance"]) + "," + str(i["maneuver"]["type"]))
-                dist = dist + float(i["distance"])
-                dur = dur + float(i["duration"])
+    Returns (urls, parse), where parse(responses) gives one (k, 2) array of
+    distance and duration per origin, in candidate order, with NaN for pairs
+    OSRM could not route.
+    """
+    #Candidates shared between origins in the block are only sent once.
+    destColumns = {}
+    destCoords = []
+    for row, closestPts in block:
+        for index_urbcent, x, y in zip(closestPts.index, closestPts.geometry.x, closestPts.geometry.y):
+            if index_urbcent not in destColumns:
+                destColumns[index_urbcent] = len(destCoords)
+                destCoords.append((x, y))
 
-            #Add in the distances and estimate the durations from the waypoints.
-            #These are cases in which no road is known, we assume an average of 20km/hour
-            #In these cases.
-            from_waypoint_dist = query["waypoints"][0]["distance"]
-            to_waypoint_dist = query["waypoints"][1]["distance"]
+    origins = [(row.geometry.x, row.geometry.y) for row, closestPts in block]
+    coords = ";".join(str(x) + "," + str(y) for x, y in origins + destCoords)
+    sources = ";".join(str(i) for i in range(len(origins)))
+    destinations = ";".join(str(len(origins) + j) for j in range(len(destCoords)))
+    url = baseUrl + "/table/v1/driving/" + coords + "?sources=" + sources + "&destinations=" + destinations + "&annotations=duration,distance"
 
-            #Distances are in meters.
-            #Total distance / 1000 (kilometers)
-            #/20 = duration in hours
-            #*60*60 = duration in seconds
-            from_waypoint_time = (from_waypoint_dist / 1000 / 20) * 60 * 60
-            to_waypoint_time = (to_waypoint_dist / 1000 / 20) * 60 * 60
+    def parse(responses):
+        query = responses[0]
+        if query is None or query.get("code") != "Ok":
+            print("Table request failed: " + str(query))
+            print("Request: " + str(url))
+            return [np.full((len(closestPts), 2), np.nan) for row, closestPts in block]
 
-            dist = dist + from_waypoint_dist + to_waypoint_dist
+        #The matrix only covers the road network between the snapped points, so the
+        #snap distances of each source and destination are added back in, as in /route.
+        #None (unroutable) cells become NaN.
+        distances = np.array(query["distances"], dtype=np.float64)
+        durations = np.array(query["durations"], dtype=np.float64)
+        fromSnap = np.array([s["distance"] for s in query["sources"]], dtype=np.float64)[:, None]
+        toSnap = np.array([d["distance"] for d in query["destinations"]], dtype=np.float64)[None, :]
+        totals = with_offroad(distances, durations, fromSnap, toSnap).reshape(len(block), len(destCoords), 2)
+        return [totals[i, [destColumns[index_urbcent] for index_urbcent in closestPts.index]]
+                for i, (row, closestPts) in enumerate(block)]
+    return [url], parse
 
-            dur = dur + from_waypoint_time + to_waypoint_time
+def route_blocks(blocks, client=None, cache=None, baseUrls=None, deferred=None, stats=None):
+    """Route a window of blocks; returns one routed block per block.
 
-            duration = dur
-            distance = dist
+    A routed block holds one (k, 2) array of distance and duration per origin,
+    in candidate order, with NaN for pairs that could not be routed.
 
+    baseUrls gives the OSRM server for each block (default OSRM_URL).
 
-            if(distance == 0):
-                distance = 9999999999.0
+    With a RouteCache, pairs already in the cache are not requested again, and
+    newly routed pairs are added to it.  With an AsyncRoutingClient every
+    request in the window is issued concurrently; otherwise they are sent one
+    at a time with osm_request.  With a deferred set, the PIDs of origins with
+    a failed request are added to it (see fetch_blocks).  stats, if given,
+    counts the OSRM requests sent in stats["requests"].
+    """
+    if baseUrls is None:
+        baseUrls = [OSRM_URL] * len(blocks)
+    if cache is None:
+        return fetch_blocks(blocks, client, baseUrls, deferred, stats)
 
-            if(float(mindist) > float(distance)):
-                mindist = float(distance)
-                results["latitude"] = str(from_lat)
-                results["longitude"] = str(from_lon)
-                results["name"] = str(row_urbcent["CIESIN_NAME_TL"])
-                try:
-                    results["total_population"] = str(row_urbcent["Total_Pop"])
-                except:
-                    results["total_population"] = str(0)
-                
-                results["urbanID"] = str(row["PID"])
-                try:
-                    results["distance"] = str(distance)
-                    results["traveltime"] = str(duration)
-                except:
-                    results["distance"] = "99999.0"
-                    results["traveltime"] = "99999.0"
-            
-                results["dest_latitude"] = str(to_lat)
-                results["dest_longitude"] = str(to_lon)
-                results["dest_ID"] = str(row_urbcent["UID"])
-        if(results == {}):
-            print("Error in calculating route for " + str(from_lat) + ";" + str(from_lon) + ": " + str(query))
-            print("Request: " + str(url))
-        else:
-            print(results)
-            print("---")
-            distanceResults.append(results)
+    #Look every pair up first, then route only the candidates that missed.
+    cached = []
+    missing = []
+    for block in blocks:
+        cachedBlock = []
+        missingBlock = []
+        for row, closestPts in block:
+            hits = [cache.get(row.geometry.x, row.geometry.y, pt.x, pt.y) for pt in closestPts.geometry]
+            cachedBlock.append(hits)
+            misses = [h is None for h in hits]
+            if any(misses):
+                missingBlock.append((row, closestPts[misses]))
+        cached.append(cachedBlock)
+        missing.append(missingBlock)
+
+    fetched = iter(fetch_blocks([b for b in missing if b], client, [u for b, u in zip(missing, baseUrls) if b], deferred, stats))
+    routedBlocks = []
+    for block, cachedBlock, missingBlock in zip(blocks, cached, missing):
+        fetchedRouted = iter(next(fetched) if missingBlock else [])
+        routedBlock = []
+        for (row, closestPts), hits in zip(block, cachedBlock):
+            if all(h is not None for h in hits):
+                routedBlock.append(np.array(hits, dtype=np.float64).reshape(-1, 2))
+                continue
+            newPairs = iter(next(fetchedRouted))
+            routed = np.empty((len(hits), 2))
+            for j, (pt, hit) in enumerate(zip(closestPts.geometry, hits)):
+                if hit is None:
+                    hit = next(newPairs)
+                    #Only successful routes are cached, so failed requests are retried on reruns.
+                    if not np.isnan(hit).any():
+                        cache.put(row.geometry.x, row.geometry.y, pt.x, pt.y, (float(hit[0]), float(hit[1])))
+                routed[j] = hit
+            routedBlock.append(routed)
+        routedBlocks.append(routedBlock)
+    cache.flush()
+    return routedBlocks
+
+def fetch_blocks(blocks, client=None, baseUrls=None, deferred=None, stats=None):
+    #A None response is a request that failed (not one OSRM could not route):
+    #the block's origins go in deferred, if given, to be tried again later.
+    if baseUrls is None:
+        baseUrls = [OSRM_URL] * len(blocks)
+    plans = [table_requests(block, baseUrl) if ROUTING_MODE == "table" else route_requests(block, baseUrl)
+             for block, baseUrl in zip(blocks, baseUrls)]
+    urls = [url for blockUrls, parse in plans for url in blockUrls]
+    routingMetrics.metrics.inc("osrm_requests", len(urls))
+    if stats is not None:
+        stats["requests"] = stats.get("requests", 0) + len(urls)
+    if client is not None:
+        responses = client.get_many(urls)
+    else:
+        responses = [osm_request(url, RETRIES, RESPONSEWAIT) for url in urls]
+
+    routedBlocks = []
+    for block, (blockUrls, parse) in zip(blocks, plans):
+        blockResponses = responses[:len(blockUrls)]
+        if deferred is not None and any(query is None for query in blockResponses):
+            deferred.update(row["PID"] for row, closestPts in block)
+        routedBlocks.append(parse(blockResponses))
+        responses = responses[len(blockUrls):]
+    return routedBlocks
+
+#Distance recorded for candidates OSRM reports as 0 m away, so they are never picked.
+ZERO_DISTANCE = 9999999999.0
+
+def result_columns(lon, lat, pids, chosen, distance, traveltime):
+    """The roadresults columns, as typed arrays, for origins and the urbanPoints rows chosen for them."""
+    if "Total_Pop" in chosen:
+        population = chosen["Total_Pop"].values
+    else:
+        population = np.zeros(len(chosen), dtype=np.int64)
+    return {"latitude": lon,
+            "longitude": lat,
+            "name": chosen["CIESIN_NAME_TL"].astype(str).values,
+            "total_population": population,
+            "urbanID": pids,
+            "distance": distance,
+            "traveltime": traveltime,
+            "dest_latitude": chosen.geometry.x.values,
+            "dest_longitude": chosen.geometry.y.values,
+            "dest_ID": chosen["UID"].values}
+
+def select_results(origins, candidates, routed, urbanPoints):
+    """Pick the candidate with the shortest road distance for a window of origins, in one vectorized pass.
+
+    origins are the origin rows, candidates their closestPts and routed the
+    (k, 2) arrays from route_blocks.  The distances go into an origin x
+    candidate matrix (NaN-padded, as origins can have fewer than
+    N_CANDIDATES candidates); zero distances are replaced by ZERO_DISTANCE and
+    each row's argmin is taken.  Returns (columns, failed): the roadresults
+    columns as typed arrays for origins with a routable candidate, and a bool
+    array marking the origins without one.
+    """
+    n = len(origins)
+    lengths = np.array([len(closestPts) for closestPts in candidates])
+    width = max(1, lengths.max(initial=0))
+    filled = np.arange(width)[None, :] < lengths[:, None]
+    stacked = np.concatenate(routed) if n else np.empty((0, 2))
+    distance = np.full((n, width), np.nan)
+    duration = np.full((n, width), np.nan)
+    positions = np.zeros((n, width), dtype=np.int64)
+    distance[filled] = stacked[:, 0]
+    duration[filled] = stacked[:, 1]
+    if n:
+        positions[filled] = urbanPoints.index.get_indexer(np.concatenate([closestPts.index.values for closestPts in candidates]))
+
+    distance[distance == 0] = ZERO_DISTANCE
+    distance[np.isnan(distance)] = np.inf
+    best = np.argmin(distance, axis=1)
+    rows = np.arange(n)
+    bestDistance = distance[rows, best]
+    ok = bestDistance < ZERO_DISTANCE
+
+    okOrigins = [row for row, keep in zip(origins, ok) if keep]
+    columns = result_columns(np.array([row.geometry.x for row in okOrigins], dtype=np.float64),
+                             np.array([row.geometry.y for row in okOrigins], dtype=np.float64),
+                             np.array([row["PID"] for row in okOrigins]),
+                             urbanPoints.iloc[positions[rows, best][ok]], bestDistance[ok], duration[rows, best][ok])
+    return columns, ~ok
+
+def snap_origins(pts, client=None, shardMap=None):
+    """Snap every origin to the road network and group origins that snap to the same point.
+
+    Returns (snapped, groups, snapMeters): snapped is a GeoDataFrame with one
+    row per distinct snapped location (geometry) and a PID numbering those
+    rows, groups gives the snapped row of each origin in pts, and snapMeters
+    each origin's off-road distance to it.  Requests that fail are retried
+    in up to RETRY_PASSES passes, like routing requests; origins that still
+    could not be snapped keep their own coordinates and a snap of 0 m, so
+    they are routed as before.
+
+    /nearest only takes one coordinate, so the snapping is done with /table
+    requests of SNAP_CHUNK sources and a single destination: their "sources"
+    waypoints are the same snapped locations and distances /nearest returns.
+    Origins are grouped by that exact location, so origins projected onto
+    different points of the same road segment are not merged.
+    """
+    lon = pts.geometry.x.values
+    lat = pts.geometry.y.values
+    if shardMap is None:
+        baseUrls = np.full(len(pts), OSRM_URL, dtype=object)
+    else:
+        baseUrls = np.array([shardMap.urls[h] for h in shardMap.home(lon, lat)], dtype=object)
+    chunks = []
+    for baseUrl in set(baseUrls):
+        indices = np.flatnonzero(baseUrls == baseUrl)
+        chunks.extend((baseUrl, indices[start:start + SNAP_CHUNK]) for start in range(0, len(indices), SNAP_CHUNK))
+    urls = [baseUrl + "/table/v1/driving/" + ";".join(str(x) + "," + str(y) for x, y in zip(lon[indices], lat[indices]))
+            + "?sources=" + ";".join(str(i) for i in range(len(indices))) + "&destinations=0&annotations=distance"
+            for baseUrl, indices in chunks]
+    responses = [None] * len(urls)
+    with routingMetrics.metrics.timer("snapping"):
+        for attempt in range(RETRY_PASSES + 1):
+            todo = [i for i, query in enumerate(responses) if query is None]
+            if not todo:
+                break
+            if attempt > 0:
+                print("Retrying " + str(len(todo)) + " snapping requests that failed.")
+                osrmHealth.wait_for_recovery(RETRY_PASS_WAIT)
+            if client is not None:
+                answers = client.get_many([urls[i] for i in todo])
+            else:
+                answers = [osm_request(urls[i], RETRIES, RESPONSEWAIT) for i in todo]
+            for i, query in zip(todo, answers):
+                responses[i] = query
+
+    snapLon = lon.astype(np.float64)
+    snapLat = lat.astype(np.float64)
+    snapMeters = np.zeros(len(pts))
+    for (baseUrl, indices), query in zip(chunks, responses):
+        if query is None or query.get("code") != "Ok":
+            continue
+        waypoints = query["sources"]
+        snapLon[indices] = [w["location"][0] for w in waypoints]
+        snapLat[indices] = [w["location"][1] for w in waypoints]
+        snapMeters[indices] = [w["distance"] for w in waypoints]
+    #The server's own snapped coordinate, unless the origin wasn't snapped: those stay apart.
+    keys = np.column_stack((snapLon, snapLat, np.where(snapMeters > 0, 0, np.arange(len(pts)))))
+    unique, first, groups = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    #Number the snapped points in the order of their first origin, so nearby origins stay in the same blocks.
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    snapped = geopandas.GeoDataFrame({"PID": np.arange(len(order))},
+                                     geometry=geopandas.points_from_xy(unique[order, 0], unique[order, 1]), crs=pts.crs)
+    return snapped, rank[np.ravel(groups)], snapMeters
+
+def fan_out(columns, pts, groups, snapMeters):
+    """Expand select_results columns for snapped points (urbanID = snapped PID) to every origin in their groups.
+
+    Each origin keeps its own coordinates and PID, and adds its off-road leg
+    to the snapped point's distance and travel time.
+    """
+    order = np.argsort(groups, kind="stable")
+    sortedGroups = groups[order]
+    snappedPids = np.asarray(columns["urbanID"], dtype=np.int64)
+    starts = np.searchsorted(sortedGroups, snappedPids, side="left")
+    counts = np.searchsorted(sortedGroups, snappedPids, side="right") - starts
+    #Positions starts[i], starts[i] + 1, ... for each snapped point, all in one array.
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    members = order[np.repeat(starts, counts) + offsets]
+    expanded = {c: np.repeat(np.asarray(v), counts) for c, v in columns.items()}
+    expanded["latitude"] = pts.geometry.x.values[members]
+    expanded["longitude"] = pts.geometry.y.values[members]
+    expanded["urbanID"] = pts["PID"].values[members]
+    expanded["distance"] = expanded["distance"] + snapMeters[members]
+    expanded["traveltime"] = expanded["traveltime"] + offroad_seconds(snapMeters[members])
+    return expanded
+
+def origin_candidates(pts, urbanIndex, shardMap=None):
+    """Yield (row, positions, crowMeters, baseUrl) for every origin.
+
+    Identify the N_CANDIDATES closest urban areas as the crow flies, looked up
+    for CANDIDATE_CHUNK origins at a time: positions are their rows in
+    urbanPoints (nearest first) and crowMeters their great-circle distances.
+    We'll then calculate driving distance for them, and select the closest as
+    our match.  With a ShardMap, baseUrl is the OSRM shard chosen for the
+    origin and positions only holds the candidates that shard can route.
+    """
+    for start in range(0, len(pts), CANDIDATE_CHUNK):
+        chunk = pts.iloc[start:start + CANDIDATE_CHUNK]
+        with routingMetrics.metrics.timer("candidates"):
+            positions, crowDistances = urbanIndex.query(chunk.geometry.x.values, chunk.geometry.y.values, N_CANDIDATES)
+            if shardMap is None:
+                baseUrls = [OSRM_URL] * len(chunk)
+            else:
+                baseUrls, keep = shardMap.assign(chunk.geometry.x.values, chunk.geometry.y.values, positions)
+                positions = [p[k] for p, k in zip(positions, keep)]
+                crowDistances = [c[k] for c, k in zip(crowDistances, keep)]
+                #Group the chunk by shard so table blocks don't break at every change of server.
+                order = sorted(range(len(chunk)), key=lambda i: baseUrls[i])
+                chunk = chunk.iloc[order]
+                positions = [positions[i] for i in order]
+                crowDistances = [crowDistances[i] for i in order]
+                baseUrls = [baseUrls[i] for i in order]
+        rows = origin_rows(chunk.geometry.x.values, chunk.geometry.y.values, chunk["PID"].values)
+        for row, rowPositions, rowCrow, baseUrl in zip(rows, positions, crowDistances, baseUrls):
+            yield row, rowPositions, rowCrow, baseUrl
+
+def pack_blocks(items):
+    """Group (row, closestPts, baseUrl) items, in order, into (baseUrl, block) pairs routed together.
+
+    In "route" mode every block holds a single origin.  In "table" mode origins
+    are grouped until the block would exceed TABLE_BLOCK_SIZE origins or the
+    table size osrm-routed accepts; neighbouring origins usually share most
+    of their candidates, so blocks stay small in destinations.  A block never
+    spans two OSRM shards.
+    """
+    block = []
+    blockUrl = None
+    destinations = set()
+    for row, closestPts, baseUrl in items:
+        if ROUTING_MODE != "table":
+            yield baseUrl, [(row, closestPts)]
+            continue
+        merged = destinations | set(closestPts.index)
+        if block and (baseUrl != blockUrl or len(block) >= TABLE_BLOCK_SIZE or (len(block) + 1) * len(merged) > TABLE_MAX_LOCATIONS ** 2):
+            yield blockUrl, block
+            block = []
+            merged = set(closestPts.index)
+        block.append((row, closestPts))
+        blockUrl = baseUrl
+        destinations = merged
+    if block:
+        yield blockUrl, block
+
+def origin_blocks(pts, urbanIndex, shardMap=None):
+    """Yield (baseUrl, block) pairs covering every origin and all of its candidates (see pack_blocks)."""
+    return pack_blocks((row, urbanIndex.candidates(positions), baseUrl)
+                       for row, positions, crowMeters, baseUrl in origin_candidates(pts, urbanIndex, shardMap))
+
+def routed_windows(pts, urbanIndex, client=None, cache=None, shardMap=None, deferred=None, stats=None):
+    """Route ROUTING_WINDOW blocks at a time, yielding (origins, candidates, routed) lists per window."""
+    blocks = origin_blocks(pts, urbanIndex, shardMap)
+    while True:
+        window = list(itertools.islice(blocks, ROUTING_WINDOW))
+        if not window:
+            return
+        baseUrls = [baseUrl for baseUrl, block in window]
+        window = [block for baseUrl, block in window]
+        origins = []
+        candidates = []
+        routed = []
+        with routingMetrics.metrics.timer("routing"):
+            routedWindow = route_blocks(window, client, cache, baseUrls, deferred, stats)
+        if stats is not None:
+            stats["origins"] = stats.get("origins", 0) + sum(len(block) for block in window)
+        for block, routedBlock in zip(window, routedWindow):
+            for (row, closestPts), routedPairs in zip(block, routedBlock):
+                origins.append(row)
+                candidates.append(closestPts)
+                routed.append(routedPairs)
+        yield origins, candidates, routed
+
+def widen_candidates(row, queried, urbanIndex, shardMap=None):
+    """The next nearest candidates past the first `queried`, for an origin none of whose candidates routed.
 
-        #sys.exit()
+    Returns (positions, crowMeters, baseUrl, queried), looking at twice as
+    many candidates as before, up to ADAPTIVE_MAX_CANDIDATES.
+    """
+    k = min(queried * 2, ADAPTIVE_MAX_CANDIDATES)
+    positions, crowDistances = urbanIndex.query([row.geometry.x], [row.geometry.y], k)
+    positions = positions[0][queried:]
+    crowDistances = crowDistances[0][queried:]
+    baseUrl = OSRM_URL
+    if shardMap is not None:
+        baseUrls, keep = shardMap.assign([row.geometry.x], [row.geometry.y], [positions])
+        baseUrl = baseUrls[0]
+        positions = positions[keep[0]]
+        crowDistances = crowDistances[keep[0]]
+    return positions, crowDistances, baseUrl, k
 
-        #Commit to MySQL every N observations.
-        if(len(distanceResults) >= 2):
-            for r in distanceResults:
+def route_adaptive(window, urbanIndex, client=None, cache=None, shardMap=None, stats=None, deferred=None):
+    """Route a window of origin_candidates items in rounds, skipping candidates that cannot win.
+
+    Each round routes up to ADAPTIVE_STEP more candidates per origin, nearest
+    first, and stops for an origin once its next candidate's great-circle
+    distance times CROW_LOWER_BOUND is no shorter than the best road distance
+    found so far.  An origin with no routable candidate among its first
+    N_CANDIDATES is widened (see widen_candidates), unless one of its requests
+    failed: its NaNs then say nothing about its candidates, so it is not
+    widened, and with a deferred set it is not routed any further either, as
+    it will be retried in a later pass.  Returns (origins,
+    candidates, routed) like routed_windows, holding only the routed
+    candidates; stats, if given, counts origins, routed pairs, OSRM requests
+    and widenings.
+    """
+    n = len(window)
+    origins = [row for row, positions, crowMeters, baseUrl in window]
+    pending = [positions for row, positions, crowMeters, baseUrl in window]
+    pendingCrow = [crowMeters for row, positions, crowMeters, baseUrl in window]
+    baseUrls = [baseUrl for row, positions, crowMeters, baseUrl in window]
+    queried = [N_CANDIDATES] * n
+    done = [[] for i in range(n)]
+    routed = [[] for i in range(n)]
+    best = np.full(n, np.inf)
+    failed = np.zeros(n, dtype=bool)
+    widened = 0
+    pruned = 0
+
+    while True:
+        todo = []
+        for i in range(n):
+            if failed[i] and deferred is not None:
+                pending[i] = pending[i][:0]
+                continue
+            while len(pending[i]) == 0 and np.isinf(best[i]) and not failed[i] and queried[i] < ADAPTIVE_MAX_CANDIDATES:
+                pending[i], pendingCrow[i], baseUrls[i], queried[i] = widen_candidates(origins[i], queried[i], urbanIndex, shardMap)
+                widened = widened + 1
+            #Candidates are nearest first, so the first one that can't beat best ends the search.
+            hopeless = np.flatnonzero(pendingCrow[i] * CROW_LOWER_BOUND >= best[i])
+            take = min(ADAPTIVE_STEP, hopeless[0] if len(hopeless) else len(pending[i]))
+            if take == 0:
+                pruned = pruned + len(pending[i])
+                pending[i] = pending[i][:0]
+                continue
+            todo.append((i, pending[i][:take]))
+            pending[i] = pending[i][take:]
+            pendingCrow[i] = pendingCrow[i][take:]
+        if not todo:
+            break
+
+        blocks = list(pack_blocks((origins[i], urbanIndex.candidates(positions), baseUrls[i]) for i, positions in todo))
+        routedPairs = []
+        #Origins with a failed request this round, whether or not they can be deferred.
+        roundFailed = set()
+        for start in range(0, len(blocks), ROUTING_WINDOW):
+            chunk = blocks[start:start + ROUTING_WINDOW]
+            with routingMetrics.metrics.timer("routing"):
+                routedChunk = route_blocks([block for baseUrl, block in chunk], client, cache, [baseUrl for baseUrl, block in chunk], roundFailed, stats)
+            routedPairs.extend(pairs for routedBlock in routedChunk for pairs in routedBlock)
+        if deferred is not None:
+            deferred.update(roundFailed)
+        for (i, positions), pairs in zip(todo, routedPairs):
+            failed[i] = failed[i] or origins[i]["PID"] in roundFailed
+            done[i].append(positions)
+            routed[i].append(pairs)
+            #Zero and unroutable distances are never selected (see select_results).
+            distances = pairs[:, 0]
+            distances = distances[(distances > 0) & ~np.isnan(distances)]
+            if len(distances):
+                best[i] = min(best[i], distances.min())
+
+    candidates = [urbanIndex.candidates(np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)) for positions in done]
+    routed = [np.concatenate(pairs) if pairs else np.empty((0, 2)) for pairs in routed]
+    nPairs = sum(len(pairs) for pairs in routed)
+    routingMetrics.metrics.inc("pairs_routed", nPairs)
+    routingMetrics.metrics.inc("pairs_pruned", pruned)
+    if stats is not None:
+        stats["origins"] = stats.get("origins", 0) + n
+        stats["pairs"] = stats.get("pairs", 0) + nPairs
+        stats["widened"] = stats.get("widened", 0) + widened
+    return origins, candidates, routed
+
+def candidate_mode():
+    """CANDIDATE_MODE, with "auto" resolved for ROUTING_MODE."""
+    if CANDIDATE_MODE == "auto":
+        return "adaptive" if ROUTING_MODE == "route" else "fixed"
+    return CANDIDATE_MODE
+
+def adaptive_windows(pts, urbanIndex, client=None, cache=None, shardMap=None, stats=None, deferred=None):
+    """Adaptive counterpart of routed_windows: yields (origins, candidates, routed) per window via route_adaptive."""
+    items = origin_candidates(pts, urbanIndex, shardMap)
+    windowSize = ROUTING_WINDOW * (TABLE_BLOCK_SIZE if ROUTING_MODE == "table" else 1)
+    while True:
+        window = list(itertools.islice(items, windowSize))
+        if not window:
+            return
+        yield route_adaptive(window, urbanIndex, client, cache, shardMap, stats, deferred)
+
+def load_urban_points():
+    if PREPARED_PATH is not None:
+        return prepared_points(URBAN_PATH, URBAN_COLUMNS, PREPARED_PATH)
+    with open(URBAN_PATH, "r") as u:
+        urbanPoints = geopandas.read_file(u)
+    urbanPoints.crs = {'proj': 'moll', 'lon_0': 0, 'datum': 'WGS84'}
+    return urbanPoints.to_crs(epsg=4326)
+
+def new_routing_client(concurrency=None):
+    concurrency = ROUTING_CONCURRENCY if concurrency is None else concurrency
+    return AsyncRoutingClient(concurrency, RETRIES, RESPONSEWAIT, deadline=REQUEST_DEADLINE) if concurrency > 1 else None
+
+def new_route_cache(path=None):
+    """RouteCache in the first free slot file of path (CACHE_PATH by default): <path>-0.sqlite, <path>-1.sqlite, ..."""
+    if not ROUTE_CACHE:
+        return None
+    base, ext = os.path.splitext(CACHE_PATH if path is None else path)
+    for slot in itertools.count():
+        try:
+            return RouteCache(base + "-" + str(slot) + ext, OSRM_DATASET_VERSION, precision=CACHE_PRECISION,
+                              memory_items=CACHE_MEMORY_ITEMS, max_disk_bytes=CACHE_MAX_BYTES)
+        except BlockingIOError:
+            continue
+
+def routing_indexes(urbanPoints):
+    """The (UrbanIndex, ShardMap or None) processPoints searches urbanPoints with.
+
+    Building them costs a pass over every urban point, so callers routing
+    several chunks build them once and pass them in.
+    """
+    urbanIndex = UrbanIndex(urbanPoints)
+    shardMap = None
+    if OSRM_SHARDS:
+        shardMap = ShardMap.from_geojson(OSRM_SHARDS, OSRM_FALLBACK_URL)
+        shardMap.index_candidates(urbanPoints)
+    return urbanIndex, shardMap
+
+def processPoints(pts, writer, urbanPoints=None, client=None, cache=None, failed=None, indexes=None):
+    """Route every origin in pts and write the closest urban area for each; returns the number processed.
+
+    A routing client, route cache or routing_indexes(urbanPoints) passed in
+    are reused and left open (processSource, processShards and the Prefect
+    flow build them once); otherwise they are built for this call and the
+    client and cache closed at the end.  Origins whose OSRM requests fail
+    are retried in up to RETRY_PASSES later passes; the last pass writes
+    whatever it gets, unless a failed set is given: then the PIDs of origins
+    whose requests still failed go in it, unwritten, for the caller to retry.
+    With SNAP_ORIGINS, the distinct snapped points are routed instead of the
+    origins (see snap_origins).
+    """
+    print("Processing " + str(len(pts)) + " total locations.")
+    total = 0
+    if urbanPoints is None:
+        urbanPoints = load_urban_points()
+    urbanIndex, shardMap = routing_indexes(urbanPoints) if indexes is None else indexes
+    ownClient = client is None
+    ownCache = cache is None
+    if ownClient:
+        client = new_routing_client()
+    if ownCache:
+        cache = new_route_cache()
+
+    stats = {}
+    groups = None
+    try:
+        routingPts = pts
+        if SNAP_ORIGINS and len(pts):
+            routingPts, groups, snapMeters = snap_origins(pts, client, shardMap)
+            groupSizes = np.bincount(groups, minlength=len(routingPts))
+            print("Snapped " + str(len(pts)) + " locations to " + str(len(routingPts)) + " distinct road points.")
+        remaining = routingPts
+        for attempt in range(RETRY_PASSES + 1):
+            #Origins with a failed request (OSRM down, restarting or overloaded)
+            #are queued for another pass rather than written with a partial
+            #answer; the last pass writes whatever it gets (or leaves them to
+            #the caller, with failed).
+            deferred = set() if attempt < RETRY_PASSES or failed is not None else None
+            if candidate_mode() == "adaptive":
+                windows = adaptive_windows(remaining, urbanIndex, client, cache, shardMap, stats, deferred)
+            else:
+                windows = routed_windows(remaining, urbanIndex, client, cache, shardMap, deferred, stats)
+
+            for origins, candidates, routed in windows:
+                if deferred:
+                    keep = [row["PID"] not in deferred for row in origins]
+                    origins = [row for row, k in zip(origins, keep) if k]
+                    candidates = [closestPts for closestPts, k in zip(candidates, keep) if k]
+                    routed = [pairs for pairs, k in zip(routed, keep) if k]
+                with routingMetrics.metrics.timer("assembly"):
+                    columns, noRoute = select_results(origins, candidates, routed, urbanPoints)
+                    if groups is not None:
+                        columns = fan_out(columns, pts, groups, snapMeters)
+                        weights = groupSizes[[row["PID"] for row in origins]]
+                    else:
+                        weights = np.ones(len(origins), dtype=np.int64)
+                total = total + int(weights.sum())
+                if routingMetrics.metrics.enabled:
+                    routingMetrics.metrics.inc("origins", int(weights.sum()))
+                    routingMetrics.metrics.inc("failed_origins", int(weights[noRoute].sum()))
+                    routingMetrics.metrics.inc("unroutable_pairs", int(sum(np.isnan(r[:, 0]).sum() for r in routed)))
+                for i in np.flatnonzero(noRoute):
+                    print("Error in calculating route for " + str(origins[i].geometry.x) + ";" + str(origins[i].geometry.y) + ": " + str(routed[i].tolist()))
+                print("Processed " + str(total) + " of " + str(len(pts)) + " locations.")
+
+                #The writer commits to MySQL in batches of WRITE_BATCH_SIZE rows.
                 try:
-                    insert_results(conn, r)
+                    with routingMetrics.metrics.timer("write"):
+                        writer.write_columns(columns)
                 except Exception as e: 
                     print("CRITICAL FAILURE: SQL Insert failed: " + str(e))
-                    print(r)
                     traceback.print_exc()
-            distanceResults= []
-                                  
-    return(distanceResults)
 
-with open("./sourceData/nepalDegurbaPoints.geojson", 'r') as f:
-    degUrbPts = geopandas.read_file(f)
+            if not deferred:
+                break
+            if attempt == RETRY_PASSES:
+                failedPids = pts["PID"].values[np.isin(groups, list(deferred))] if groups is not None else list(deferred)
+                failed.update(failedPids)
+                print(str(len(failedPids)) + " locations still failed; leaving them unwritten.")
+                break
+            remaining = routingPts[routingPts["PID"].isin(list(deferred))]
+            print("Retrying " + str(len(remaining)) + " locations whose OSRM requests failed.")
+            routingMetrics.metrics.inc("deferred_origins", len(remaining))
+            osrmHealth.wait_for_recovery(RETRY_PASS_WAIT)
+    finally:
+        if client is not None and ownClient:
+            client.close()
+        if stats.get("origins"):
+            #Requests sent, not counting cache hits or client retries.
+            print(candidate_mode().capitalize() + " candidates: " + str(stats.get("requests", 0)) + " OSRM requests for "
+                  + str(stats["origins"]) + " routed origins (" + "%.2f" % (stats.get("requests", 0) / stats["origins"]) + " per origin)"
+                  + ("; " + str(stats["pairs"]) + " pairs routed, " + str(stats["widened"]) + " searches widened." if "pairs" in stats else "."))
+        if cache is not None:
+            print(cache.stats())
+            if ownCache:
+                cache.close()
+
+    writer.flush()
+    return(total)
 
-degUrbPts.crs = {'proj': 'moll', 'lon_0': 0, 'datum': 'WGS84'}
-degUrbPts = degUrbPts.to_crs(epsg=4326)
-#Subset for dev
-#degUrbExampleSubset = degUrbPts.head()
+def new_result_writer(connect=None):
+    """The RESULT_SINK writer; connect() opens the MariaDB connection (connect_with_retry by default)."""
+    if RESULT_SINK == "parquet":
+        from parquetResults import ParquetResultWriter
+        return ParquetResultWriter(os.path.join(RESULTS_PATH, "shards"),
+                                   dataset_path=os.path.join(RESULTS_PATH, "roadresults"),
+                                   row_group_rows=PARQUET_ROW_GROUP_ROWS)
+    if connect is None:
+        connect = lambda: connect_with_retry(mysql_config_db)
+    return ResultWriter(connect(),
+                        reconnect=connect,
+                        batch_size=WRITE_BATCH_SIZE,
+                        flush_interval=WRITE_FLUSH_SECONDS,
+                        load_data_rows=LOAD_DATA_ROWS)
 
-conn = connect_with_retry(mysql_config_db)
-print(processPoints(degUrbPts, conn))
-conn.close()
\ No newline at end of file
+def load_road_graph(pts, path=None):
+    """RoadGraph of the roads within ROADS_BUFFER_DEGREES of the points in pts."""
+    from sourceData.roadExtract import ROADS_SUBSET, read_roads
+    xmin, ymin, xmax, ymax = pts.total_bounds
+    b = ROADS_BUFFER_DEGREES
+    roads = read_roads(ROADS_PATH if path is None else path, bbox=(xmin - b, ymin - b, xmax + b, ymax + b),
+                       highways=ROADS_SUBSET, columns=["highway"])
+    return RoadGraph.from_roads(roads)
+
+def processGraph(pts, writer, urbanPoints=None, graph=None):
+    """Find the closest urban area by road for every origin in pts with one graph search; returns the number processed.
+
+    The urban centroids inside the road graph's extent are snapped to their
+    nearest road node and searched from all at once (RoadGraph.nearest_sources);
+    each origin is then snapped to its nearest node and reads off that node's
+    urban area, distance and travel time, plus its off-road leg at OFFROAD_KMH.
+    Urban centroids and origins more than GRAPH_MAX_SNAP_METERS from a road
+    node are skipped.  Without a graph, one is loaded for pts (see load_road_graph).
+    """
+    print("Processing " + str(len(pts)) + " total locations on the road graph.")
+    if urbanPoints is None:
+        urbanPoints = load_urban_points()
+    if graph is None:
+        with routingMetrics.metrics.timer("graph_build"):
+            graph = load_road_graph(pts)
+        print("Road graph: " + str(len(graph)) + " nodes, " + str(graph.edge_count()) + " edges.")
+    if len(graph) == 0:
+        print("No roads around these locations.")
+        return 0
+    #Urban areas beyond the roads loaded, or too far off them, would only be reached off-road.
+    xmin, xmax, ymin, ymax = graph.lon.min(), graph.lon.max(), graph.lat.min(), graph.lat.max()
+    ux = urbanPoints.geometry.x.values
+    uy = urbanPoints.geometry.y.values
+    urbanPoints = urbanPoints[(ux >= xmin) & (ux <= xmax) & (uy >= ymin) & (uy <= ymax)]
+    urbanNodes, urbanMeters = graph.snap(urbanPoints.geometry.x.values, urbanPoints.geometry.y.values)
+    near = urbanMeters <= GRAPH_MAX_SNAP_METERS
+    urbanPoints, urbanNodes, urbanMeters = urbanPoints[near], urbanNodes[near], urbanMeters[near]
+    if len(urbanPoints) == 0:
+        print("No urban areas near the roads around these locations.")
+        return 0
+
+    with routingMetrics.metrics.timer("graph_search"):
+        source, meters, seconds = graph.nearest_sources(urbanNodes, urbanMeters, offroad_seconds(urbanMeters), GRAPH_WEIGHT)
+
+    total = 0
+    for start in range(0, len(pts), CANDIDATE_CHUNK):
+        chunk = pts.iloc[start:start + CANDIDATE_CHUNK]
+        with routingMetrics.metrics.timer("assembly"):
+            lon = chunk.geometry.x.values.astype(np.float64)
+            lat = chunk.geometry.y.values.astype(np.float64)
+            nodes, snapMeters = graph.snap(lon, lat)
+            offRoad = snapMeters > GRAPH_MAX_SNAP_METERS
+            ok = (source[nodes] >= 0) & ~offRoad
+            columns = result_columns(lon[ok], lat[ok], chunk["PID"].values[ok], urbanPoints.iloc[source[nodes][ok]],
+                                     meters[nodes][ok] + snapMeters[ok], seconds[nodes][ok] + offroad_seconds(snapMeters[ok]))
+        total = total + len(chunk)
+        routingMetrics.metrics.inc("origins", len(chunk))
+        routingMetrics.metrics.inc("failed_origins", int((~ok).sum()))
+        for i in np.flatnonzero(~ok):
+            reason = "no road within " + str(GRAPH_MAX_SNAP_METERS) + " m" if offRoad[i] else "no urban area reachable by road"
+            print("Error in calculating route for " + str(lon[i]) + ";" + str(lat[i]) + ": " + reason + ".")
+        print("Processed " + str(total) + " of " + str(len(pts)) + " locations.")
+
+        try:
+            with routingMetrics.metrics.timer("write"):
+                writer.write_columns(columns)
+        except Exception as e:
+            print("CRITICAL FAILURE: SQL Insert failed: " + str(e))
+            traceback.print_exc()
+
+    writer.flush()
+    return(total)
+
+def load_origin_points():
+    if PREPARED_PATH is not None:
+        return prepared_points(ORIGIN_PATH, ORIGIN_COLUMNS, PREPARED_PATH)
+    with open(ORIGIN_PATH, 'r') as f:
+        degUrbPts = geopandas.read_file(f)
+
+    degUrbPts.crs = {'proj': 'moll', 'lon_0': 0, 'datum': 'WGS84'}
+    return degUrbPts.to_crs(epsg=4326)
+
+def load_origin_source():
+    """OriginSource over the origins: the prepared GeoParquet copy with PREPARED_PATH set, else ORIGIN_PATH."""
+    if PREPARED_PATH is not None:
+        return prepared_source(ORIGIN_PATH, "PID", PREPARED_PATH, chunk_rows=ORIGIN_CHUNK_ROWS)
+    return OriginSource(ORIGIN_PATH, crs=MOLLWEIDE, chunk_rows=ORIGIN_CHUNK_ROWS)
+
+def processSource(source, writer, urbanPoints=None, client=None, cache=None):
+    """Route every origin of an OriginSource, one chunk at a time; returns the number processed.
+
+    The urban points and their indexes, routing client and route cache are
+    shared by all chunks, so only one chunk of origins is ever held in memory.
+    """
+    if urbanPoints is None:
+        urbanPoints = load_urban_points()
+    indexes = routing_indexes(urbanPoints)
+    ownClient = client is None
+    ownCache = cache is None
+    if ownClient:
+        client = new_routing_client()
+    if ownCache:
+        cache = new_route_cache()
+    total = 0
+    try:
+        for pts in source.frames():
+            total = total + processPoints(pts, writer, urbanPoints, client, cache, indexes=indexes)
+    finally:
+        if client is not None and ownClient:
+            client.close()
+        if cache is not None and ownCache:
+            cache.close()
+    return(total)
+
+def processShards(source, writer, urbanPoints):
+    """Work-queue mode: claim PID-range shards from roadshards until none are left.
+
+    Each shard's origins are read from the OriginSource by PID range.  Origins
+    already present in roadresults (from a pod that died mid-shard) are
+    skipped, and a shard is only marked done once all its origins were routed
+    (origins whose OSRM requests still failed leave it claimed, so it is
+    handed out again once its lease runs out) and their results are
+    committed: right away with ResultWriter, and when the shard file holding
+    them is finished with ParquetResultWriter (see when_committed), so a pod
+    can hold several claims at once.  Each claim gets its own owner name for that.
+    The urban indexes, routing client and route cache are shared by all shards.
+    """
+    owner = worker_name()
+    indexes = routing_indexes(urbanPoints)
+    client = new_routing_client()
+    cache = new_route_cache()
+    queueConn = connect_with_retry(mysql_config_db)
+    try:
+        nShards = create_shards(queueConn, source.pids, SHARD_SIZE)
+        kLog("INFO", owner + " working on " + str(nShards) + " shards.")
+        for claim in itertools.count():
+            claimOwner = owner + "/" + str(claim)
+            shard = claim_shard(queueConn, claimOwner, SHARD_LEASE_SECONDS)
+            if shard is None:
+                kLog("INFO", owner + ": no shards left.")
+                return
+            shard_id, pid_min, pid_max = shard
+            shardPts = source.subset(pid_range=(pid_min, pid_max)).read()
+            done = writer.done_pids(shardPts["PID"])
+            shardPts = shardPts[~shardPts["PID"].map(str).isin(done)]
+            kLog("INFO", owner + " claimed shard " + str(shard_id) + ": " + str(len(shardPts)) + " origins left, " + str(len(done)) + " already done.")
+            failed = set()
+            processPoints(shardPts, writer, urbanPoints, client, cache, failed=failed, indexes=indexes)
+            if failed:
+                kLog("WARN", owner + ": " + str(len(failed)) + " origins of shard " + str(shard_id)
+                     + " failed; leaving it claimed to be retried after its lease.")
+                continue
+            writer.when_committed(lambda shard_id=shard_id, claimOwner=claimOwner: complete_shard(queueConn, shard_id, claimOwner))
+    finally:
+        #Finish the open shard file while the queue connection can still record its shards as done.
+        writer.commit()
+        queueConn.close()
+        if client is not None:
+            client.close()
+        if cache is not None:
+            cache.close()
+
+if __name__ == "__main__":
+    origins = load_origin_source()
+    #Subset for dev
+    #origins = origins.subset(pid_range=(0, 1000))
+
+    #Kubernetes stops pods with SIGTERM; exit normally so buffered results are flushed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if METRICS_PORT or METRICS_SUMMARY:
+        routingMetrics.enable(METRICS_PORT, logging_path + str(os.getenv('POD_NAME')) + "-metrics.json" if METRICS_SUMMARY else None,
+                              METRICS_SUMMARY_SECONDS)
+
+    with new_result_writer() as writer:
+        if ROUTING_ENGINE == "graph":
+            print(processGraph(origins.read(), writer))
+        elif WORK_QUEUE:
+            processShards(origins, writer, load_urban_points())
+        else:
+            print(processSource(origins, writer))
+    if getattr(writer, "conn", None) is not None:
+        writer.conn.close()
@@ -0,0 +1,131 @@
+import atexit
+import csv
+import os
+import tempfile
+import time
+
+import pymysql
+
+import routingMetrics
+import workQueue
+
+COLUMNS = ["latitude", "longitude", "name", "total_population", "urbanID",
+           "distance", "traveltime", "dest_latitude", "dest_longitude", "dest_ID"]
+
+class ResultWriter:
+    """Buffered, transactional writer for roadresults.
+
+    Rows are collected in memory and written in one transaction per batch with
+    executemany, or with LOAD DATA LOCAL INFILE once a flush reaches
+    load_data_rows (the connection must be opened with local_infile=True).
+    A batch is flushed when it reaches batch_size rows, when a row arrives more
+    than flush_interval seconds after the last flush, and on close/exit.
+    There is no timer: flush_interval is only checked in write/write_columns,
+    so rows buffered before a writer goes quiet wait for the next write or an
+    explicit flush (processPoints flushes before it returns).
+    If a flush fails, the transaction is rolled back, the connection is
+    replaced via reconnect() and the whole batch is retried.
+    """
+
+    def __init__(self, conn, reconnect=None, batch_size=500, flush_interval=30,
+                 load_data_rows=None, retries=3, table="roadresults"):
+        self.conn = conn
+        self.reconnect = reconnect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.load_data_rows = load_data_rows
+        self.retries = retries
+        self.table = table
+        self.rows = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def write(self, results):
+        self.rows.append(tuple(results[c] for c in COLUMNS))
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_columns(self, columns):
+        """Buffer a batch of rows given as one array (or list) per column in COLUMNS."""
+        values = [columns[c].tolist() if hasattr(columns[c], "tolist") else list(columns[c]) for c in COLUMNS]
+        self.rows.extend(zip(*values))
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return 0
+        for attempt in range(self.retries):
+            try:
+                with routingMetrics.metrics.timer("db_write"):
+                    if self.load_data_rows and len(self.rows) >= self.load_data_rows:
+                        self._load_data(self.rows)
+                    else:
+                        self._executemany(self.rows)
+                    self.conn.commit()
+                break
+            except pymysql.Error as e:
+                print(f"Attempt {attempt + 1}/{self.retries}: Batch insert of {len(self.rows)} rows failed - {e}")
+                routingMetrics.metrics.inc("db_write_failures")
+                try:
+                    self.conn.rollback()
+                except pymysql.Error:
+                    pass
+                if attempt == self.retries - 1:
+                    raise
+                if self.reconnect is not None:
+                    try:
+                        self.conn.close()
+                    except pymysql.Error:
+                        pass
+                    self.conn = self.reconnect()
+        count = len(self.rows)
+        self.written = self.written + count
+        routingMetrics.metrics.inc("db_rows", count)
+        self.rows = []
+        return count
+
+    def commit(self):
+        """Flush; every flush is its own transaction, so flushed rows are durable."""
+        return self.flush()
+
+    def when_committed(self, callback):
+        """Call callback() once every row written so far is committed, i.e. after a flush."""
+        self.flush()
+        callback()
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def done_pids(self, pids):
+        """The subset of pids (as strings) already in the table; see workQueue.done_pids."""
+        return workQueue.done_pids(self.conn, pids)
+
+    def _executemany(self, rows):
+        query = ("INSERT INTO " + self.table + " (" + ", ".join(COLUMNS) + ") VALUES ("
+                 + ", ".join(["%s"] * len(COLUMNS)) + ")")
+        with self.conn.cursor() as cursor:
+            cursor.executemany(query, rows)
+
+    def _load_data(self, rows):
+        #pymysql streams LOAD DATA LOCAL from a file path, so the CSV is staged in a temp file.
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False) as f:
+            csv.writer(f, lineterminator="\n").writerows(rows)
+            path = f.name
+        try:
+            query = ("LOAD DATA LOCAL INFILE %s INTO TABLE " + self.table
+                     + " FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"'"
+                     + " LINES TERMINATED BY '\\n' (" + ", ".join(COLUMNS) + ")")
+            with self.conn.cursor() as cursor:
+                cursor.execute(query, (path,))
+        finally:
+            os.remove(path)
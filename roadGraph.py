@@ -0,0 +1,154 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from urbanIndex import EARTH_RADIUS, chord_to_meters, unit_vectors
+
+#Free-flow speeds (km/h) per highway class, close to the defaults in OSRM's
+#car.lua, so graph travel times are comparable with the OSRM server's.
+HIGHWAY_SPEEDS = {"motorway": 90, "motorway_link": 45, "trunk": 85, "trunk_link": 40,
+                  "primary": 65, "primary_link": 30, "secondary": 55, "secondary_link": 25,
+                  "tertiary": 40, "tertiary_link": 20, "residential": 25, "living_street": 10,
+                  "track": 5}
+DEFAULT_SPEED = 25
+#Vertex coordinates are rounded to this many decimals (~1 cm) before roads
+#sharing a vertex are joined at one node.
+NODE_PRECISION = 7
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(a) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+class RoadGraph:
+    """The road network as a compressed sparse row (CSR) graph, for multi-source searches.
+
+    Nodes are the distinct road vertices; every segment between consecutive
+    vertices of a road is an edge in both directions (oneway tags are not
+    kept by the road extract), with its length in meters and its travel time
+    at the road's HIGHWAY_SPEEDS speed.  Where two roads join the same pair of
+    vertices only the faster edge is kept.
+    """
+
+    def __init__(self, lon, lat, indptr, indices, meters, seconds):
+        self.lon = lon
+        self.lat = lat
+        self.indptr = indptr
+        self.indices = indices
+        self.meters = meters
+        self.seconds = seconds
+        self.tree = cKDTree(unit_vectors(lon, lat))
+
+    @classmethod
+    def from_roads(cls, roads, speeds=HIGHWAY_SPEEDS, default_speed=DEFAULT_SPEED):
+        """Build the graph from a GeoDataFrame of LineStrings with a highway column (see roadExtract.read_roads)."""
+        import shapely
+        geometry = roads.geometry.values
+        coords, parts = shapely.get_coordinates(geometry, return_index=True)
+        kmh = roads["highway"].map(speeds).fillna(default_speed).values.astype(np.float64)
+        #Consecutive coordinates of the same road are a segment.
+        sameRoad = parts[1:] == parts[:-1]
+        keys = np.round(coords, NODE_PRECISION)
+        unique, nodes = np.unique(keys, axis=0, return_inverse=True)
+        nodes = np.ravel(nodes)
+        start = nodes[:-1][sameRoad]
+        end = nodes[1:][sameRoad]
+        meters = haversine(coords[:-1, 0][sameRoad], coords[:-1, 1][sameRoad], coords[1:, 0][sameRoad], coords[1:, 1][sameRoad])
+        seconds = meters / 1000 / kmh[parts[:-1][sameRoad]] * 60 * 60
+        keep = start != end
+        start, end, meters, seconds = start[keep], end[keep], meters[keep], seconds[keep]
+        return cls.from_edges(unique[:, 0], unique[:, 1], np.concatenate((start, end)), np.concatenate((end, start)),
+                              np.concatenate((meters, meters)), np.concatenate((seconds, seconds)))
+
+    @classmethod
+    def from_edges(cls, lon, lat, start, end, meters, seconds):
+        """Build the graph from node coordinates and directed edge arrays."""
+        n = len(lon)
+        #Sorted by start node, then end node, then travel time: the first edge of
+        #each (start, end) pair is its fastest, and the edges are in CSR order.
+        order = np.lexsort((seconds, end, start))
+        start, end, meters, seconds = start[order], end[order], meters[order], seconds[order]
+        first = np.ones(len(start), dtype=bool)
+        first[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+        start, end, meters, seconds = start[first], end[first], meters[first], seconds[first]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(start, minlength=n), out=indptr[1:])
+        return cls(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64), indptr,
+                   end.astype(np.int32), meters, seconds)
+
+    def __len__(self):
+        return len(self.lon)
+
+    def edge_count(self):
+        return len(self.indices)
+
+    def snap(self, lon, lat):
+        """(node, meters): the nearest graph node to each point and its great-circle distance."""
+        chord, node = self.tree.query(unit_vectors(lon, lat), workers=-1)
+        return np.asarray(node, dtype=np.int64), chord_to_meters(np.asarray(chord))
+
+    def edge_positions(self, start, end):
+        #Position in indices of the edge start -> end (which must exist).
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+        keys = rows * len(self) + self.indices
+        return np.searchsorted(keys, np.asarray(start, dtype=np.int64) * len(self) + end)
+
+    def nearest_sources(self, sourceNodes, sourceMeters, sourceSeconds, weight="distance"):
+        """One multi-source Dijkstra search from every source at once.
+
+        Each source starts at a graph node already sourceMeters/sourceSeconds
+        away (its off-road leg).  weight is "distance" or "duration", the
+        cost minimized.  Returns (source, meters, seconds) for every node:
+        the position of its nearest source (-1 if no source can reach it)
+        and the distance and travel time of the path to it, both including
+        the source's off-road leg.
+        """
+        n = len(self)
+        sourceNodes = np.asarray(sourceNodes, dtype=np.int64)
+        startCost = np.asarray(sourceMeters if weight == "distance" else sourceSeconds, dtype=np.float64)
+        #Several sources can snap to one node: only the cheapest start there matters.
+        order = np.lexsort((startCost, sourceNodes))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sourceNodes[order][1:] != sourceNodes[order][:-1]
+        best = order[first]
+        roots = sourceNodes[best]
+
+        #A virtual node n joined to each root by its start cost turns the
+        #search into an ordinary single-source one.  Edge weights are nudged
+        #up by a tiny amount, as csgraph treats zero weights as missing edges.
+        cost = self.meters if weight == "distance" else self.seconds
+        indptr = np.concatenate((self.indptr, [self.indptr[-1] + len(roots)]))
+        indices = np.concatenate((self.indices, roots.astype(np.int32)))
+        data = np.concatenate((cost, startCost[best])) + 1e-9
+        graph = csr_matrix((data, indices, indptr), shape=(n + 1, n + 1))
+        _, predecessors = dijkstra(graph, indices=n, return_predecessors=True)
+        predecessors = predecessors[:n].astype(np.int64)
+
+        #Sum the edges along each node's shortest-path tree branch by pointer
+        #doubling: log2(depth) vectorized passes instead of a walk per node.
+        reached = predecessors >= 0
+        isRoot = predecessors == n
+        parent = np.where(reached & ~isRoot, predecessors, np.arange(n))
+        edgeMeters = np.zeros(n)
+        edgeSeconds = np.zeros(n)
+        inner = np.flatnonzero(reached & ~isRoot)
+        positions = self.edge_positions(parent[inner], inner)
+        edgeMeters[inner] = self.meters[positions]
+        edgeSeconds[inner] = self.seconds[positions]
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            edgeMeters = edgeMeters + np.where(parent != np.arange(n), edgeMeters[parent], 0)
+            edgeSeconds = edgeSeconds + np.where(parent != np.arange(n), edgeSeconds[parent], 0)
+            parent = grand
+        #Every reached node's parent is now its root.
+        rootSource = np.full(n, -1, dtype=np.int64)
+        rootSource[roots] = best
+        source = np.where(reached, rootSource[parent], -1)
+        meters = np.full(n, np.nan)
+        seconds = np.full(n, np.nan)
+        meters[reached] = edgeMeters[reached] + np.asarray(sourceMeters, dtype=np.float64)[source[reached]]
+        seconds[reached] = edgeSeconds[reached] + np.asarray(sourceSeconds, dtype=np.float64)[source[reached]]
+        return source, meters, seconds
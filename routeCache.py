@@ -0,0 +1,131 @@
+import fcntl
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+class RouteCache:
+    """Two-tier cache of routed origin/destination pairs.
+
+    Keys are the origin and destination coordinates rounded to `precision`
+    decimal places (4 places is ~11 m, well inside the distance OSRM snaps a
+    point to its road), plus the routing profile and OSRM dataset version.
+    Values are the (distance, duration) pair processPoints uses, off-road legs
+    included.
+
+    The memory tier is an LRU of `memory_items` pairs.  The disk tier is a
+    SQLite file that is trimmed, oldest entries first, once it holds more than
+    `max_disk_bytes` of live data, and is emptied when opened with a different
+    dataset_version (i.e. after the OSRM dataset has been rebuilt).  SQLite
+    (and its WAL journal) is not safe on NFS, so the file must be on local
+    storage.  It is locked while open; opening a file another process holds
+    raises BlockingIOError (see processDegurb.new_route_cache).
+    """
+
+    def __init__(self, path, dataset_version, profile="driving", precision=4,
+                 memory_items=200000, max_disk_bytes=2 * 1024 ** 3):
+        self.dataset_version = str(dataset_version)
+        self.profile = profile
+        self.precision = precision
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.pending = []
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        self.db = None
+        self.lock = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            lock = open(path + ".lock", "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                raise
+            self.lock = lock
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, distance REAL,
+                               duration REAL, created REAL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS routes_created ON routes (created)")
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'dataset_version'").fetchone()
+            if row is None or row[0] != self.dataset_version:
+                print("Route cache " + str(path) + ": dataset version changed from " + str(row and row[0]) + " to " + self.dataset_version + ", clearing.")
+                self.db.execute("DELETE FROM routes")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dataset_version', ?)", (self.dataset_version,))
+            self.db.commit()
+
+    def key(self, from_x, from_y, to_x, to_y):
+        p = self.precision
+        return (self.profile + "|" + self.dataset_version + "|"
+                + "%.*f,%.*f;%.*f,%.*f" % (p, from_x, p, from_y, p, to_x, p, to_y))
+
+    def get(self, from_x, from_y, to_x, to_y):
+        """Cached (distance, duration) for the pair, or None."""
+        key = self.key(from_x, from_y, to_x, to_y)
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+            self.hits_memory = self.hits_memory + 1
+            return value
+        if self.db is not None:
+            row = self.db.execute("SELECT distance, duration FROM routes WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.hits_disk = self.hits_disk + 1
+                self._remember(key, row)
+                return row
+        self.misses = self.misses + 1
+        return None
+
+    def put(self, from_x, from_y, to_x, to_y, value):
+        key = self.key(from_x, from_y, to_x, to_y)
+        self._remember(key, tuple(value))
+        if self.db is not None:
+            self.pending.append((key, value[0], value[1], time.time()))
+
+    def flush(self):
+        """Write pending pairs to disk and trim the file to max_disk_bytes."""
+        if self.db is None or not self.pending:
+            return
+        self.db.executemany("INSERT OR REPLACE INTO routes (key, distance, duration, created) VALUES (?, ?, ?, ?)", self.pending)
+        self.pending = []
+        self.db.commit()
+        if self.disk_bytes() > self.max_disk_bytes:
+            #Drop the oldest 10% of entries; freed pages are reused by later inserts.
+            count = self.db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+            self.db.execute("DELETE FROM routes WHERE key IN (SELECT key FROM routes ORDER BY created LIMIT ?)",
+                            (max(1, count // 10),))
+            self.db.commit()
+
+    def disk_bytes(self):
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+        freelist = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist) * page_size
+
+    def stats(self):
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        hits = self.hits_memory + self.hits_disk
+        return ("Route cache: " + str(hits) + "/" + str(lookups) + " hits ("
+                + ("%.1f" % (100.0 * hits / lookups) if lookups else "0.0") + "%), "
+                + str(self.hits_memory) + " memory, " + str(self.hits_disk) + " disk, "
+                + str(self.misses) + " misses.")
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from prefect import flow, task
+from prefect_dask import DaskTaskRunner
+
+import processDegurb
+import routingMetrics
+from osrmBuild import file_sha256
+
+#Connections, routing client, route cache, inputs and their indexes are opened once per Dask
+#worker thread and reused by every batch it runs.
+_pool = threading.local()
+
+def connect():
+    return processDegurb.connect_with_retry(processDegurb.mysql_config_db)
+
+def worker_resources(concurrency):
+    if getattr(_pool, "writer", None) is None:
+        _pool.writer = processDegurb.new_result_writer(connect)
+        _pool.client = processDegurb.new_routing_client(concurrency)
+        #Each worker thread gets the first free cache slot, so later runs reuse the files.
+        _pool.cache = processDegurb.new_route_cache()
+        _pool.urbanPoints = processDegurb.load_urban_points()
+        _pool.indexes = processDegurb.routing_indexes(_pool.urbanPoints)
+        _pool.origins = processDegurb.load_origin_source()
+        if processDegurb.METRICS_PORT or processDegurb.METRICS_SUMMARY:
+            #One set of metrics per worker process; with several processes per node only the first gets the port.
+            routingMetrics.enable(processDegurb.METRICS_PORT,
+                                  processDegurb.logging_path + str(os.getenv('POD_NAME')) + "-" + str(os.getpid()) + "-metrics.json" if processDegurb.METRICS_SUMMARY else None,
+                                  processDegurb.METRICS_SUMMARY_SECONDS)
+    return _pool
+
+def routing_config():
+    #Everything besides the origins themselves that changes a batch's results.
+    return "|".join(str(v) for v in (processDegurb.OSRM_DATASET_VERSION, processDegurb.ROUTING_MODE,
+                                     processDegurb.N_CANDIDATES, processDegurb.candidate_mode(),
+                                     processDegurb.CROW_LOWER_BOUND, processDegurb.SNAP_ORIGINS, processDegurb.OFFROAD_KMH,
+                                     processDegurb.OSRM_URL, processDegurb.OSRM_SHARDS,
+                                     file_sha256(processDegurb.URBAN_PATH)))
+
+def origin_batches(pts, batchSize):
+    """Split origins into PID-ordered batches of batchSize: a list of (pid_min, pid_max, hash).
+
+    The hash covers the batch's PIDs and coordinates plus routing_config(),
+    so a batch is only recomputed if its inputs or the routing setup change.
+    """
+    pts = pts.sort_values("PID")
+    config = routing_config().encode()
+    pids = pts["PID"].values
+    coords = np.column_stack((pts.geometry.x.values, pts.geometry.y.values))
+    batches = []
+    for start in range(0, len(pts), batchSize):
+        h = hashlib.sha256(config)
+        h.update(np.ascontiguousarray(pids[start:start + batchSize]).tobytes())
+        h.update(np.ascontiguousarray(coords[start:start + batchSize]).tobytes())
+        batches.append((pids[start].item(), pids[min(start + batchSize, len(pts)) - 1].item(), h.hexdigest()))
+    return batches
+
+def batch_cache_key(context, parameters):
+    return "degurba-batch-" + parameters["batchHash"]
+
+@task(name="Route Origin Batch",
+      description="Route one PID range of origins and write the results to roadresults",
+      task_run_name="batch-{pidMin}-{pidMax}",
+      retries=2, retry_delay_seconds=60,
+      cache_key_fn=batch_cache_key, cache_expiration=timedelta(days=30), persist_result=True,
+      log_prints=True)
+def routeBatch(pidMin: int, pidMax: int, batchHash: str, concurrency: int = 32):
+    """
+    Routes the origins with pidMin <= PID <= pidMax, skipping any already in
+    roadresults (e.g. from a failed earlier attempt), and commits the results
+    before returning.  Results are cached by batchHash, so a rerun of the
+    flow skips batches that completed with the same inputs.
+
+    Returns:
+    dict: Counts of origins routed and already done.
+    """
+    resources = worker_resources(concurrency)
+    batchPts = resources.origins.subset(pid_range=(pidMin, pidMax)).read()
+    done = resources.writer.done_pids(batchPts["PID"])
+    batchPts = batchPts[~batchPts["PID"].map(str).isin(done)]
+    routed = processDegurb.processPoints(batchPts, resources.writer, resources.urbanPoints,
+                                         resources.client, resources.cache, indexes=resources.indexes)
+    #The task result is cached, so the batch has to be durable before it returns.
+    resources.writer.commit()
+    return {"pidMin": pidMin, "pidMax": pidMax, "routed": routed, "alreadyDone": len(done)}
+
+@flow(name="Degurba Routing Batches",
+      description="Route origin batches in parallel on the Dask task runner.",
+      log_prints=True)
+def routeBatches(BATCHES: list, CONCURRENCY: int = 32):
+    jobs = []
+    for pidMin, pidMax, batchHash in BATCHES:
+        job = routeBatch.submit(pidMin, pidMax, batchHash, CONCURRENCY)
+        jobs.append(job)
+
+    results = []
+    for j in jobs:
+        results.append(j.result())
+    return(results)
+
+@flow(name="Degurba Routing Flow",
+      description="Drive distances from every origin to its closest urban area.",
+      flow_run_name="{TIMESTAMP}",
+      log_prints=True)
+def degurbaRouting(BATCH_SIZE: int = 5000,
+                   WORKERS: int = 4,
+                   CONCURRENCY: int = 32,
+                   PROCESSES: bool = True,
+                   TIMESTAMP: str = str(datetime.now())):
+    """
+    Parameters:
+    BATCH_SIZE (int): Origins per task.  Each task commits its results, which
+        with RESULT_SINK=parquet finishes a shard file, so use larger batches there.
+    WORKERS (int): Dask workers, each running one batch at a time.
+    CONCURRENCY (int): OSRM requests in flight per worker.
+    PROCESSES (bool): Run Dask workers as processes (False uses threads).
+    """
+    pts = processDegurb.load_origin_points()
+    batches = origin_batches(pts, BATCH_SIZE)
+    print("Routing " + str(len(pts)) + " origins in " + str(len(batches)) + " batches.")
+    runner = DaskTaskRunner(cluster_kwargs={"n_workers": WORKERS, "threads_per_worker": 1, "processes": PROCESSES})
+    results = routeBatches.with_options(task_runner=runner)(batches, CONCURRENCY)
+    print("Routed " + str(sum(r["routed"] for r in results)) + " origins; "
+          + str(sum(r["alreadyDone"] for r in results)) + " were already done.")
+    return(results)
+
+if __name__ == "__main__":
+    degurbaRouting()
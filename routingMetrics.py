@@ -0,0 +1,199 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Histogram bucket upper bounds in seconds, shared by every stage.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "globalroads_"
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class NullMetrics:
+    """Stand-in used while metrics are disabled: every call is a no-op."""
+
+    enabled = False
+
+    def observe(self, stage, seconds):
+        pass
+
+    def inc(self, name, amount=1):
+        pass
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+class Metrics:
+    """Per-stage timing histograms and counters for the routing pipeline.
+
+    observe() records a duration for a stage, inc() bumps a counter; both are
+    thread safe.  The "origins" counter drives the throughput figure.  The
+    same numbers are available as Prometheus text (prometheus(), or serve()
+    on a port) and as a JSON summary (summary(), or report_every() to a file).
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                #Per-bucket counts (the last is +Inf), then count, sum and max.
+                hist = self.stages[stage] = [[0] * (len(self.buckets) + 1), 0, 0.0, 0.0]
+            hist[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[1] += 1
+            hist[2] += seconds
+            if seconds > hist[3]:
+                hist[3] = seconds
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def _snapshot(self):
+        with self.lock:
+            stages = {s: (list(h[0]), h[1], h[2], h[3]) for s, h in self.stages.items()}
+            return stages, dict(self.counters), time.time() - self.started
+
+    def _quantile(self, counts, total, q, maximum):
+        #Upper bound of the bucket holding the q-th observation.
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.buckets + (maximum,), counts):
+            seen = seen + n
+            if seen >= rank:
+                return min(bound, maximum)
+        return maximum
+
+    def summary(self):
+        stages, counters, elapsed = self._snapshot()
+        origins = counters.get("origins", 0)
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "elapsed_seconds": round(elapsed, 3),
+                "origins_per_second": round(origins / elapsed, 3) if elapsed > 0 else 0.0,
+                "counters": counters,
+                "stages": {s: {"count": n,
+                               "total_seconds": round(total, 6),
+                               "mean_seconds": round(total / n, 6) if n else 0.0,
+                               "p50_seconds": round(self._quantile(counts, n, 0.5, maximum), 6),
+                               "p95_seconds": round(self._quantile(counts, n, 0.95, maximum), 6),
+                               "max_seconds": round(maximum, 6)}
+                           for s, (counts, n, total, maximum) in sorted(stages.items())}}
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        stages, counters, elapsed = self._snapshot()
+        lines = ["# HELP " + PREFIX + "stage_seconds Time spent in each routing pipeline stage.",
+                 "# TYPE " + PREFIX + "stage_seconds histogram"]
+        for stage, (counts, n, total, maximum) in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative = cumulative + count
+                lines.append(PREFIX + 'stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, cumulative))
+            lines.append(PREFIX + 'stage_seconds_sum{stage="%s"} %r' % (stage, total))
+            lines.append(PREFIX + 'stage_seconds_count{stage="%s"} %d' % (stage, n))
+        for name, value in sorted(counters.items()):
+            lines.append("# TYPE " + PREFIX + name + "_total counter")
+            lines.append(PREFIX + name + "_total " + repr(value))
+        lines.append("# TYPE " + PREFIX + "origins_per_second gauge")
+        lines.append(PREFIX + "origins_per_second " + repr(counters.get("origins", 0) / elapsed if elapsed > 0 else 0.0))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serve prometheus() at /metrics from a daemon thread; returns the server, or None if the port is taken."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, int(port)), Handler)
+        except OSError as e:
+            print("Metrics server not started on port " + str(port) + ": " + str(e))
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def write_summary(self, path):
+        #Written under a temporary name and renamed, so readers never see a partial file.
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.summary(), f, indent=1)
+        os.replace(tmpPath, path)
+
+    def report_every(self, path, interval=60):
+        """Rewrite the JSON summary at path every interval seconds, and once more at exit."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_summary(path)
+                except OSError as e:
+                    print("Metrics summary not written: " + str(e))
+
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(self.write_summary, path)
+
+#Instrumented code calls routingMetrics.metrics.<method>; until enable() is
+#called that is a NullMetrics, so the instrumentation costs one no-op call.
+metrics = NullMetrics()
+
+def enable(port=None, summaryPath=None, interval=60):
+    """Start collecting metrics in this process (later calls return the same Metrics).
+
+    With port, Prometheus metrics are served at http://<host>:<port>/metrics;
+    with summaryPath, a JSON summary is rewritten there every interval seconds.
+    """
+    global metrics
+    if not metrics.enabled:
+        metrics = Metrics()
+        if port:
+            metrics.serve(port)
+        if summaryPath:
+            metrics.report_every(summaryPath, interval)
+    return metrics
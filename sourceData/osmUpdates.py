@@ -0,0 +1,101 @@
+import gzip
+import os
+import shutil
+import subprocess
+
+import requests
+
+def sequence_path(sequence):
+    """Replication path for a sequence number: 4123 -> "000/004/123"."""
+    s = "%09d" % int(sequence)
+    return s[0:3] + "/" + s[3:6] + "/" + s[6:9]
+
+def parse_state(text):
+    """Sequence number from a replication state.txt."""
+    for line in text.splitlines():
+        if line.startswith("sequenceNumber="):
+            return int(line.split("=", 1)[1].strip())
+    raise ValueError("No sequenceNumber in state file")
+
+def remote_sequence(baseUrl, timeout=60):
+    r = requests.get(baseUrl + "/state.txt", timeout=timeout)
+    r.raise_for_status()
+    return parse_state(r.text)
+
+def header_option(pbfPath, name, env=None):
+    """A header option of an OSM file (e.g. osmosis_replication_sequence_number), or None."""
+    result = subprocess.run(["osmium", "fileinfo", "-g", "header.option." + name, pbfPath],
+                            env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    value = result.stdout.strip()
+    return value or None
+
+def fetch_diff(baseUrl, sequence, path, timeout=60):
+    """Download one .osc.gz diff; returns False if the server doesn't have it."""
+    r = requests.get(baseUrl + "/" + sequence_path(sequence) + ".osc.gz", stream=True, timeout=timeout)
+    with r:
+        if r.status_code == 404:
+            return False
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    #A truncated gzip stream would make osmium fail half-way through the apply.
+    with gzip.open(path, "rb") as f:
+        while f.read(1024 * 1024):
+            pass
+    return True
+
+def update_extract(pbfPath, baseUrl, workdir, env=None, max_diffs=60, log=print, keep=None):
+    """Bring an extract up to date by applying replication diffs instead of re-downloading it.
+
+    The extract's current sequence number is read from its PBF header (Geofabrik
+    extracts carry osmosis_replication_sequence_number), every diff after it up
+    to the server's state.txt is fetched into workdir, and osmium apply-changes
+    writes the updated extract, with the new sequence number in its header,
+    before it replaces pbfPath.  With keep, the applied diffs are then moved
+    into that folder (so files built from the extract can apply them too)
+    instead of being deleted with workdir.
+
+    Returns True if the extract is now current.  Returns False when a full
+    download is needed instead: no local file or sequence number, more than
+    max_diffs diffs behind, or a gap in the diff chain on the server.
+    """
+    if not os.path.exists(pbfPath):
+        return False
+    local = header_option(pbfPath, "osmosis_replication_sequence_number", env)
+    if local is None:
+        log(str(pbfPath) + ": No replication sequence number in header; full download needed.")
+        return False
+    local = int(local)
+    remote = remote_sequence(baseUrl)
+    if remote <= local:
+        log(str(pbfPath) + ": Up to date at sequence " + str(local) + ".")
+        return True
+    if remote - local > max_diffs:
+        log(str(pbfPath) + ": " + str(remote - local) + " diffs behind; full download is cheaper.")
+        return False
+
+    os.makedirs(workdir, exist_ok=True)
+    diffs = []
+    try:
+        for sequence in range(local + 1, remote + 1):
+            path = os.path.join(workdir, str(sequence) + ".osc.gz")
+            if not fetch_diff(baseUrl, sequence, path):
+                log(str(pbfPath) + ": Diff " + str(sequence) + " missing from " + baseUrl + "; diff chain broken.")
+                return False
+            diffs.append(path)
+
+        updated = pbfPath + ".updated.osm.pbf"
+        command = ["osmium", "apply-changes", pbfPath] + diffs + [
+            "--output-header=osmosis_replication_sequence_number=" + str(remote),
+            "--overwrite", "-o", updated]
+        subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        os.replace(updated, pbfPath)
+        if keep is not None:
+            os.makedirs(keep, exist_ok=True)
+            for path in diffs:
+                shutil.move(path, os.path.join(keep, os.path.basename(path)))
+        log(str(pbfPath) + ": Applied " + str(len(diffs)) + " diffs, now at sequence " + str(remote) + ".")
+        return True
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
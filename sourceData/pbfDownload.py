@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+class DownloadError(Exception):
+    pass
+
+def _read_meta(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_meta(path, meta):
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def _validators(headers):
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+def remote_validators(url, timeout=60):
+    """ETag and Last-Modified of the remote file, from a HEAD request."""
+    r = requests.head(url, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    return _validators(r.headers)
+
+def remote_size(url, timeout=60):
+    """Size in bytes of the remote file from a HEAD request, or None if the server doesn't say."""
+    r = requests.head(url, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    length = r.headers.get("Content-Length")
+    return int(length) if length else None
+
+def is_current(url, path, timeout=60):
+    """True if path holds the version of url the server is currently offering.
+
+    Compares the ETag/Last-Modified recorded when path was downloaded with the
+    server's.  If the server cannot be reached, an existing file is kept.
+    """
+    if not os.path.exists(path):
+        return False
+    local = _read_meta(path + ".meta")
+    if not local:
+        return False
+    try:
+        remote = remote_validators(url, timeout)
+    except requests.exceptions.RequestException:
+        return True
+    if remote["etag"] and local.get("etag"):
+        return remote["etag"] == local["etag"]
+    return bool(remote["last_modified"]) and remote["last_modified"] == local.get("last_modified")
+
+def expected_md5(url, timeout=60):
+    """The checksum from Geofabrik's <file>.md5 sidecar ("<hash>  <name>"), or None if there isn't one."""
+    try:
+        r = requests.get(url + ".md5", timeout=timeout)
+    except requests.exceptions.RequestException:
+        return None
+    if r.status_code != 200 or not r.text.strip():
+        return None
+    return r.text.split()[0].lower()
+
+def download(url, path, retries=5, base_wait=5, timeout=60, chunk_size=CHUNK_SIZE, verify_md5=True, log=print):
+    """Stream url to path without holding it in memory.
+
+    Data goes to <path>.part in chunk_size pieces.  After a dropped connection
+    the transfer resumes from the end of the partial file with an HTTP Range
+    request (guarded by If-Range, so a file that changed on the server restarts
+    from zero), waiting base_wait * 2**attempt seconds between attempts.  The
+    result is checked against the .md5 sidecar if the server has one, then
+    renamed into place, so path is never left half-written.
+
+    Returns False if path is already current (see is_current), True after a
+    download.  Raises DownloadError if the file cannot be retrieved.
+    """
+    if is_current(url, path, timeout):
+        log(str(path) + ": Matches the server's current version. Skipping download.")
+        return False
+
+    partPath = path + ".part"
+    partMeta = _read_meta(partPath + ".meta")
+    md5 = expected_md5(url, timeout) if verify_md5 else None
+
+    for attempt in range(retries):
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        headers = {}
+        validator = partMeta.get("etag") or partMeta.get("last_modified")
+        if offset and validator:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            headers["If-Range"] = validator
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416:
+                    #The partial file is already complete.
+                    pass
+                elif r.status_code not in (200, 206):
+                    raise DownloadError(str(url) + ": Error during download.  Status code: " + str(r.status_code))
+                else:
+                    if r.status_code == 200:
+                        #No resume: a fresh download, or the file changed on the server.
+                        offset = 0
+                        partMeta = _validators(r.headers)
+                        _write_meta(partPath + ".meta", partMeta)
+                    else:
+                        log(str(path) + ": Resuming at byte " + str(offset) + ".")
+                    with open(partPath, "r+b" if offset else "wb") as f:
+                        f.seek(offset)
+                        f.truncate()
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+            break
+        except (requests.exceptions.RequestException, OSError) as e:
+            log(f"Attempt {attempt + 1}/{retries}: Download of {url} interrupted - {str(e)}")
+            if attempt == retries - 1:
+                raise DownloadError(str(url) + ": Download failed after " + str(retries) + " attempts.") from e
+            wait_time = base_wait * (2 ** attempt)
+            log(f"Retrying in {wait_time} seconds...")
+            time.sleep(wait_time)
+
+    if md5 is not None:
+        digest = file_md5(partPath, chunk_size)
+        if digest != md5:
+            #A corrupt partial file can't be resumed from, so start over next time.
+            os.remove(partPath)
+            raise DownloadError(str(path) + ": Checksum mismatch (expected " + md5 + ", got " + digest + ").")
+        log(str(path) + ": Checksum verified.")
+
+    os.replace(partPath, path)
+    _write_meta(path + ".meta", partMeta)
+    if os.path.exists(partPath + ".meta"):
+        os.remove(partPath + ".meta")
+    return True
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
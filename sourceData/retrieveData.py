@@ -1,12 +1,12 @@
 import requests
-import geopandas as gpd
 import shutil
 from datetime import datetime, timedelta
 import os
-import traceback
-import gc
+import dask
 from prefect import flow, task
 from prefect_dask import DaskTaskRunner
+from pbfDownload import download, remote_size, DownloadError
+from roadExtract import extract_road_dataset, ROADS_SUBSET
 
 # Constants
 
@@ -25,6 +25,25 @@ OUTPUTPATH = "/sciclone/geograd/_deployed/globalRoads/sourceData/parquet"
 ORIGINALPATH = "/sciclone/geograd/_deployed/globalRoads/sourceData/original"
 LOGBASEPATH = "/sciclone/geograd/_deployed/globalRoads/logs"
 STALE_DAYS = 3
+#Size (degrees) of the spatial tiles the road datasets are partitioned by.
+TILE_DEGREES = 5.0
+
+#Dask cluster for osm_data_processing: DASK_WORKERS workers of WORKER_THREADS
+#threads, each offering WORKER_MEMORY_GB of the "MEMORY" resource.  Every
+#conversion reserves PBF_MEMORY_FACTOR GB per GB of PBF (at least
+#MIN_TASK_MEMORY_GB, at most a whole worker), so small continents share a
+#worker while Asia or Europe get one to themselves.  Downloads stream to disk
+#and reserve DOWNLOAD_MEMORY_GB.
+DASK_WORKERS = 2
+WORKER_THREADS = 4
+WORKER_MEMORY_GB = 28
+PBF_MEMORY_FACTOR = 2.0
+MIN_TASK_MEMORY_GB = 1
+DOWNLOAD_MEMORY_GB = 1
+#Assumed PBF size when neither the local file nor the server gives one.
+DEFAULT_PBF_GB = 5
+#How long (seconds) the flow waits on one download before checking the next.
+DOWNLOAD_POLL_SECONDS = 1
 
 def pLogger(id, type, message, path=LOGBASEPATH):
     with open(path + "/" + str(id) + ".log", "a") as f:
@@ -35,117 +54,131 @@ def check_and_recreate_folder(folder_path):
         shutil.rmtree(folder_path)
     os.makedirs(folder_path)
 
-def convertToGeoJSON(jobID):
-    TMPPATH = TMPBASEPATH + "/" + str(jobID)
-    FILEPATH = TMPPATH + "/" + str(jobID) + ".geojson"
-    pbfInput = TMPPATH + "/" + str(jobID) + ".osm.pbf"
+def job_id(url):
+    return url.split("/")[3].split(".")[0].split("-")[0]
 
-    if os.path.isfile(FILEPATH):
-        os.remove(FILEPATH)
-    command = 'ogr2ogr -f GeoJSON ' + FILEPATH + " " + pbfInput + " lines"
-    pLogger(jobID, "INFO", "Preparing to convert to geoJSON: " + str(command))
-    os.system(command)
-    pLogger(jobID, "INFO", "geoJSON Conversion Successful")
+def pbf_gigabytes(url, jobID):
+    """Size of a continent's PBF in GB: the local copy if there is one, else the server's Content-Length."""
+    pbfPath = ORIGINALPATH + "/" + str(jobID) + ".osm.pbf"
+    if os.path.exists(pbfPath):
+        return os.path.getsize(pbfPath) / 1024 ** 3
+    try:
+        size = remote_size(url)
+    except requests.exceptions.RequestException:
+        size = None
+    return DEFAULT_PBF_GB if size is None else size / 1024 ** 3
+
+def conversion_memory(pbfGB):
+    #GB of the worker "MEMORY" resource a conversion of a pbfGB PBF reserves.
+    return min(WORKER_MEMORY_GB, max(MIN_TASK_MEMORY_GB, pbfGB * PBF_MEMORY_FACTOR))
+
+@task(task_run_name="filter-{jobID}")
+def filterPBF_createParquet(jobID, pbfPath=None):
+    parquet_file = OUTPUTPATH + "/" + str(jobID) + ".parquet"
+    pbfInput = ORIGINALPATH + "/" + str(jobID) + ".osm.pbf" if pbfPath is None else pbfPath
+    pLogger(jobID, "INFO", "Beginning PBF road extraction")
+
+    if os.path.exists(parquet_file):
+        file_mod_time = datetime.fromtimestamp(os.path.getmtime(parquet_file))
+        if datetime.now() - file_mod_time < timedelta(days=STALE_DAYS):
+            pLogger(jobID, "INFO", "Parquet file is up-to-date. Skipping filtering and creation.")
+            return "SKIP"
 
-@task
-def filtergeoJson_createParquet(jobID):
+    #The highway filter is applied by GDAL while reading the PBF, and roads are
+    #streamed in batches into a dataset partitioned by highway class and
+    #TILE_DEGREES tile (read regions back with roadExtract.read_roads).
+    TMPPATH = TMPBASEPATH + "/" + str(jobID)
+    os.makedirs(TMPPATH, exist_ok=True)
     try:
-        parquet_file = OUTPUTPATH + "/" + str(jobID) + ".parquet"
-        pLogger(jobID, "INFO", "Beginning geoJSON-based Filtering")
-        TMPPATH = TMPBASEPATH + "/" + str(jobID)
-        geoJSONPath = TMPPATH + "/" + str(jobID) + ".geojson"
-
-        if os.path.exists(parquet_file):
-            file_mod_time = datetime.fromtimestamp(os.path.getmtime(parquet_file))
-            if datetime.now() - file_mod_time < timedelta(days=STALE_DAYS):
-                pLogger(jobID, "INFO", "Parquet file is up-to-date. Skipping filtering and creation.")
-                return "SKIP"
-
-        jsonOSM = gpd.read_file(geoJSONPath)
-        pLogger(jobID, "INFO", "geoJSON Loaded, moving into filtering.")
-        roadsSubset = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'residential', 'motorway_link', 'trunk_link',
-                    'primary_link', 'secondary_link', 'tertiary_link', 'living_street', 'track']
-
-        roadways = jsonOSM.loc[jsonOSM['highway'].isin(roadsSubset)]
-        pLogger(jobID, "INFO", "geoJSON filtered, saving as Parquet.")
-        roadways.to_parquet(parquet_file)
+        roads = extract_road_dataset(pbfInput, parquet_file, ROADS_SUBSET, tile_degrees=TILE_DEGREES, tmpdir=TMPPATH,
+                                     log=lambda message: pLogger(jobID, "INFO", message))
     except Exception as e:
         pLogger(jobID, "ERROR", str(e))
+        raise
+    pLogger(jobID, "INFO", str(roads) + " roads saved as a partitioned Parquet dataset.")
+    return roads
 
 @task
 def fetch_data(url):
     response = requests.get(url)
     return response.json()
 
-@task
+@task(task_run_name="download-{jobID}", retries=2, retry_delay_seconds=60)
 def download_feature(url, jobID):
     TMPPATH = TMPBASEPATH + "/" + str(jobID)
     FILEPATH = ORIGINALPATH + "/" + str(jobID) + ".osm.pbf"
 
-    if os.path.exists(FILEPATH):
-        file_mod_time = datetime.fromtimestamp(os.path.getmtime(FILEPATH))
-        if datetime.now() - file_mod_time < timedelta(days=STALE_DAYS):
-            pLogger(jobID, "INFO", "File is up-to-date. Skipping download.")
-            return "SKIP"
-
-    check_and_recreate_folder(TMPPATH)
-    
     try:
         pLogger(jobID, "INFO", "Downloading: " + str(url))
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(FILEPATH, 'wb') as file:
-                file.write(response.content)
-            pLogger(jobID, "INFO", "File downloaded.")
-            return "PASS"
-        else:
-            pLogger(jobID, "CRIT", "Failed to retrieve the file. Status code: " + str(response.status_code))
-            return "FAIL"
-    except Exception as e:
-        pLogger(jobID, "CRIT", "Failed to retrieve the file with an exception. Error: " + str(e))
-        return "FAIL"
-
-@task
-def process_file(url, jobID):
-    try:
-        parquet_file = OUTPUTPATH + "/" + str(jobID) + ".parquet"
-        if not os.path.exists(parquet_file):
-            downloadOutcome = download_feature(url, jobID)
-            
-            if(downloadOutcome != "FAIL"):
-                convertToGeoJSON(jobID)
-                pLogger("MASTER", "INFO", str(jobID) + " master loop moving into filtering.")
-                filtergeoJson_createParquet(jobID)
-                pLogger("MASTER", "INFO", str(jobID) + " DONE.")
-                return [jobID,"DONE"]
-            else:
-                pLogger("MASTER_ERROR", "CRIT", "Download failed for: " + str(jobID) + " with URL: " + str(url))
-                return [jobID,"FAIL"]
-        else:
+        #Streams to disk, resumes interrupted transfers and verifies the .md5 sidecar;
+        #skips the download if the server's ETag/Last-Modified are unchanged.
+        if not download(url, FILEPATH, log=lambda message: pLogger(jobID, "INFO", message)):
+            pLogger(jobID, "INFO", "File is up-to-date. Skipping download.")
+            return FILEPATH
+        check_and_recreate_folder(TMPPATH)
+        pLogger(jobID, "INFO", "File downloaded.")
+        return FILEPATH
+    except DownloadError as e:
+        pLogger(jobID, "CRIT", "Failed to retrieve the file. Error: " + str(e))
+        raise
+
+def submit_conversion(jobID, pbfPath, pbfGB):
+    memory = conversion_memory(pbfGB)
+    pLogger("MASTER", "INFO", str(jobID) + " moving into filtering, reserving " + str(round(memory, 1)) + " GB.")
+    with dask.annotate(resources={"MEMORY": memory}):
+        return filterPBF_createParquet.submit(jobID, pbfPath)
+
+def dask_runner(workers=DASK_WORKERS, threads=WORKER_THREADS, memoryGB=WORKER_MEMORY_GB, processes=True):
+    return DaskTaskRunner(cluster_kwargs={"n_workers": workers, "threads_per_worker": threads, "processes": processes,
+                                          "resources": {"MEMORY": memoryGB}})
+
+@flow(task_runner=dask_runner(), log_prints=True)
+def osm_data_processing(urls):
+    """
+    Download every continent in urls and convert its roads, each continent as
+    its own download -> filter task chain on the Dask workers.  Failed
+    downloads and conversions are left as Failed task states.
+
+    Parameters:
+    urls (list): Geofabrik PBF URLs.
+
+    Returns:
+    list: The final state of each continent's chain; the flow fails if any failed.
+    """
+    #Largest first, so the continents that need a worker to themselves start early.
+    sizes = {url: pbf_gigabytes(url, job_id(url)) for url in urls}
+    downloads = {}
+    for url in sorted(urls, key=sizes.get, reverse=True):
+        jobID = job_id(url)
+        if os.path.exists(OUTPUTPATH + "/" + str(jobID) + ".parquet"):
             pLogger("MASTER", "INFO", str(jobID) + " parquet file already exists. Skipping.")
-            return [jobID, "ALREADY EXISTS"]
-    except Exception as e:
-        pLogger("MASTER_ERROR", "CRIT", "The feature was unable to be processed: " + str(jobID))
-        pLogger("MASTER_ERROR", "CRIT", "E: " + str(e))
-        pLogger("MASTER_ERROR", "CRIT", "Trace: " + str(traceback.format_exc()))
-        return [jobID,"ERROR"]
-
-@task
-def process_links(urls):
-    results = []
-    for url in urls:
-        jobID = url.split("/")[3].split(".")[0].split("-")[0]
+            continue
         pLogger("MASTER", "INFO", "Processing: " + str(url))
-        result = process_file(url, jobID)
-        pLogger("MASTER", "INFO", "Result Completed: " + str(result))
-        results.append(result)
-        del result
-        gc.collect()
-    return results
-
-@flow(task_runner=DaskTaskRunner())
-def osm_data_processing(urls):
-    process_links(urls)
+        with dask.annotate(resources={"MEMORY": DOWNLOAD_MEMORY_GB}):
+            downloads[jobID] = (url, download_feature.submit(url, jobID))
+
+    #A conversion is submitted once its download is done rather than made to
+    #wait on it, so it never holds a worker's memory while the PBF downloads.
+    states = {}
+    conversions = {}
+    while downloads:
+        for jobID, (url, job) in list(downloads.items()):
+            state = job.wait(DOWNLOAD_POLL_SECONDS)
+            if state is None:
+                continue
+            del downloads[jobID]
+            if state.is_completed():
+                conversions[jobID] = submit_conversion(jobID, state.result(), pbf_gigabytes(url, jobID))
+            else:
+                states[jobID] = state
+    for jobID, job in conversions.items():
+        states[jobID] = job.wait()
+
+    for jobID, state in states.items():
+        pLogger("MASTER", "INFO", str(jobID) + " " + state.name + ".")
+        if not state.is_completed():
+            pLogger("MASTER_ERROR", "CRIT", str(jobID) + " did not complete: " + str(state.message))
+    return list(states.values())
 
 if __name__ == "__main__":
     osm_data_processing(LINKS)
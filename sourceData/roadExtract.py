@@ -0,0 +1,220 @@
+import json
+import math
+import os
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+#Side file of a road dataset listing, per tile, the widest and tallest road
+#extent (degrees) of the roads assigned to it, so read_roads knows how far
+#outside a bbox a road can start and still reach into it.
+TILE_EXTENTS = "_tiles.json"
+
+ROADS_SUBSET = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'residential', 'motorway_link', 'trunk_link',
+                'primary_link', 'secondary_link', 'tertiary_link', 'living_street', 'track']
+
+def highway_where(highways):
+    return "highway IN (" + ", ".join("'" + h + "'" for h in highways) + ")"
+
+def geoparquet_metadata(geometry_types):
+    #GeoParquet 1.0 "geo" key; no crs means OGC:CRS84 (lon/lat), which is what OSM data is in.
+    return {"version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": geometry_types}}}
+
+def road_batches(pbfPath, highways=ROADS_SUBSET, batch_size=65536, columns=None):
+    """Stream the road features of an OSM PBF as pyarrow RecordBatches.
+
+    Reads the OGR "lines" layer with the highway filter applied inside GDAL, so
+    non-road features are never materialized in Python.  The geometry column is
+    WKB, named "geometry".
+    """
+    with pyogrio.open_arrow(pbfPath, layer="lines", where=highway_where(highways), columns=columns,
+                            batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometryName = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            names = ["geometry" if n == geometryName else n for n in batch.schema.names]
+            yield batch.rename_columns(names)
+
+def extract_roads(pbfPath, parquetPath, highways=ROADS_SUBSET, batch_size=65536, row_group_size=262144,
+                  tmpdir=None, log=print):
+    """Write the roads of an OSM PBF straight to a GeoParquet file.
+
+    Features are streamed batch_size at a time into a ParquetWriter with row
+    groups of row_group_size rows, so memory use is bounded by the batch size
+    rather than the size of the continent.  The file is written next to
+    parquetPath and renamed into place when complete.  tmpdir is where GDAL's
+    OSM driver keeps its node index for large files.  Returns the number of
+    roads written.
+    """
+    if tmpdir is not None:
+        pyogrio.set_gdal_config_options({"CPL_TMPDIR": tmpdir})
+    partPath = parquetPath + ".part"
+    writer = None
+    rows = 0
+    try:
+        for batch in road_batches(pbfPath, highways, batch_size):
+            if writer is None:
+                schema = batch.schema.with_metadata({b"geo": json.dumps(geoparquet_metadata(["LineString"])).encode()})
+                writer = pq.ParquetWriter(partPath, schema, compression="snappy")
+            writer.write_batch(batch, row_group_size=row_group_size)
+            rows = rows + batch.num_rows
+            log("Wrote " + str(rows) + " roads.")
+        if writer is None:
+            #No roads in the extract; still produce a (empty) file so the step is not rerun.
+            schema = pa.schema([("geometry", pa.binary())],
+                               metadata={b"geo": json.dumps(geoparquet_metadata([])).encode()})
+            writer = pq.ParquetWriter(partPath, schema)
+        writer.close()
+        writer = None
+        os.replace(partPath, parquetPath)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(partPath):
+            os.remove(partPath)
+    return rows
+
+def tile_ids(x, y, tile_degrees):
+    """Coarse spatial tile number for lon/lat arrays: row-major cells of tile_degrees."""
+    ncols = int(math.ceil(360.0 / tile_degrees))
+    tx = np.clip(np.floor((np.asarray(x) + 180.0) / tile_degrees), 0, ncols - 1).astype(np.int32)
+    ty = np.floor((np.asarray(y) + 90.0) / tile_degrees).astype(np.int32)
+    return ty * ncols + tx
+
+def with_bbox_and_tile(batch, tile_degrees):
+    #Adds xmin/ymin/xmax/ymax columns (whose row-group statistics let readers skip
+    #row groups) and the tile partition column, from each road's lower-left corner.
+    bounds = shapely.bounds(shapely.from_wkb(batch.column("geometry").to_numpy(zero_copy_only=False)))
+    columns = list(batch.columns)
+    names = list(batch.schema.names)
+    for i, name in enumerate(["xmin", "ymin", "xmax", "ymax"]):
+        columns.append(pa.array(bounds[:, i], type=pa.float64()))
+        names.append(name)
+    columns.append(pa.array(tile_ids(bounds[:, 0], bounds[:, 1], tile_degrees), type=pa.int32()))
+    names.append("tile")
+    return pa.RecordBatch.from_arrays(columns, names=names)
+
+def update_tile_extents(batch, extents):
+    #Folds a with_bbox_and_tile batch into extents {tile: [max width, max height]}.
+    tiles = batch.column("tile").to_numpy()
+    width = batch.column("xmax").to_numpy() - batch.column("xmin").to_numpy()
+    height = batch.column("ymax").to_numpy() - batch.column("ymin").to_numpy()
+    for tile in np.unique(tiles):
+        mask = tiles == tile
+        old = extents.get(int(tile), [0.0, 0.0])
+        extents[int(tile)] = [max(old[0], float(width[mask].max())), max(old[1], float(height[mask].max()))]
+
+def extract_road_dataset(pbfPath, datasetPath, highways=ROADS_SUBSET, tile_degrees=5.0, batch_size=65536,
+                         min_rows_per_group=16384, max_rows_per_group=131072, tmpdir=None, log=print):
+    """Write the roads of an OSM PBF as a Hive-partitioned GeoParquet dataset.
+
+    Partitions are highway=<class>/tile=<n>, where tile is the tile_degrees cell
+    holding each road's lower-left corner (see tile_ids).  Every file carries
+    xmin/ymin/xmax/ymax columns with per-row-group statistics, so read_roads
+    can prune both partitions and row groups for a bbox; TILE_EXTENTS records
+    how far the roads of each tile reach beyond it.  The dataset is built
+    next to datasetPath and swapped into place when complete.  Returns the
+    number of roads written.
+    """
+    if tmpdir is not None:
+        pyogrio.set_gdal_config_options({"CPL_TMPDIR": tmpdir})
+    partPath = datasetPath + ".part"
+    if os.path.exists(partPath):
+        shutil.rmtree(partPath)
+    counts = {"rows": 0}
+    extents = {}
+
+    def batches():
+        for batch in road_batches(pbfPath, highways, batch_size):
+            counts["rows"] = counts["rows"] + batch.num_rows
+            log("Partitioned " + str(counts["rows"]) + " roads.")
+            batch = with_bbox_and_tile(batch, tile_degrees)
+            update_tile_extents(batch, extents)
+            yield batch
+
+    stream = batches()
+    first = next(stream, None)
+    if first is None:
+        os.makedirs(partPath)
+    else:
+        geo = geoparquet_metadata(["LineString"])
+        geo["tile_degrees"] = tile_degrees
+        schema = first.schema.with_metadata({b"geo": json.dumps(geo).encode()})
+        reader = pa.RecordBatchReader.from_batches(schema, (b for chain in ([first], stream) for b in chain))
+        partitioning = ds.partitioning(pa.schema([("highway", pa.string()), ("tile", pa.int32())]), flavor="hive")
+        ds.write_dataset(reader, partPath, format="parquet", partitioning=partitioning,
+                         min_rows_per_group=min_rows_per_group, max_rows_per_group=max_rows_per_group,
+                         existing_data_behavior="overwrite_or_ignore")
+    with open(os.path.join(partPath, TILE_EXTENTS), "w") as f:
+        json.dump({"tile_degrees": tile_degrees, "tiles": {str(t): e for t, e in extents.items()}}, f)
+    if os.path.exists(datasetPath):
+        shutil.rmtree(datasetPath)
+    os.replace(partPath, datasetPath)
+    return counts["rows"]
+
+def dataset_tile_extents(datasetPath):
+    #(tile_degrees, {tile: (max width, max height)}) from TILE_EXTENTS, or None
+    #for datasets written without it.
+    path = os.path.join(datasetPath, TILE_EXTENTS)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        extents = json.load(f)
+    return extents["tile_degrees"], {int(t): tuple(e) for t, e in extents["tiles"].items()}
+
+def bbox_tiles(bbox, tile_degrees, extents):
+    #Tiles holding a road that can intersect bbox: the tile's cell, widened
+    #right and up by the largest road extent in it, overlaps the bbox.
+    qxmin, qymin, qxmax, qymax = bbox
+    ncols = int(math.ceil(360.0 / tile_degrees))
+    tiles = []
+    for tile, (width, height) in extents.items():
+        x0 = -180.0 + (tile % ncols) * tile_degrees
+        y0 = -90.0 + (tile // ncols) * tile_degrees
+        #Edge columns are clipped in tile_ids, so they hold roads starting beyond them.
+        left = -math.inf if tile % ncols == 0 else x0
+        right = math.inf if tile % ncols == ncols - 1 else x0 + tile_degrees
+        if left <= qxmax and right + width >= qxmin and y0 <= qymax and y0 + tile_degrees + height >= qymin:
+            tiles.append(tile)
+    return sorted(tiles)
+
+def read_roads(datasetPath, bbox=None, polygon=None, highways=None, columns=None):
+    """Read the roads intersecting a bbox (xmin, ymin, xmax, ymax) or polygon from a road dataset.
+
+    Only partitions for the requested highway classes and tiles whose roads
+    can reach the bbox (see TILE_EXTENTS) are opened, and row groups whose bbox statistics fall outside it are
+    skipped (pyarrow predicate pushdown).  A polygon is first reduced to its
+    bounds, then matched exactly.  Returns a GeoDataFrame in EPSG:4326.
+    """
+    dataset = ds.dataset(datasetPath, format="parquet", partitioning="hive")
+    if polygon is not None:
+        bbox = polygon.bounds
+    expr = None
+    if highways is not None:
+        expr = pc.field("highway").isin(list(highways))
+    if bbox is not None:
+        qxmin, qymin, qxmax, qymax = bbox
+        rows = (pc.field("xmax") >= qxmin) & (pc.field("xmin") <= qxmax) & (pc.field("ymax") >= qymin) & (pc.field("ymin") <= qymax)
+        expr = rows if expr is None else expr & rows
+        tileExtents = dataset_tile_extents(datasetPath)
+        if tileExtents is not None:
+            #Roads are tiled by their lower-left corner, so also open tiles left
+            #and below the bbox whose roads are long enough to run into it.
+            expr = expr & pc.field("tile").isin(bbox_tiles(bbox, *tileExtents))
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    table = dataset.to_table(columns=columns, filter=expr)
+    df = table.drop_columns(["geometry"]).to_pandas()
+    roads = gpd.GeoDataFrame(df, geometry=shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False)),
+                             crs="EPSG:4326")
+    if polygon is not None:
+        roads = roads[roads.intersects(polygon)]
+    return roads
@@ -0,0 +1,53 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+#Mean earth radius in meters.
+EARTH_RADIUS = 6371008.8
+
+def unit_vectors(lon, lat):
+    """Convert lon/lat degrees to 3D points on the unit sphere.
+
+    Straight-line (chord) distance between these points increases monotonically
+    with great-circle distance, so a KD-tree over them returns the true nearest
+    neighbours on the sphere without any projection error.
+    """
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def chord_to_meters(chord):
+    return 2 * np.arcsin(np.clip(chord / 2, 0, 1)) * EARTH_RADIUS
+
+class UrbanIndex:
+    """KD-tree over the urban centroids for candidate selection.
+
+    Built once per worker; query() returns the k nearest centroids for a whole
+    batch of origins in one vectorized call instead of a full-table distance
+    scan per origin.
+    """
+
+    def __init__(self, urbanPoints):
+        #urbanPoints must already be in EPSG:4326.
+        self.urbanPoints = urbanPoints
+        self.tree = cKDTree(unit_vectors(urbanPoints.geometry.x.values, urbanPoints.geometry.y.values))
+
+    def __len__(self):
+        return len(self.urbanPoints)
+
+    def query(self, lon, lat, k=20):
+        """Return (positions, meters), each of shape (n_origins, k), sorted nearest first.
+
+        positions are row positions into urbanPoints (use .iloc); meters are
+        great-circle distances.
+        """
+        k = min(k, len(self))
+        chord, positions = self.tree.query(unit_vectors(lon, lat), k=k, workers=-1)
+        #cKDTree drops the k axis when k == 1.
+        chord = np.asarray(chord).reshape(-1, k)
+        positions = np.asarray(positions).reshape(-1, k)
+        return positions, chord_to_meters(chord)
+
+    def candidates(self, positions):
+        """Candidate rows for one origin, in the order returned by query()."""
+        return self.urbanPoints.iloc[positions]
@@ -0,0 +1,90 @@
+import os
+import socket
+import uuid
+
+import numpy as np
+
+#Shards of the origin grid, by PID range, claimed by routing pods.
+#status moves pending -> claimed -> done; a claim older than the lease is
+#treated as abandoned (the pod died) and can be claimed again.
+CREATE_SHARDS = """CREATE TABLE IF NOT EXISTS roadshards (
+                       shard_id INT PRIMARY KEY,
+                       pid_min BIGINT NOT NULL,
+                       pid_max BIGINT NOT NULL,
+                       status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                       owner VARCHAR(255),
+                       claimed_at DATETIME,
+                       completed_at DATETIME,
+                       INDEX (status, claimed_at))"""
+
+def worker_name():
+    #Unique per process, so a restarted pod with the same name never owns its old claims.
+    return str(os.getenv('POD_NAME') or socket.gethostname()) + "-" + uuid.uuid4().hex[:8]
+
+def create_shards(conn, pids, shard_size):
+    """Split the sorted PIDs into ranges of shard_size origins and register them.
+
+    Does nothing if shards already exist, so every pod can call it at start-up;
+    pods racing on an empty table insert identical rows, which INSERT IGNORE drops.
+    pids may be a function returning them, called only when the table is
+    empty, so pods starting on an existing queue never read the origins.
+    Returns the number of shards in the table.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE_SHARDS)
+        cursor.execute("SELECT COUNT(*) FROM roadshards")
+        existing = cursor.fetchone()[0]
+        if existing == 0:
+            pids = np.unique(np.asarray(pids() if callable(pids) else pids, dtype=np.int64))
+            shards = [(i // shard_size, pids[i].item(), pids[min(i + shard_size, len(pids)) - 1].item())
+                      for i in range(0, len(pids), shard_size)]
+            cursor.executemany("INSERT IGNORE INTO roadshards (shard_id, pid_min, pid_max) VALUES (%s, %s, %s)", shards)
+        cursor.execute("SELECT COUNT(*) FROM roadshards")
+        count = cursor.fetchone()[0]
+    conn.commit()
+    return count
+
+def claim_shard(conn, owner, lease_seconds):
+    """Atomically claim the next pending (or abandoned) shard.
+
+    Returns (shard_id, pid_min, pid_max), or None when no work is left.
+    The claim is a single UPDATE ... LIMIT 1, so two pods can never hold the
+    same shard.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""UPDATE roadshards SET status = 'claimed', owner = %s, claimed_at = NOW()
+                          WHERE status = 'pending'
+                             OR (status = 'claimed' AND claimed_at < NOW() - INTERVAL %s SECOND)
+                          ORDER BY shard_id LIMIT 1""", (owner, lease_seconds))
+        claimed = cursor.rowcount
+        shard = None
+        if claimed:
+            cursor.execute("""SELECT shard_id, pid_min, pid_max FROM roadshards
+                              WHERE owner = %s AND status = 'claimed'
+                              ORDER BY claimed_at DESC, shard_id DESC LIMIT 1""", (owner,))
+            shard = cursor.fetchone()
+    conn.commit()
+    return shard
+
+def complete_shard(conn, shard_id, owner):
+    with conn.cursor() as cursor:
+        cursor.execute("""UPDATE roadshards SET status = 'done', completed_at = NOW()
+                          WHERE shard_id = %s AND owner = %s""", (shard_id, owner))
+    conn.commit()
+
+def done_pids(conn, pids, chunk=1000):
+    """The subset of pids that already have a row in roadresults.
+
+    roadresults stores the origin PID as text in urbanID, so the lookup is an
+    IN list of strings (which can use an index on urbanID).
+    """
+    pids = [str(p) for p in pids]
+    done = set()
+    with conn.cursor() as cursor:
+        for i in range(0, len(pids), chunk):
+            part = pids[i:i + chunk]
+            cursor.execute("SELECT DISTINCT urbanID FROM roadresults WHERE urbanID IN ("
+                           + ", ".join(["%s"] * len(part)) + ")", part)
+            done.update(r[0] for r in cursor.fetchall())
+    conn.commit()
+    return done